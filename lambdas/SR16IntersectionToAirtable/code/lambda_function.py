@@ -5,7 +5,7 @@ import fiona
 from shapely.geometry import shape
 from pyproj import CRS, Transformer
 import psycopg2
-from pyairtable import Api
+import airtable_io
 from shapely.validation import explain_validity
 
 # Initialize S3 client
@@ -24,6 +24,8 @@ local_dbf = '/tmp/vector_w_HK_infos.dbf'
 # Airtable configuration
 AIRTABLE_PERSONAL_ACCESS_TOKEN = os.getenv('AIRTABLE_PERSONAL_ACCESS_TOKEN')
 AIRTABLE_BASE_ID = os.getenv('AIRTABLE_BASE_ID')
+# Kept for the life of the container, so warm invocations reuse its connections (see airtable_io)
+airtable = airtable_io.AirtableClient(AIRTABLE_PERSONAL_ACCESS_TOKEN, AIRTABLE_BASE_ID)
 
 # Database connection parameters
 conn_params = {
@@ -118,9 +120,9 @@ def query_fragment(geom, cursor):
     return cursor.fetchone()[0]
 
 # Function to update Airtable rows based on a list of dictionaries
-def update_airtable_from_dict(data, table, forestID):
-    # Fetch all records from the table
-    records = table.all()
+def update_airtable_from_dict(data, table_name, forestID):
+    # Fetch the bestand_id of all records in the table
+    records = airtable.list_records(table_name, ['bestand_id'])
     record_map = {record['fields']['bestand_id']: record['id'] for record in records if 'bestand_id' in record['fields']}
     
     # Create a mapping of Airtable field names to dictionary keys
@@ -140,12 +142,11 @@ def update_airtable_from_dict(data, table, forestID):
         else:
             log(forestID, f"Record with bestand_id: {bestand_id} not found in Airtable")
     
-    # Perform batch upsert
-    batch_size = 10  # Adjust the batch size as needed
-    for i in range(0, len(batch_records), batch_size):
-        batch = batch_records[i:i + batch_size]
-        log(forestID, f"Upserting batch {i // batch_size + 1}: {len(batch)} records")
-        table.batch_upsert(batch, ['bestand_id'], replace=False)
+    # Update the records by id in batches, a few at a time at the pace Airtable allows
+    results = airtable.update_records(table_name, batch_records)
+    for i, (batch, response) in enumerate(results):
+        log(forestID, f"Updated batch {i + 1}: {len(batch)} records")
+    airtable_io.raise_for_failed_batches(results)
             
 def find_SR16_intersection(event):
     print("Finding SR16 intersection")
@@ -284,15 +285,12 @@ def find_SR16_intersection(event):
     TABLE_NAME = f'{forestID}_bestandsdata'
     try:
         log(forestID, f"Connecting to Airtable... to Base ID: {AIRTABLE_BASE_ID}")
-        api = Api(AIRTABLE_PERSONAL_ACCESS_TOKEN)
-        base = api.base(AIRTABLE_BASE_ID)
-        tables = base.schema().tables
-        table_exists = any(table.name == TABLE_NAME for table in tables)
+        tables = airtable.tables()
+        table_exists = any(table['name'] == TABLE_NAME for table in tables)
         
         if table_exists:
             log(forestID, f"Table {TABLE_NAME} exists. Proceeding with updates...")
-            table = base.table(TABLE_NAME)
-            update_airtable_from_dict(final_data, table, forestID)
+            update_airtable_from_dict(final_data, TABLE_NAME, forestID)
         else:
             log(forestID, f"Table {TABLE_NAME} does not exist in the Airtable")
             raise Exception(f"Table {TABLE_NAME} does not exist in the Airtable")
@@ -2,7 +2,7 @@ import os
 import boto3
 from botocore.exceptions import ClientError
 import shapefile
-from pyairtable import Api
+import airtable_io
 # Initialize the S3 client
 s3_client = boto3.client('s3')
 
@@ -18,6 +18,8 @@ local_dbf_path = '/tmp/vector_w_info.dbf'
 # Airtable configuration
 AIRTABLE_PERSONAL_ACCESS_TOKEN = os.getenv('AIRTABLE_PERSONAL_ACCESS_TOKEN')
 AIRTABLE_BASE_ID = os.getenv('AIRTABLE_BASE_ID')
+# Kept for the life of the container, so warm invocations reuse its connections (see airtable_io)
+airtable = airtable_io.AirtableClient(AIRTABLE_PERSONAL_ACCESS_TOKEN, AIRTABLE_BASE_ID)
 
 # Table fields and shape file records mappings
 table_fields_names_maps = {
@@ -98,6 +100,8 @@ airtable_fields = [
     {'name': 'volume_at_maturity', 'type': 'number', 'options': {'precision': 8}},
     {'name': 'volume_at_maturity_without_bark', 'type': 'number', 'options': {'precision': 8}},
     {'name': 'yield_requirement', 'type': 'number', 'options': {'precision': 3}},
+    # Fingerprint of the inputs the model results were computed from, set by the model lambda. Upserting a stand clears it, so the model recomputes it
+    {'name': 'model_fingerprint', 'type': 'singleLineText'},
 ]
 def log(forestID, message):
     if forestID:
@@ -150,20 +154,19 @@ def lambda_handler(event, context):
 
         try:
             log(forestID, f"Connecting to Airtable... to Base ID: {AIRTABLE_BASE_ID}")
-            api = Api(AIRTABLE_PERSONAL_ACCESS_TOKEN)
-            base = api.base(AIRTABLE_BASE_ID)
             # check if the table exists in the Airtable
-            tables = base.schema().tables
-            table_exists = any(table.name == TABLE_NAME for table in tables)
+            tables = airtable.tables()
+            table_exists = any(table['name'] == TABLE_NAME for table in tables)
             
             table = None
             if table_exists:
-                table = base.table(TABLE_NAME)
+                table = TABLE_NAME
             else:
                 log(forestID, f"Creating table {TABLE_NAME} in the Airtable")
                 # create the table
                 log(forestID, f"Creating table {TABLE_NAME} in the Airtable")
-                table = base.create_table(TABLE_NAME, airtable_fields)
+                airtable.create_table(TABLE_NAME, airtable_fields)
+                table = TABLE_NAME
                 log(forestID, f"Table {TABLE_NAME} created in the Airtable")
             if table is None:
                 log(forestID, f"Table {TABLE_NAME} does not exist in the Airtable and couldn't create it either!")
@@ -193,6 +196,9 @@ def lambda_handler(event, context):
                     if field_name in table_fields_names_maps:
                         mapped_record[table_fields_names_maps[field_name]] = value
 
+                # Clear the fingerprint of the model, so it recomputes the stand from the new values
+                mapped_record['model_fingerprint'] = ''
+
                 # Initialize a list to keep track of processed bestand_ids
 
                 # Cross-reference mapped_record with airtable_fields and cast values
@@ -227,12 +233,11 @@ def lambda_handler(event, context):
                 batch_records.append({"fields": mapped_record})
                 processed_bestand_ids.append(mapped_record['bestand_id'])
 
-            # Insert or update the records in the Airtable table in batches
-            batch_size = 10  # Adjust the batch size as needed
-            for i in range(0, len(batch_records), batch_size):
-                batch = batch_records[i:i + batch_size]
-                log(forestID, f"Upserting batch {i // batch_size + 1}: {len(batch)} records")
-                table.batch_upsert(batch, ['bestand_id'], replace=False)
+            # Insert or update the records in the Airtable table in batches, a few at a time at the pace Airtable allows
+            results = airtable.upsert_records(table, batch_records, ['bestand_id'])
+            for i, (batch, response) in enumerate(results):
+                log(forestID, f"Upserted batch {i + 1}: {len(batch)} records")
+            airtable_io.raise_for_failed_batches(results)
             log(forestID, f"Successfully upserted all batches to the table {TABLE_NAME}")
         except Exception as e:
             log(forestID, f"Error connecting to Airtable: {e}")
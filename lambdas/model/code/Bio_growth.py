@@ -1,20 +1,13 @@
 import json
 import numpy as np
 import pandas as pd
+import growth_engine
+import growth_model
+import ensemble
+#The model itself runs on plain dicts of NumPy arrays in growth_model. Bio_growth is the pandas adapter around it, with DataFrames in and out,
+#along with the row by row formulas and the 100 year dataframe functions used by local_model.py and notebooks
+from growth_model import adjustment_factor_bark, log, peak_rss_mb, StageMetrics, INPUT_COLUMNS, MATURITY_COLUMNS, maturity_column, wood_to_carbon
 
-#Adjustment factor because we are calculating volumes with bark, whereas when we look at value (and standing timber) we do not care about bark
-# Taken as a sort of average of the differences between SR16s values with and without bark for mature trees
-#According to SR16, in molidalen skog the average value is 0.86. This value does not vary much across hogstklasser
-#(For HK 5 the average was 0.86 and even for HK2 the value was 0.85. as such 0.86 is good enough for now)
-adjustment_factor_bark = 0.86
-
-def log(forestID, message):
-    if forestID:
-        print(f"forestID: {forestID} - {message}")
-    else:
-        forestID = "unknown"
-        print(f"forestID: {forestID} - {message}")
-        
 def add_cors_headers(response):
     response['headers'] = {
         'Access-Control-Allow-Origin': '*',
@@ -23,30 +16,23 @@ def add_cors_headers(response):
     }
     return response
 
+#The columns of df that growth_model works from
+def input_columns(df):
+    return {name: df[name].to_numpy() for name in df.columns if name in ('bestand_id', *INPUT_COLUMNS)}
+
+#A DataFrame of the columns computed by growth_model, after the input columns taken as they are from df
+def stands_frame(df, stands):
+    df_inputs = df[['bestand_id', *INPUT_COLUMNS]].copy()
+    computed = {name: values for name, values in stands.items() if name not in df_inputs.columns}
+    return pd.concat([df_inputs, pd.DataFrame(computed, index=df.index)], axis=1)
+
+#A short fingerprint of the INPUT_COLUMNS values of each stand and the model version, see growth_model.input_fingerprints
+def input_fingerprints(df):
+    return pd.Series(growth_model.input_fingerprints(input_columns(df)), index=df.index, dtype=object)
+
 def load_data(df, forestID):
-    log(forestID, "Bio_growth: Loading data!")
-    # Copy only certain columns from df to df_bestander
-    df_bestander = df[['bestand_id', 'hogstkl_verdi', 'bonitet', 'treslag', 'arealm2', 'alder', 'srhoydeo', 'srtrean', 'srgrflate', 'srvolmb', 'srvolub']].copy()
-    
-    # Add height in meters to the main dataframe. Getting that from the SR16 data, which provides height in decimeters
-    df_bestander['height'] = df_bestander['srhoydeo'] / 10
-    # We use the SR16V values for starting density
-    df_bestander['N_per_hectare'] = df_bestander['srtrean']
-    # Adding a new column 'G1' for grunnlflate. Taking the starting value from SR16V
-    df_bestander['G1'] = df_bestander['srgrflate']
-
-    log(forestID, "Bio_growth: reading CSVs!")
-    # Load the H40 bonitetstables for Gran and Furu
-    df_GH40 = pd.read_csv('Bonitetstabell_calculations-Gran_H40.csv')
-    df_FH40 = pd.read_csv('Bonitetstabell_calculations-Furu_H40.csv')
-    log(forestID, "Bio_growth: CSVs read!")
-    
-    merged_df_gran = pd.merge(df_bestander, df_GH40[['H40', 'Ht40']], left_on='bonitet', right_on='H40', how='left')
-    merged_df_furu = pd.merge(df_bestander, df_FH40[['H40', 'Ht40']], left_on='bonitet', right_on='H40', how='left')
-    df_bestander['Ht40'] = np.where(df_bestander['treslag'] == 'Gran', merged_df_gran['Ht40'], np.where(df_bestander['treslag'] == 'Furu', merged_df_furu['Ht40'], np.nan))
-    df_bestander['Ht40'] = pd.to_numeric(df_bestander['Ht40'], errors='coerce')
-    
-    return df_bestander
+    # Copy only certain columns from df to df_bestander, and add the starting height, N per hectare, G1 and Ht40
+    return stands_frame(df, growth_model.load_data(input_columns(df), forestID))
 
 
 #Adding a growth formula for the height of a stand of gran at time A2, starting out at height H1 at time A1
@@ -232,188 +218,128 @@ def saw_wood_portion(row):
     return saw_wood_portion
 
 
-#The first dataframe for future values we want to calculate is height, as we can calculate that only based on the current values we have
-def calculate_future_heights(df_bestander, gran_filter, furu_filter):
-    df_bestand_height_100years = pd.DataFrame({0: df_bestander['height']})
-
-    for year in range(1, 101):
-        for idx, row in df_bestand_height_100years.iterrows():
-
-            #if we dont have a value for the yearly_height_growth for the stand then we skip the 100 year calculation
-            if np.isnan(df_bestander.at[idx, 'yearly_height_growth']):
-                continue
+#The future values are kept in stands x years matrices preallocated by growth_engine.allocate_trajectories.
+#trajectory_frame wraps such a matrix in a DataFrame without copying it, for code that expects the 100 year dataframes
+def trajectory_frame(trajectory, index, first_year=0):
+    return pd.DataFrame(trajectory, index=index, columns=range(first_year, first_year + trajectory.shape[1]), copy=False)
 
-            if gran_filter.loc[idx]:
-                df_bestand_height_100years.at[idx, year] = func_gran_H02(
-                    df_bestand_height_100years.at[idx, year - 1],
-                    df_bestander['alder'].at[idx] + year - 1,
-                    df_bestander['alder'].at[idx] + year
-                    )
-            elif furu_filter.loc[idx]:
-                df_bestand_height_100years.at[idx, year] = func_furu_H02(
-                    df_bestand_height_100years.at[idx, year - 1],
-                    df_bestander['alder'].at[idx] + year - 1,
-                    df_bestander['alder'].at[idx] + year
-                    )
-    return df_bestand_height_100years
+#The first dataframe for future values we want to calculate is height, as we can calculate that only based on the current values we have
+#The heights are evaluated by growth_engine.height_trajectory, furu stands straight from their starting height and age and
+#gran stands year by year, or also straight from the start with direct_gran=True (see height_trajectory for why that differs)
+#When out is given (a matrix from growth_engine.allocate_trajectories) the heights are written into it
+def calculate_future_heights(df_bestander, gran_filter, furu_filter, out=None, direct_gran=False, horizon=growth_engine.HORIZON):
+    #if we dont have a value for the yearly_height_growth for the stand then we skip the 100 year calculation
+    active = df_bestander['yearly_height_growth'].notna().to_numpy()
+    years = np.arange(out.shape[1] if out is not None else horizon + 1)
+
+    heights = growth_engine.height_trajectory(
+        df_bestander['height'].to_numpy(dtype=float),
+        df_bestander['alder'].to_numpy(dtype=float),
+        gran_filter.to_numpy() & active,
+        furu_filter.to_numpy() & active,
+        years,
+        direct_gran=direct_gran,
+        out=out,
+        )
+    return trajectory_frame(heights, df_bestander.index)
 
 
 
 # We want to calculate the future N per hectare for each stand
-def calculate_future_N_per_hectare(df_bestander, df_bestand_height_100years, gran_filter, furu_filter):
-        df_bestand_N_per_hectare_100years = pd.DataFrame({0: df_bestander['N_per_hectare']})
-    
-        for year in range(1, 101):
-            for idx, row in df_bestand_N_per_hectare_100years.iterrows():
-    
-                #if we dont have the yearly change in density for the stand then we skip the 100 year calculation
-                if np.isnan(df_bestander.at[idx, 'delta_N_per_hectare']):
-                    continue
-    
-                if gran_filter.loc[idx]:
-                    df_bestand_N_per_hectare_100years.at[idx, year] = gran_N2_per_hectare(
-                        df_bestand_N_per_hectare_100years.at[idx, year - 1],
-                        df_bestander['alder'].at[idx] + year - 1,
-                        df_bestander['alder'].at[idx] + year,
-                        df_bestander['Ht40'].at[idx]
-                        )
-                elif furu_filter.loc[idx]:
-                    df_bestand_N_per_hectare_100years.at[idx, year] = furu_N2_per_hectare(
-                        df_bestand_N_per_hectare_100years.at[idx, year - 1],
-                        df_bestander['alder'].at[idx] + year - 1,
-                        df_bestander['alder'].at[idx] + year,
-                        df_bestander['Ht40'].at[idx]
-                        )
-        return df_bestand_N_per_hectare_100years
-
-def calculate_future_base_area(df_bestander, df_bestand_height_100years, df_bestand_N_per_hectare_100years, gran_filter, furu_filter):
-    df_bestand_G_100years = pd.DataFrame({0: df_bestander['G2']})
-
-    for year in range(1, 101):
-        for idx, row in df_bestand_G_100years.iterrows():
-
-            #if we dont have the yearly change in base area for the stand then we skip the 100 year calculation
-            if np.isnan(df_bestander.at[idx, 'volume_growth_next_year']):
-                continue
-
-            if gran_filter.loc[idx]:
-                df_bestand_G_100years.at[idx, year] = gran_basearea_growth(
-                    df_bestand_G_100years.at[idx, year - 1],
-                    df_bestand_N_per_hectare_100years.at[idx, year - 1],
-                    df_bestand_N_per_hectare_100years.at[idx, year],
-                    df_bestand_height_100years.at[idx, year - 1],
-                    df_bestand_height_100years.at[idx, year],
-                    )
-            elif furu_filter.loc[idx]:
-                df_bestand_G_100years.at[idx, year] = furu_basearea_growth(
-                    df_bestand_G_100years.at[idx, year - 1],
-                    df_bestander['alder'].at[idx] + year - 1,
-                    df_bestander['alder'].at[idx] + year,
-                    df_bestand_height_100years.at[idx, year - 1],
-                    df_bestand_height_100years.at[idx, year],
-                    df_bestand_N_per_hectare_100years.at[idx, year - 1],
-                    df_bestand_N_per_hectare_100years.at[idx, year],
-                    )
-    return df_bestand_G_100years
+def calculate_future_N_per_hectare(df_bestander, df_bestand_height_100years, gran_filter, furu_filter, out=None):
+    #if we dont have the yearly change in density for the stand then we skip the 100 year calculation
+    active = df_bestander['delta_N_per_hectare'].notna().to_numpy()
+
+    densities = growth_engine.project_N_per_hectare(
+        df_bestander['N_per_hectare'].to_numpy(dtype=float),
+        df_bestander['alder'].to_numpy(dtype=float),
+        df_bestander['Ht40'].to_numpy(dtype=float),
+        gran_filter.to_numpy() & active,
+        furu_filter.to_numpy() & active,
+        out=out,
+        )
+    return trajectory_frame(densities, df_bestander.index)
+
+def calculate_future_base_area(df_bestander, df_bestand_height_100years, df_bestand_N_per_hectare_100years, gran_filter, furu_filter, out=None):
+    #if we dont have the yearly change in volume for the stand then we skip the 100 year calculation
+    active = df_bestander['volume_growth_next_year'].notna().to_numpy()
+
+    base_areas = growth_engine.project_base_area(
+        df_bestander['G2'].to_numpy(dtype=float),
+        df_bestander['alder'].to_numpy(dtype=float),
+        df_bestand_height_100years.to_numpy(),
+        df_bestand_N_per_hectare_100years.to_numpy(),
+        gran_filter.to_numpy() & active,
+        furu_filter.to_numpy() & active,
+        out=out,
+        )
+    return trajectory_frame(base_areas, df_bestander.index)
 
 #Now we can calculate the volume per hectare for the next 100 years
-def calculate_future_volume_per_hectare(df_bestander, df_bestand_height_100years, df_bestand_G_100years, gran_filter, furu_filter):
-    df_bestand_volume_per_hectare_100years = pd.DataFrame({0: df_bestander['volume_per_hectare']})
-
-    for year in range(1, 101):
-        for idx, row in df_bestand_volume_per_hectare_100years.iterrows():
-
-            #if we dont have the yearly change in volume for the stand then we skip the 100 year calculation
-            if np.isnan(df_bestander.at[idx, 'volume_growth_next_year']):
-                continue
-
-            if gran_filter.loc[idx]:
-                df_bestand_volume_per_hectare_100years.at[idx, year] = gran_volume(
-                    df_bestand_G_100years.at[idx, year],
-                    df_bestand_height_100years.at[idx, year],
-                    df_bestander['alder'].at[idx] + year
-                    )
-            elif furu_filter.loc[idx]:
-                df_bestand_volume_per_hectare_100years.at[idx, year] = furu_volume(
-                    df_bestand_G_100years.at[idx, year],
-                    df_bestand_height_100years.at[idx, year],
-                    df_bestander['alder'].at[idx] + year
-                    )
-    return df_bestand_volume_per_hectare_100years
-
-#Calculate the future growth rate per year
-def calculate_future_growth_rate(df_bestand_volume_per_hectare_100years):
-    df_bestand_growth_rate_100years = pd.DataFrame()
-
-    for year in range(1, df_bestand_volume_per_hectare_100years.shape[1]):
-        current_year_col = df_bestand_volume_per_hectare_100years.columns[year]
-        previous_year_col = df_bestand_volume_per_hectare_100years.columns[year - 1]
-        df_bestand_growth_rate_100years[current_year_col] = (
-            (df_bestand_volume_per_hectare_100years[current_year_col] - df_bestand_volume_per_hectare_100years[previous_year_col]) / df_bestand_volume_per_hectare_100years[previous_year_col]
+def calculate_future_volume_per_hectare(df_bestander, df_bestand_height_100years, df_bestand_G_100years, gran_filter, furu_filter, out=None):
+    #if we dont have the yearly change in volume for the stand then we skip the 100 year calculation
+    active = df_bestander['volume_growth_next_year'].notna().to_numpy()
+
+    volumes = growth_engine.project_volume_per_hectare(
+        df_bestander['volume_per_hectare'].to_numpy(dtype=float),
+        df_bestander['alder'].to_numpy(dtype=float),
+        df_bestand_height_100years.to_numpy(),
+        df_bestand_G_100years.to_numpy(),
+        gran_filter.to_numpy() & active,
+        furu_filter.to_numpy() & active,
+        out=out,
         )
-    return df_bestand_growth_rate_100years
+    return trajectory_frame(volumes, df_bestander.index)
+
+#Calculate the future growth rate per year. The growth rates start at year 1
+def calculate_future_growth_rate(df_bestand_volume_per_hectare_100years, out=None):
+    growth_rates = growth_engine.growth_rate_array(df_bestand_volume_per_hectare_100years.to_numpy(), out=out)
+    return trajectory_frame(growth_rates[:, 1:], df_bestand_volume_per_hectare_100years.index, first_year=1)
 
 #calculate the years to maturity for each stand
 def calculate_years_to_maturity(df_bestander, df_bestand_growth_rate_100years, yield_requirement=0.03):
+    # If we don't have value for volume_growth_next_year for the stand, skip the maturity calculation
+    active = df_bestander['volume_growth_next_year'].notna().to_numpy()
+
+    # Year 1 growth rates come out too high so that we get too many years_to_maturity == 1.
+    #(And the first column is nan) Fixing this by starting the check at [2:] but this should be revisited
+    growth_rates = df_bestand_growth_rate_100years.loc[:, 2:].to_numpy()
+
     # Adding the column for the years to maturity to the main dataframe (df_bestander)
-    df_bestander['years_to_maturity'] = np.nan
-
-    for idx in df_bestander.index:
-        # If we don't have value for volume_growth_next_year for the stand, skip the maturity calculation
-        if np.isnan(df_bestander.at[idx, 'volume_growth_next_year']):
-            continue
-
-        # Year 1 growth rates come out too high so that we get too many years_to_maturity == 1.
-        #(And the first column is nan) Fixing this by starting the check at [2:] but this should be revisited
-        # Get the growth rates for the current stand
-        growth_rates = df_bestand_growth_rate_100years.loc[idx, 2:].values
-
-        # Find the first year where the growth rate falls below the yield requirement
-        years_below_yield = np.where(growth_rates < yield_requirement)[0]
-
-        if len(years_below_yield) > 0:
-            first_year_below_yield = years_below_yield[0]
-            df_bestander.at[idx, 'years_to_maturity'] = first_year_below_yield
-        else:
-            df_bestander.at[idx, 'years_to_maturity'] = 0
-            
+    df_bestander['years_to_maturity'] = growth_engine.years_to_maturity_array(growth_rates, active, yield_requirement)
     return df_bestander
 
 #Function to calculate the volume at maturity for each stand. This is done by taking the years_to_maturity and and finding the corresponding volume in the volume_per_hectare_100years dataframe
 def calculate_volume_at_maturity(df_bestander, df_bestand_volume_per_hectare_100years):
-    df_bestander['volume_at_maturity'] = np.nan
-    
-    for idx in df_bestander.index:
-        if np.isnan(df_bestander.at[idx, 'years_to_maturity']):
-            continue
-    
-        maturity_year = df_bestander.at[idx, 'years_to_maturity']
-        df_bestander.at[idx, 'volume_at_maturity'] = df_bestand_volume_per_hectare_100years.at[idx, maturity_year] * df_bestander.at[idx, 'arealm2'] / 10000
-    
+    df_bestander['volume_at_maturity'] = growth_engine.volume_at_maturity_array(
+        df_bestand_volume_per_hectare_100years.to_numpy(),
+        df_bestander['years_to_maturity'].to_numpy(dtype=float),
+        df_bestander['arealm2'].to_numpy(dtype=float),
+        )
     return df_bestander
 
-#Now we'll go on to estimate the carbon stored and carbon captured
-# In the first iteration we'll do this conversion on the basis of a fixed conversion of biomass to carbon
-#Well use the values from this paper: https://www.mdpi.com/1999-4907/11/5/587.
-#The density of the wood depends on species and other factors such as the number of trees per stand
-# The values for both Gran and Furu are quite similar, though pine is somewhat more dense than spruce. (In the order o 5% or less)
-# For now we'll use the value of 450kg/m3 for all wood.
-#Wood is generally about 0.5 carbon by weight, so we'll use a conversion factor of 0.5 https://www.fs.usda.gov/sites/default/files/Forest-Carbon-FAQs.pdf#:~:text=URL%3A%20https%3A%2F%2Fwww.fs.usda.gov%2Fsites%2Fdefault%2Ffiles%2FForest
-#One kg of pure carbon produces 3.67 kg of CO2, so we'll use that as a conversion factor to CO2 (44 units CO2/12 units C)
-
-#According to skog.no the breakdown of biomass in trees is 50% in the wood (sawwood + pulp), 25% in the branches and tops, and 25% in the roots and stump https://skog.no/wp-content/uploads/2016/05/Trevirke-som-fornybart-r%C3%A5stoff.pdf
-#Thus we will adjust the amount of carbon stored up by a factor of (25% + 50%)/50% = 1.5
-def wood_to_carbon(wood_volume):
-    wood_density = 450 #kg/m3 
-    carbon_fraction = 0.5 #How much of the wood is carbon
-    CO2_conversion_factor = 3.67 #kg CO2/kg C
-    wood_to_above_ground_factor = 1.5 #Adjustment factor for the amount of carbon stored in the stand
 
-    carbon_stored = wood_volume * wood_density * carbon_fraction * CO2_conversion_factor * wood_to_above_ground_factor
-
-    return carbon_stored
-
-def main(df=None, yield_requirement = 0.03, forestID = None):
+#The maturity results for each of several yield requirements as plain records, one list of stands per requirement.
+#df_bestander is what main returns when given the same yield_requirements. Missing values become None so the records are valid JSON
+def maturity_sweep_records(df_bestander, yield_requirements):
+    columns = ['bestand_id'] + [maturity_column(column, requirement) for requirement in yield_requirements for column in MATURITY_COLUMNS]
+    return growth_model.maturity_sweep_records({column: df_bestander[column].to_numpy() for column in columns}, yield_requirements)
+
+#Runs the model (growth_model.run) for the stands in df, returning them as a DataFrame with the model results added.
+#yield_requirement can be a single value or a list of them. With a list, the stands are simulated once for all of them,
+#the standard columns are filled for the first one and maturity_column columns are added for each of them
+#trajectories can be a dict from growth_engine.allocate_trajectories(len(df)) to also get the yearly values of every stand
+#direct_gran_heights evaluates the gran heights without yearly chaining, see growth_engine.height_trajectory
+#horizon is the number of years we look ahead for the maturity year. Stands stop being simulated once they have matured
+#trajectory_cache can be a trajectory_cache.TrajectoryCache, stands already in it are then not simulated again (it is not used with trajectories)
+#With profile=True main returns (df_bestander, metrics), metrics being the list of StageMetrics records of the stages.
+#With emit_metrics=True the stage metrics are also printed as JSON log lines
+#chunk_size runs the stands that many at a time (see growth_model.run_chunks), to bound the memory for very large forests.
+#The results are the same, and the metrics of the chunks are summed per stage
+#processes simulates the stands in that many worker processes (see parallel_simulation), for bulk reruns on a machine with several cores
+#thinning_scenarios (e.g. thinning.DEFAULT_SCENARIOS) adds the best thinning scenario of each stand, see growth_model.THINNING_COLUMNS
+#trajectory_writer (a trajectory_export.TrajectoryWriter) collects the yearly trajectories of the stands for export as one columnar file
+def main(df=None, yield_requirement = 0.03, forestID = None, trajectories = None, direct_gran_heights = False, horizon = growth_engine.HORIZON, trajectory_cache = None, profile = False, emit_metrics = False, chunk_size = None, processes = None, thinning_scenarios = None, trajectory_writer = None):
     log(forestID, "Bio_growth: Starting main function!")
     #Setting up, loading, and cleaning the data
     if df is None:
@@ -422,71 +348,29 @@ def main(df=None, yield_requirement = 0.03, forestID = None):
             'body': json.dumps({'error': 'Missing dataframe'})
         }
         return add_cors_headers(response)
-    else:
-        df_bestander = load_data(df, forestID)
-
-    log(forestID, "Bio_growth: Data loaded!")
-    # Apply the grain height growth function to compute yearly height growth for 'Gran' rows in the dataframe
-    gran_filter = df_bestander['treslag'] == 'Gran'
-    df_bestander.loc[gran_filter, 'yearly_height_growth'] = df_bestander[gran_filter].apply(lambda row: func_gran_H02(row['height'], row['alder'], row['alder'] + 1), axis=1) - df_bestander.loc[gran_filter, 'height']
-    # Apply the furu height growth function to compute yearly height growth for 'Furu' rows in the dataframe
-    furu_filter = df_bestander['treslag'] == 'Furu'
-    df_bestander.loc[furu_filter, 'yearly_height_growth'] = df_bestander[furu_filter].apply(lambda row: func_furu_H02(row['height'], row['alder'], row['alder'] + 1), axis=1) - df_bestander.loc[furu_filter, 'height']
-    #Apply the function to compute the yearly change in the number of trees per hectare
-    df_bestander['delta_N_per_hectare'] = df_bestander.apply(lambda row: calculate_N_per_hectare(row, N1_per_hectare_column='N_per_hectare', A1=row['alder'], A2=row['alder']+1, GE=1, GF=1), axis=1) - df_bestander['N_per_hectare']
-    # Calculating base area growth and storing in a new column
-    df_bestander['G2'] = df_bestander.apply(apply_basearea_growth, axis=1).astype(float)
-    #Adding volume_per_hectare and volume_per_hectare_next_year to the dataframe
-    #First we calculate the volume per hectare for the current year for gran and furu
-    df_bestander['volume_per_hectare'] = df_bestander.apply(apply_current_volume_per_hectare, axis=1)
-    #If the calculated volume_per_hectare is NaN, then we use the value for volume with bark from SR16V (srvolmb) if it exists
-    df_bestander['volume_per_hectare'] = df_bestander['volume_per_hectare'].fillna(df_bestander['srvolmb'])
-    df_bestander['volume_per_hectare_next_year'] = df_bestander.apply(apply_nextyear_volume_per_hectare, axis=1)
-    #Adding volume adjusted for bark to the dataframe
-    df_bestander['volume_per_hectare_without_bark'] = adjustment_factor_bark * df_bestander['volume_per_hectare']
-    #Adding volume growth and volume growth factor to the dataframe
-    df_bestander['volume'] = df_bestander['volume_per_hectare'] * df_bestander['arealm2']/10000
-    df_bestander['volume_next_year'] = df_bestander['volume_per_hectare_next_year'] * df_bestander['arealm2']/10000
-    df_bestander['volume_growth_next_year'] = df_bestander['volume_next_year'] - df_bestander['volume']
-    df_bestander['volume_growth_factor'] = (df_bestander['volume_next_year'] / df_bestander['volume']) - 1
-    #Calculate saw wood portion based to the bonitet of the stand
-    df_bestander['saw_wood_portion'] = df_bestander.apply(saw_wood_portion, axis=1)
-    #adjusting the standing volume to not include bark
-    df_bestander['volume_without_bark'] = df_bestander['volume'] * adjustment_factor_bark
-
-    #Adding carbon currently stored based on standing volume
-    df_bestander['carbon_stored'] = wood_to_carbon(df_bestander['volume'])
-
-    #Adding carbon captured per year based on yearly growth in volume
-    df_bestander['carbon_captured_next_year'] = wood_to_carbon(df_bestander['volume_growth_next_year'])
-
-    #Adding a column "yield_requirement" to keep track of the yield requirement used for this calculation
-    df_bestander['yield_requirement'] = yield_requirement
-    
-    #Now we move on to calculating the future values
-    #First we calculate the future heights of the stands
-    log(forestID, "Bio_growth: Calculating future values!")
-    df_bestand_height_100years = calculate_future_heights(df_bestander, gran_filter, furu_filter)
-    #Then we calculate the future N per hectare for each stand
-    log(forestID, "Bio_growth: Calculating future N per hectare!")
-    df_bestand_N_per_hectare_100years = calculate_future_N_per_hectare(df_bestander, df_bestand_height_100years, gran_filter, furu_filter)
-    log(forestID, "Bio_growth: Calculating future base area!")
-    #Then we calculate the future base area for each stand
-    df_bestand_G_100years = calculate_future_base_area(df_bestander, df_bestand_height_100years, df_bestand_N_per_hectare_100years, gran_filter, furu_filter)
-    log(forestID, "Bio_growth: Calculating future volume per hectare!")
-    #Then we calculate the future volume per hectare for each stand
-    df_bestand_volume_per_hectare_100years = calculate_future_volume_per_hectare(df_bestander, df_bestand_height_100years, df_bestand_G_100years, gran_filter, furu_filter)
-    log(forestID, "Bio_growth: Calculating future growth rate!")
-    #Then we calculate the future growth rate per year for each stand
-    df_bestand_growth_rate_100years = calculate_future_growth_rate(df_bestand_volume_per_hectare_100years)
-    log(forestID, "Bio_growth: Calculating years to maturity!")
-    #Then we calculate the years to maturity for each stand and the volume at maturity
-    df_bestander = calculate_years_to_maturity(df_bestander, df_bestand_growth_rate_100years, yield_requirement)
-    log(forestID, "Bio_growth: Calculating volume at maturity!")
-    #And finally we calculate the volume at maturity for each stand
-    df_bestander = calculate_volume_at_maturity(df_bestander, df_bestand_volume_per_hectare_100years)
-    #And adding a column for volume at maturity without bark
-    df_bestander['volume_at_maturity_without_bark'] = adjustment_factor_bark * df_bestander['volume_at_maturity']
-
-    log(forestID, "Bio_growth: Done calculating future values! Returning the dataframe!")
-    return df_bestander
\ No newline at end of file
+
+    metrics = StageMetrics(forestID, emit=emit_metrics)
+    stands = growth_model.run(
+        input_columns(df[['bestand_id', *INPUT_COLUMNS]]),
+        yield_requirement,
+        forestID=forestID,
+        trajectories=trajectories,
+        direct_gran_heights=direct_gran_heights,
+        horizon=horizon,
+        trajectory_cache=trajectory_cache,
+        metrics=metrics,
+        chunk_size=chunk_size,
+        processes=processes,
+        thinning_scenarios=thinning_scenarios,
+        trajectory_writer=trajectory_writer,
+        )
+    df_bestander = stands_frame(df, stands)
+    if profile:
+        return df_bestander, metrics.stages
+    return df_bestander
+
+#Percentile bands of volume, carbon_stored and years_to_maturity for every stand, from n_samples runs with the SR16 values perturbed.
+#See ensemble.ensemble_bands for the arguments. Returns a frame with bestand_id and the band columns, e.g. volume_p5 and volume_p95
+def ensemble_bands(df, n_samples = 100, yield_requirement = 0.03, forestID = None, **kwargs):
+    bands = ensemble.ensemble_bands(input_columns(df), n_samples, yield_requirement, forestID=forestID, **kwargs)
+    return pd.DataFrame(bands, index=df.index)
@@ -0,0 +1,9 @@
+import numpy as np
+import growth_engine
+
+#Compiles the H40 bonitet CSVs into growth_engine.BONITET_TABLES_FILE, one dense Ht40 array per species indexed by bonitet.
+#Run it from the directory with the CSVs before packaging the lambda (the Dockerfile does), so the CSVs don't have to be parsed on a cold start
+if __name__ == "__main__":
+    tables = {species: growth_engine._read_bonitet_csv(file_name) for species, file_name in growth_engine.BONITET_TABLE_FILES.items()}
+    np.savez(growth_engine.BONITET_TABLES_FILE, **tables)
+    print(f"Wrote {growth_engine.BONITET_TABLES_FILE} with bonitets up to {max(len(table) for table in tables.values()) - 1}")
@@ -0,0 +1,375 @@
+import json
+import hashlib
+import time
+import numpy as np
+import growth_engine
+import thinning
+try:
+    import resource
+except ImportError:
+    #resource is not available on Windows, we then leave out the peak memory
+    resource = None
+
+#The growth model for a whole forest, working on plain dicts of columns (lists or NumPy arrays, one entry per stand) so it runs without pandas.
+#Bio_growth is the pandas adapter around it, used by local_model.py and notebooks. The model lambda uses this module directly
+
+#Adjustment factor because we are calculating volumes with bark, whereas when we look at value (and standing timber) we do not care about bark
+# Taken as a sort of average of the differences between SR16s values with and without bark for mature trees
+#According to SR16, in molidalen skog the average value is 0.86. This value does not vary much across hogstklasser
+#(For HK 5 the average was 0.86 and even for HK2 the value was 0.85. as such 0.86 is good enough for now)
+adjustment_factor_bark = 0.86
+
+def log(forestID, message):
+    if forestID:
+        print(f"forestID: {forestID} - {message}")
+    else:
+        forestID = "unknown"
+        print(f"forestID: {forestID} - {message}")
+
+#Peak resident memory of the process so far in MB, None where we can't tell
+def peak_rss_mb():
+    if resource is None:
+        return None
+    #ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+#Records the wall time, CPU time, peak memory and number of stands of each stage of the model.
+#A stage runs from begin() until the next begin() or finish(). With emit=True every stage is also printed as a JSON log line,
+#e.g. {"metric": "Bio_growth.stage", "forestID": "...", "stage": "simulate_stands", "wall_seconds": 0.21, ...}, for the dashboards.
+#peak_rss_mb is the peak of the process up to the end of the stage, so it only goes up from one stage to the next.
+#The stages of the chunks of a forest run in chunks (see run_chunks) are merged into one record per stage, recorded by finish
+class StageMetrics:
+    def __init__(self, forestID=None, emit=False):
+        self.forestID = forestID
+        self.emit = emit
+        self.stages = []
+        self.current = None
+        self.merged = {}
+        self.started = (time.perf_counter(), time.process_time())
+
+    def begin(self, stage, stands):
+        self.end()
+        self.current = (stage, stands, time.perf_counter(), time.process_time())
+
+    def end(self):
+        if self.current is None:
+            return
+        stage, stands, wall, cpu = self.current
+        self.current = None
+        self.record({
+            'stage': stage,
+            'stands': int(stands),
+            'wall_seconds': time.perf_counter() - wall,
+            'cpu_seconds': time.process_time() - cpu,
+            'peak_rss_mb': peak_rss_mb(),
+        })
+
+    #Adds the stages recorded by other metrics (e.g. of one chunk of the stands) to the merged stages: the stands, wall and CPU seconds
+    #of a stage are summed and peak_rss_mb is the highest. Their 'total' stage is left out, finish records the total
+    def merge(self, other):
+        for metrics in other.stages:
+            if metrics['stage'] == 'total':
+                continue
+            merged = self.merged.get(metrics['stage'])
+            if merged is None:
+                self.merged[metrics['stage']] = dict(metrics)
+                continue
+            for key in ('stands', 'wall_seconds', 'cpu_seconds'):
+                merged[key] += metrics[key]
+            if metrics['peak_rss_mb'] is not None:
+                merged['peak_rss_mb'] = max(merged['peak_rss_mb'], metrics['peak_rss_mb'])
+
+    #Ends the last stage, records the merged stages and adds a 'total' stage covering everything since the metrics were created
+    def finish(self, stands):
+        self.end()
+        for metrics in self.merged.values():
+            self.record(metrics)
+        self.merged = {}
+        wall, cpu = self.started
+        self.record({
+            'stage': 'total',
+            'stands': int(stands),
+            'wall_seconds': time.perf_counter() - wall,
+            'cpu_seconds': time.process_time() - cpu,
+            'peak_rss_mb': peak_rss_mb(),
+        })
+        return self.stages
+
+    def record(self, metrics):
+        self.stages.append(metrics)
+        if self.emit:
+            print(json.dumps({'metric': 'Bio_growth.stage', 'forestID': self.forestID, **metrics}))
+
+#The columns of the input that the results of the model depend on
+INPUT_COLUMNS = ('hogstkl_verdi', 'bonitet', 'treslag', 'arealm2', 'alder', 'srhoydeo', 'srtrean', 'srgrflate', 'srvolmb', 'srvolub')
+
+#The columns run computes for every stand, after bestand_id and the INPUT_COLUMNS
+RESULT_COLUMNS = (
+    'height', 'N_per_hectare', 'G1', 'Ht40', 'yearly_height_growth', 'delta_N_per_hectare', 'G2',
+    'volume_per_hectare', 'volume_per_hectare_next_year', 'volume_per_hectare_without_bark', 'volume', 'volume_next_year',
+    'volume_growth_next_year', 'volume_growth_factor', 'saw_wood_portion', 'volume_without_bark', 'carbon_stored',
+    'carbon_captured_next_year', 'yield_requirement', 'years_to_maturity', 'volume_at_maturity', 'volume_at_maturity_without_bark',
+    )
+
+#The maturity results that depend on the yield requirement
+MATURITY_COLUMNS = ('years_to_maturity', 'volume_at_maturity', 'volume_at_maturity_without_bark')
+
+#The columns run adds for the best thinning scenario of each stand (see thinning.best_thinning), when it is given thinning_scenarios
+THINNING_COLUMNS = ('thinning_year', 'thinning_share', 'thinning_volume', 'years_to_maturity_with_thinning', 'volume_at_maturity_with_thinning')
+
+#Name of the column holding a maturity result for one of several yield requirements, e.g. years_to_maturity_0.02
+def maturity_column(column, yield_requirement):
+    return f"{column}_{yield_requirement:g}"
+
+#Values as a float array. Missing values and values that are not numbers become np.nan, like pd.to_numeric(errors='coerce')
+def numbers(values):
+    try:
+        return np.asarray(values, dtype=float)
+    except (TypeError, ValueError):
+        converted = np.full(len(values), np.nan)
+        for i, value in enumerate(values):
+            try:
+                converted[i] = float(value)
+            except (TypeError, ValueError):
+                pass
+        return converted
+
+#Turns records (one dict per stand, e.g. the fields of the Airtable records) into a dict of columns.
+#Stands that are missing a field get None for it
+def records_to_columns(records, names):
+    columns = {}
+    for name in names:
+        values = np.empty(len(records), dtype=object)
+        values[:] = [record.get(name) for record in records]
+        columns[name] = values
+    return columns
+
+#Turns a dict of columns back into records, with missing values replaced by missing_value and NumPy values turned into plain Python values
+def columns_to_records(columns, missing_value=None):
+    names = list(columns)
+    values = []
+    for name in names:
+        column = np.asarray(columns[name])
+        column = [missing_value if value is None or value != value else value for value in column.tolist()]
+        values.append(column)
+    return [dict(zip(names, record)) for record in zip(*values)]
+
+#The stands selected by a boolean mask (or an index array) from every column
+def select_stands(columns, stands):
+    return {name: np.asarray(values)[stands] for name, values in columns.items()}
+
+#A short fingerprint of the INPUT_COLUMNS values of each stand and the model version, so we can tell which stands have changed since they were last computed.
+#Numbers are compared as floats, so 12 and 12.0 give the same fingerprint, and missing columns count as missing values.
+#With missing_value the missing values are fingerprinted as that value, the way columns_to_records writes them back,
+#so a stand read back after it was written gets the fingerprint it was written with
+def input_fingerprints(columns, missing_value=None):
+    n_stands = len(next(iter(columns.values())))
+    missing = np.full(n_stands, None, dtype=object)
+    if missing_value is not None:
+        columns = {
+            name: np.array([missing_value if value is None or value != value else value for value in np.asarray(columns.get(name, missing), dtype=object).tolist()], dtype=object)
+            for name in INPUT_COLUMNS
+            }
+    treslag = ['' if species is None or species != species else str(species) for species in np.asarray(columns.get('treslag', missing), dtype=object)]
+    values = np.column_stack([numbers(columns.get(name, missing)) for name in INPUT_COLUMNS if name != 'treslag']) + 0.0
+    values[np.isnan(values)] = np.nan
+    fingerprints = [
+        hashlib.sha1(f"{growth_engine.MODEL_VERSION}|{species}|".encode() + stand.tobytes()).hexdigest()[:16]
+        for species, stand in zip(treslag, values)
+        ]
+    return np.array(fingerprints, dtype=object)
+
+#Now we'll go on to estimate the carbon stored and carbon captured
+# In the first iteration we'll do this conversion on the basis of a fixed conversion of biomass to carbon
+#Well use the values from this paper: https://www.mdpi.com/1999-4907/11/5/587.
+#The density of the wood depends on species and other factors such as the number of trees per stand
+# The values for both Gran and Furu are quite similar, though pine is somewhat more dense than spruce. (In the order o 5% or less)
+# For now we'll use the value of 450kg/m3 for all wood.
+#Wood is generally about 0.5 carbon by weight, so we'll use a conversion factor of 0.5 https://www.fs.usda.gov/sites/default/files/Forest-Carbon-FAQs.pdf#:~:text=URL%3A%20https%3A%2F%2Fwww.fs.usda.gov%2Fsites%2Fdefault%2Ffiles%2FForest
+#One kg of pure carbon produces 3.67 kg of CO2, so we'll use that as a conversion factor to CO2 (44 units CO2/12 units C)
+
+#According to skog.no the breakdown of biomass in trees is 50% in the wood (sawwood + pulp), 25% in the branches and tops, and 25% in the roots and stump https://skog.no/wp-content/uploads/2016/05/Trevirke-som-fornybart-r%C3%A5stoff.pdf
+#Thus we will adjust the amount of carbon stored up by a factor of (25% + 50%)/50% = 1.5
+def wood_to_carbon(wood_volume):
+    wood_density = 450 #kg/m3
+    carbon_fraction = 0.5 #How much of the wood is carbon
+    CO2_conversion_factor = 3.67 #kg CO2/kg C
+    wood_to_above_ground_factor = 1.5 #Adjustment factor for the amount of carbon stored in the stand
+
+    carbon_stored = wood_volume * wood_density * carbon_fraction * CO2_conversion_factor * wood_to_above_ground_factor
+
+    return carbon_stored
+
+#The maturity results for each of several yield requirements as plain records, one list of stands per requirement.
+#stands is what run returns when given the same yield_requirements. Missing values become None so the records are valid JSON
+def maturity_sweep_records(stands, yield_requirements):
+    sweep = []
+    for requirement in yield_requirements:
+        columns = {'bestand_id': stands['bestand_id']}
+        for column in MATURITY_COLUMNS:
+            columns[column] = stands[maturity_column(column, requirement)]
+        sweep.append({'yield_requirement': float(requirement), 'stands': columns_to_records(columns)})
+    return sweep
+
+#The best thinning scenario of each stand as plain records, from what run returns when given thinning_scenarios
+def thinning_records(stands):
+    return columns_to_records({name: stands[name] for name in ('bestand_id', *THINNING_COLUMNS)})
+
+#The columns of the stands the model starts out from: bestand_id and treslag as they are given, the other INPUT_COLUMNS as floats
+#(np.nan where they are missing), and the starting height, density, base area and Ht40 of each stand
+def load_data(columns, forestID):
+    log(forestID, "Bio_growth: Loading data!")
+    n_stands = len(columns['bestand_id'])
+    missing = np.full(n_stands, None, dtype=object)
+    stands = {'bestand_id': np.asarray(columns['bestand_id'])}
+    for name in INPUT_COLUMNS:
+        stands[name] = np.asarray(columns.get(name, missing)) if name == 'treslag' else numbers(columns.get(name, missing))
+
+    # Add height in meters. Getting that from the SR16 data, which provides height in decimeters
+    stands['height'] = stands['srhoydeo'] / 10
+    # We use the SR16V values for starting density
+    stands['N_per_hectare'] = stands['srtrean']
+    # Adding 'G1' for grunnlflate. Taking the starting value from SR16V
+    stands['G1'] = stands['srgrflate']
+
+    # Look up Ht40 in the H40 bonitet tables for Gran and Furu, which growth_engine loads once per container
+    stands['Ht40'] = growth_engine.lookup_Ht40(stands['treslag'], stands['bonitet'])
+
+    return stands
+
+#The default number of stands run_chunks runs at a time. The memory the model needs grows with the number of stands in a chunk,
+#most of all when the trajectories are kept (five stands x years matrices), which for 5000 stands is about 20 MB
+CHUNK_SIZE = 5000
+
+#Runs the model chunk_size stands at a time, yielding (start, stop, stands) for each chunk as soon as it is done, stands being
+#what run returns for the stands start to stop. As every stand is computed on its own, the results are the same as running all stands at once,
+#but the memory needed depends on chunk_size rather than the size of the forest. The other arguments are the same as for run.
+#trajectories are filled chunk by chunk. metrics, if given, gets the stages of all chunks merged (see StageMetrics.merge),
+#and is finished once the last chunk is done, so it records (and emits) one line per stage and one total for the forest
+def run_chunks(columns, chunk_size=CHUNK_SIZE, yield_requirement=0.03, forestID=None, trajectories=None, metrics=None, **kwargs):
+    n_stands = len(columns['bestand_id'])
+    for start in range(0, n_stands, chunk_size):
+        stop = min(start + chunk_size, n_stands)
+        log(forestID, f"Bio_growth: Running stands {start} to {stop} of {n_stands}")
+        chunk = {name: values[start:stop] for name, values in columns.items()}
+        chunk_trajectories = None if trajectories is None else {quantity: trajectory[start:stop] for quantity, trajectory in trajectories.items()}
+        chunk_metrics = StageMetrics(forestID)
+        stands = run(chunk, yield_requirement, forestID=forestID, trajectories=chunk_trajectories, metrics=chunk_metrics, **kwargs)
+        if metrics is not None:
+            metrics.merge(chunk_metrics)
+        yield start, stop, stands
+    if metrics is not None:
+        metrics.finish(n_stands)
+
+#Runs the model for the stands in columns, a dict with bestand_id and the INPUT_COLUMNS. Returns a dict with the input columns and all the
+#model results, in the order of the columns of Bio_growth.main.
+#yield_requirement can be a single value or a list of them. With a list, the stands are simulated once for all of them,
+#the standard columns are filled for the first one and maturity_column columns are added for each of them
+#trajectories can be a dict from growth_engine.allocate_trajectories(n_stands) to also get the yearly values of every stand
+#direct_gran_heights evaluates the gran heights without yearly chaining, see growth_engine.height_trajectory
+#horizon is the number of years we look ahead for the maturity year. Stands stop being simulated once they have matured
+#trajectory_cache can be a trajectory_cache.TrajectoryCache, stands already in it are then not simulated again (it is not used with trajectories)
+#metrics can be a StageMetrics to record the time and memory of each stage
+#With chunk_size the stands are run chunk_size at a time by run_chunks, and the chunks put together again. The stages of the chunks
+#are then merged in metrics, one record per stage
+#With processes the stands are simulated by that many worker processes, see parallel_simulation (not with trajectories or trajectory_cache)
+#thinning_scenarios (e.g. thinning.DEFAULT_SCENARIOS) adds the THINNING_COLUMNS, the best of the scenarios for each stand at the (first) yield requirement
+#trajectory_writer (a trajectory_export.TrajectoryWriter) is given the trajectories of the stands, which are then kept for the whole horizon
+def run(columns, yield_requirement=0.03, forestID=None, trajectories=None, direct_gran_heights=False, horizon=growth_engine.HORIZON, trajectory_cache=None, metrics=None, chunk_size=None, processes=None, thinning_scenarios=None, trajectory_writer=None):
+    if metrics is None:
+        metrics = StageMetrics(forestID)
+    if chunk_size is not None and len(columns['bestand_id']) > chunk_size:
+        chunks = [stands for start, stop, stands in run_chunks(
+            columns, chunk_size, yield_requirement, forestID=forestID, trajectories=trajectories, metrics=metrics,
+            direct_gran_heights=direct_gran_heights, horizon=horizon, trajectory_cache=trajectory_cache, processes=processes,
+            thinning_scenarios=thinning_scenarios, trajectory_writer=trajectory_writer,
+            )]
+        return {name: np.concatenate([stands[name] for stands in chunks]) for name in chunks[0]}
+    metrics.begin('load_data', len(columns['bestand_id']))
+    stands = load_data(columns, forestID)
+    n_stands = len(stands['bestand_id'])
+
+    log(forestID, "Bio_growth: Data loaded!")
+    metrics.begin('current_year_growth', n_stands)
+    #The growth over the coming year is computed for all stands at once by growth_engine.current_year_growth, with the same
+    #formulas and guards as the row by row functions in Bio_growth: yearly height growth, the yearly change in the number of trees per hectare,
+    #base area growth (G2), and the volume per hectare for the current and the next year
+    growth = growth_engine.current_year_growth({name: stands[name] for name in growth_engine.CURRENT_YEAR_COLUMNS})
+    stands['yearly_height_growth'] = growth['yearly_height_growth']
+    stands['delta_N_per_hectare'] = growth['delta_N_per_hectare']
+    stands['G2'] = growth['G2']
+    #If the calculated volume_per_hectare is NaN, then we use the value for volume with bark from SR16V (srvolmb) if it exists
+    stands['volume_per_hectare'] = np.where(np.isnan(growth['volume_per_hectare']), stands['srvolmb'], growth['volume_per_hectare'])
+    stands['volume_per_hectare_next_year'] = growth['volume_per_hectare_next_year']
+    #Adding volume adjusted for bark
+    stands['volume_per_hectare_without_bark'] = adjustment_factor_bark * stands['volume_per_hectare']
+    #Adding volume growth and volume growth factor
+    arealm2 = stands['arealm2']
+    stands['volume'] = stands['volume_per_hectare'] * arealm2/10000
+    stands['volume_next_year'] = stands['volume_per_hectare_next_year'] * arealm2/10000
+    stands['volume_growth_next_year'] = stands['volume_next_year'] - stands['volume']
+    with np.errstate(all='ignore'):
+        stands['volume_growth_factor'] = (stands['volume_next_year'] / stands['volume']) - 1
+    #Calculate saw wood portion based to the bonitet of the stand
+    stands['saw_wood_portion'] = growth_engine.saw_wood_portion_array(stands['treslag'], stands['bonitet'])
+    #adjusting the standing volume to not include bark
+    stands['volume_without_bark'] = stands['volume'] * adjustment_factor_bark
+
+    #Adding carbon currently stored based on standing volume
+    stands['carbon_stored'] = wood_to_carbon(stands['volume'])
+
+    #Adding carbon captured per year based on yearly growth in volume
+    stands['carbon_captured_next_year'] = wood_to_carbon(stands['volume_growth_next_year'])
+
+    #Adding "yield_requirement" to keep track of the yield requirement used for this calculation
+    #When we get several yield requirements, the standard columns are for the first one
+    yield_requirements = np.atleast_1d(np.asarray(yield_requirement, dtype=float))
+    stands['yield_requirement'] = np.full(n_stands, yield_requirements[0])
+
+    #Now we move on to calculating the future values
+    #Heights, N per hectare, base area and volume are advanced together in one pass over the years by growth_engine.simulate_stands,
+    #which also finds the year each stand matures as it goes, so the 100 year matrices are never built
+    log(forestID, "Bio_growth: Calculating future values!")
+    metrics.begin('simulate_stands', np.count_nonzero((stands['treslag'] == 'Gran') | (stands['treslag'] == 'Furu')))
+    if trajectory_writer is not None and trajectories is None:
+        trajectories = growth_engine.allocate_trajectories(n_stands, horizon)
+    if trajectory_cache is not None and trajectories is None:
+        hits = trajectory_cache.hits
+        maturity = trajectory_cache.simulate_stands(stands, yield_requirements, horizon=horizon, direct_gran=direct_gran_heights)
+        log(forestID, f"Bio_growth: {trajectory_cache.hits - hits} of {n_stands} stands found in the trajectory cache")
+    elif processes is not None and trajectories is None:
+        #Only imported here, as the model lambda doesn't run it
+        import parallel_simulation
+        maturity = parallel_simulation.simulate_stands(stands, yield_requirements, horizon=horizon, direct_gran=direct_gran_heights, processes=processes)
+    else:
+        maturity = growth_engine.simulate_stands(stands, yield_requirements, horizon=horizon, trajectories=trajectories, direct_gran=direct_gran_heights)
+    log(forestID, "Bio_growth: Calculating years to maturity and volume at maturity!")
+    metrics.begin('maturity', n_stands)
+    stands['years_to_maturity'] = maturity['years_to_maturity'][:, 0]
+    stands['volume_at_maturity'] = maturity['volume_per_hectare_at_maturity'][:, 0] * arealm2 / 10000
+    #And adding volume at maturity without bark
+    stands['volume_at_maturity_without_bark'] = adjustment_factor_bark * stands['volume_at_maturity']
+
+    #With several yield requirements we add the maturity columns for each of them as well, e.g. years_to_maturity_0.02
+    if np.ndim(yield_requirement) > 0:
+        for i, requirement in enumerate(yield_requirements):
+            stands[maturity_column('years_to_maturity', requirement)] = maturity['years_to_maturity'][:, i]
+            stands[maturity_column('volume_at_maturity', requirement)] = maturity['volume_per_hectare_at_maturity'][:, i] * arealm2 / 10000
+            stands[maturity_column('volume_at_maturity_without_bark', requirement)] = adjustment_factor_bark * stands[maturity_column('volume_at_maturity', requirement)]
+
+    if trajectory_writer is not None:
+        trajectory_writer.write(stands, trajectories)
+
+    if thinning_scenarios is not None:
+        log(forestID, f"Bio_growth: Evaluating {len(thinning_scenarios)} thinning scenarios!")
+        metrics.begin('thinning', n_stands)
+        best = thinning.best_thinning(stands, yield_requirements[0], scenarios=thinning_scenarios, horizon=horizon)
+        stands['thinning_year'] = best['thinning_year']
+        stands['thinning_share'] = best['thinning_share']
+        stands['thinning_volume'] = best['thinned_volume_per_hectare'] * arealm2 / 10000
+        stands['years_to_maturity_with_thinning'] = best['years_to_maturity']
+        stands['volume_at_maturity_with_thinning'] = best['volume_per_hectare_at_maturity'] * arealm2 / 10000
+
+    metrics.finish(n_stands)
+    log(forestID, "Bio_growth: Done calculating future values! Returning the dataframe!")
+    return stands
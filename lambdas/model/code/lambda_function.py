@@ -1,13 +1,55 @@
 import json
 import requests
 import os
-import pandas as pd
-import Bio_growth
+import airtable_io
+import growth_model
+import ensemble
+import model_jobs
+import thinning
+import trajectory_cache
+import trajectory_export
 import numpy as np
 
 # Airtable configuration
 AIRTABLE_PERSONAL_ACCESS_TOKEN = os.getenv('AIRTABLE_PERSONAL_ACCESS_TOKEN')
 AIRTABLE_BASE_ID = os.getenv('AIRTABLE_BASE_ID')
+# Kept for the life of the container, so warm invocations reuse its connections (see airtable_io)
+airtable = airtable_io.AirtableClient(AIRTABLE_PERSONAL_ACCESS_TOKEN, AIRTABLE_BASE_ID)
+
+# Missing values are written back to Airtable as this, and fingerprinted as this so the stands written with them don't look changed next time
+WRITTEN_MISSING_VALUE = 0
+
+# The field where we keep the fingerprint of the inputs each stand was last computed from (see growth_model.input_fingerprints)
+FINGERPRINT_FIELD = 'model_fingerprint'
+
+# Stands simulated by earlier invocations in this container are kept in the trajectory cache, so repeat runs skip the simulation
+# If TRAJECTORY_CACHE_BUCKET is set, the cache is also stored in that S3 bucket and shared between containers
+TRAJECTORY_CACHE_BUCKET = os.getenv('TRAJECTORY_CACHE_BUCKET')
+# The cache only pays off for forests whose stands are mostly in it already, a run that finds nothing in it takes about twice as long.
+# So it is only used for forests of up to MODEL_TRAJECTORY_CACHE_MAX_STANDS stands, and not at all unless that is set.
+# Keep it well below trajectory_cache.MAX_ENTRIES, or a forest pushes its own stands out of the cache before they are read again
+MODEL_TRAJECTORY_CACHE_MAX_STANDS = int(os.getenv('MODEL_TRAJECTORY_CACHE_MAX_STANDS', 0))
+stand_trajectory_cache = trajectory_cache.TrajectoryCache(
+    store=trajectory_cache.S3TrajectoryStore(TRAJECTORY_CACHE_BUCKET) if TRAJECTORY_CACHE_BUCKET else None
+)
+
+# The bucket the yearly trajectories of the stands are exported to, under trajectory_export.TRAJECTORY_EXPORT_PREFIX
+TRAJECTORY_EXPORT_BUCKET = os.getenv('TRAJECTORY_EXPORT_BUCKET', 'skogapp-lambda-generated-outputs')
+
+# The number of stands the model runs and writes back at a time
+MODEL_CHUNK_SIZE = int(os.getenv('MODEL_CHUNK_SIZE', growth_model.CHUNK_SIZE))
+
+# The number of stands whose results are queued for writing back at a time. Most forests are smaller than MODEL_CHUNK_SIZE,
+# so this is what lets the upload start while the rest of the forest is computed. Running the model in these smaller chunks costs
+# a fraction of a second on the largest forests, against minutes of upload at Airtable's rate limit
+MODEL_WRITE_CHUNK_SIZE = int(os.getenv('MODEL_WRITE_CHUNK_SIZE', 500))
+
+# Requests with "async": true are run as jobs from this queue (see model_jobs), their status and results go to MODEL_JOB_BUCKET
+MODEL_JOB_QUEUE_URL = os.getenv('MODEL_JOB_QUEUE_URL')
+MODEL_JOB_BUCKET = os.getenv('MODEL_JOB_BUCKET', 'skogapp-lambda-generated-outputs')
+# A job is stopped and marked as failed once less than this is left before the lambda times out. That leaves time to write the batches
+# already queued for Airtable (at most airtable_io.MAX_QUEUED_BATCHES, about 40 seconds at Airtable's rate limit) and the status
+MODEL_JOB_STOP_MILLIS = int(os.getenv('MODEL_JOB_STOP_MILLIS', 90000))
 
 def log(forestID, message):
     if forestID:
@@ -16,7 +58,11 @@ def log(forestID, message):
         forestID = "unknown"
         print(f"forestID: {forestID} - {message}")
         
-def model(event):
+# Runs the model for the request in event['body']. progress, if given, is called with the stage the model is at
+# and how far it has come, e.g. progress('model', stands_done=5000, stands=20000) (see model_jobs.JobStatus.progress)
+def model(event, progress=None):
+    if progress is None:
+        progress = lambda stage, **details: None
     print("Running the model...")
     data = json.loads(event['body'])
     if not data:
@@ -26,8 +72,41 @@ def model(event):
             'body': json.dumps({'error': 'Missing body'})
         }
         return add_cors_headers(response)
-    yield_requirement = float(data.get('yield_requirement', 0.03) ) # Default to 0.03 if 'yield_requirement' is not provided
+    # Optional list of yield requirements to compare, e.g. [0.02, 0.03, 0.04]. The model is run once for all of them
+    yield_requirements = data.get('yield_requirements', [])
+    if not isinstance(yield_requirements, list):
+        response = {
+            'statusCode': 400,
+            'body': json.dumps({'error': 'yield_requirements must be a list'})
+        }
+        return add_cors_headers(response)
+    try:
+        yield_requirement = parse_yield_requirement(data.get('yield_requirement', 0.03)) # Default to 0.03 if 'yield_requirement' is not provided
+        yield_requirements = [parse_yield_requirement(requirement) for requirement in yield_requirements]
+    except ValueError as e:
+        response = {
+            'statusCode': 400,
+            'body': json.dumps({'error': str(e)})
+        }
+        return add_cors_headers(response)
+    # The results written to Airtable are for yield_requirement, or for the first of yield_requirements if that is not provided
+    if yield_requirements and 'yield_requirement' not in data:
+        yield_requirement = yield_requirements[0]
+    if yield_requirements:
+        yield_requirements = unique_yield_requirements([yield_requirement] + yield_requirements)
     
+    # With thinning the best thinning scenario of each stand is also returned (see thinning.best_thinning)
+    with_thinning = bool(data.get('thinning', False))
+
+    # With ensemble_samples, e.g. 100, percentile bands of volume, carbon_stored and years_to_maturity are also returned (see ensemble.ensemble_bands)
+    ensemble_samples = int(data.get('ensemble_samples', 0))
+
+    # With export_trajectories the yearly trajectories of all stands are written to S3 as one Parquet file (see trajectory_export)
+    export_trajectories = bool(data.get('export_trajectories', False))
+
+    # By default only the stands whose inputs or yield requirement changed since the last run are computed and written back
+    recompute_all = bool(data.get('recompute_all', False))
+
     forestID = data.get('forestID')
     # if forestID is not found, the function will not proceed
     if not forestID:
@@ -37,33 +116,176 @@ def model(event):
         }
         return add_cors_headers(airtableResponse)
     log(forestID, f"Received body: {data}")
+
+    # With "async": true the request is queued as a job and the job id returned, see model_jobs
+    if data.get('async'):
+        return submit_job(forestID, data)
+
     # Airtable configuration
     TABLE_NAME = f'{forestID}_bestandsdata'
-    AIRTABLE_API_URL = f'https://api.airtable.com/v0/{AIRTABLE_BASE_ID}/{TABLE_NAME}'
+    progress('fetch')
     
-    # Fetch data from Airtable
+    # Airtable rejects requests for fields that are not in the table, so we only ask for the fingerprint once we know it is there
+    table_schema = fetch_table_schema(forestID, TABLE_NAME)
+    has_fingerprint_field = ensure_fingerprint_field(forestID, table_schema)
+    model_fields = ('bestand_id', *growth_model.INPUT_COLUMNS) + ((FINGERPRINT_FIELD,) if has_fingerprint_field else ())
+    # With the schema we also fetch the results of the last run (with the yield_requirement they were computed for),
+    # so only the values that change are written back (see records_to_write)
+    precisions = None
+    if table_schema is not None:
+        precisions = field_precisions(table_schema)
+        table_fields = {field['name'] for field in table_schema['fields']}
+        model_fields += tuple(name for name in growth_model.RESULT_COLUMNS if name in table_fields and name not in model_fields)
+
+    # Fetch the fields the model uses and the record ids of the stands from Airtable, in one pass over the table
     log(forestID, f"Fetching data from Airtable for Table name: {TABLE_NAME}")
-    airtable_data = fetch_airtable_data(AIRTABLE_API_URL)
-    df_airtable = pd.DataFrame(airtable_data)
-    log(forestID, f"Fetched {len(df_airtable)} records from Airtable.")
+    airtable_data, existing_records = fetch_airtable_records(TABLE_NAME, model_fields)
+    existing_fields = {fields['bestand_id']: fields for fields in airtable_data if fields.get('bestand_id')} if precisions is not None else None
+    # The model works on columns of NumPy arrays (see growth_model), so the records are turned into columns without going through pandas
+    airtable_columns = growth_model.records_to_columns(airtable_data, ('bestand_id', *growth_model.INPUT_COLUMNS, FINGERPRINT_FIELD, 'yield_requirement'))
+    log(forestID, f"Fetched {len(airtable_data)} records from Airtable.")
 
-    # Process the DataFrame using Bio_growth.main
-    log(forestID, f"Running Bio_growth model with yield requirement: {yield_requirement}")
-    df_bestander = Bio_growth.main(df=df_airtable, yield_requirement=yield_requirement, forestID=forestID)
+    # Find the stands that need to be computed. Without the fingerprint field we can't tell, so then all of them are
+    fingerprints = growth_model.input_fingerprints(airtable_columns, missing_value=WRITTEN_MISSING_VALUE)
+    if has_fingerprint_field and not recompute_all:
+        changed = stands_to_recompute(airtable_columns, fingerprints, yield_requirement)
+    else:
+        changed = np.ones(len(airtable_data), dtype=bool)
+    log(forestID, f"{int(changed.sum())} of {len(airtable_data)} stands have changed since they were last computed.")
+    if not changed.any() and not yield_requirements and not with_thinning and not ensemble_samples and not export_trajectories:
+        log(forestID, "Nothing to update.")
+        response = {
+            'statusCode': 200,
+            'body': json.dumps({'message': 'Data update completed', 'stands_updated': 0})
+        }
+        return add_cors_headers(response)
+    # The uncertainty bands are for all stands, and computed separately from the results that are written back
+    all_stands = airtable_columns
+    # The maturity sweep, thinning scenarios and trajectories are for all stands, so then all of them are computed, but only the changed ones are written back
+    if not yield_requirements and not with_thinning and not export_trajectories:
+        airtable_columns = growth_model.select_stands(airtable_columns, changed)
+        fingerprints = fingerprints[changed]
+        changed = changed[changed]
+
+    # Run the model
+    n_stands = len(airtable_columns['bestand_id'])
+    use_trajectory_cache = n_stands <= MODEL_TRAJECTORY_CACHE_MAX_STANDS
+    # The model still runs if the stored trajectory cache can't be read, it just starts out empty
+    if use_trajectory_cache:
+        try:
+            stand_trajectory_cache.load()
+        except Exception as e:
+            log(forestID, f"Could not load the trajectory cache: {e}")
+
+    log(forestID, f"Running Bio_growth model with yield requirement: {yield_requirements or yield_requirement}")
+    progress('model', stands_done=0, stands=n_stands)
+    # The stands are run and written back MODEL_WRITE_CHUNK_SIZE (at most MODEL_CHUNK_SIZE) at a time, so the memory needed doesn't grow with the size of the forest.
+    # The time and memory of each stage of the model, summed over the chunks, and the total for the forest go to the log as JSON metric lines
+    metrics = growth_model.StageMetrics(forestID, emit=True)
+    maturity_sweep = [{'yield_requirement': requirement, 'stands': []} for requirement in yield_requirements] if yield_requirements else None
+    best_thinning = [] if with_thinning else None
+    trajectory_writer = trajectory_export.TrajectoryWriter() if export_trajectories else None
+    # The results of each chunk are queued for writing as soon as they are computed, and written by the threads of the writer
+    # while the next chunks are computed, with updates and creates taking turns under the rate limit (see airtable_io.PipelinedWriter)
+    bestand_ids = {record_id: bestand_id for bestand_id, record_id in existing_records.items()}
+    writer = airtable_io.PipelinedWriter(
+        airtable, TABLE_NAME, on_result=lambda method, batch, response: log_written_batch(forestID, method, batch, response, bestand_ids),
+        )
+    try:
+        for start, stop, stands in growth_model.run_chunks(airtable_columns, min(MODEL_CHUNK_SIZE, MODEL_WRITE_CHUNK_SIZE), yield_requirement=yield_requirements or yield_requirement, forestID=forestID, metrics=metrics, trajectory_cache=stand_trajectory_cache if use_trajectory_cache else None, thinning_scenarios=thinning.DEFAULT_SCENARIOS if with_thinning else None, trajectory_writer=trajectory_writer):
+            # The results for every requirement go back in the response, only the columns of the table are written to Airtable
+            if yield_requirements:
+                for sweep, chunk_sweep in zip(maturity_sweep, growth_model.maturity_sweep_records(stands, yield_requirements)):
+                    sweep['stands'].extend(chunk_sweep['stands'])
+                for requirement in yield_requirements:
+                    for column in growth_model.MATURITY_COLUMNS:
+                        del stands[growth_model.maturity_column(column, requirement)]
+            if with_thinning:
+                best_thinning.extend(growth_model.thinning_records(stands))
+                for column in growth_model.THINNING_COLUMNS:
+                    del stands[column]
+
+            chunk_changed = changed[start:stop]
+            stands = growth_model.select_stands(stands, chunk_changed)
+            if has_fingerprint_field:
+                stands[FINGERPRINT_FIELD] = fingerprints[start:stop][chunk_changed]
+
+            # Convert the columns to records we can send as JSON, replacing missing values with 0
+            result = growth_model.columns_to_records(stands, missing_value=WRITTEN_MISSING_VALUE)
+            writer.write(*records_to_write(forestID, result, existing_records, existing_fields, precisions))
+            if writer.failure is not None:
+                break
+            progress('model', stands_done=stop, stands=n_stands, stands_updated=writer.written)
+    finally:
+        # Waits for the queued batches to be written
+        writer.close()
+    if writer.failure is not None:
+        return failed_write_response(forestID, writer.failure)
+    stands_updated = writer.written
     log(forestID, f"Bio_growth model completed.")
 
-    # Replace missing values with 0
-    df_bestander.fillna(0, inplace=True)
+    if use_trajectory_cache:
+        try:
+            stand_trajectory_cache.save()
+        except Exception as e:
+            log(forestID, f"Could not save the trajectory cache: {e}")
+
+    # The model results are already written back, so if the upload fails we log it and leave the trajectories out of the response
+    trajectories = None
+    if trajectory_writer is not None:
+        progress('export_trajectories')
+        try:
+            key = trajectory_export.upload(trajectory_writer, TRAJECTORY_EXPORT_BUCKET, forestID, yield_requirement)
+            trajectories = {'bucket': TRAJECTORY_EXPORT_BUCKET, 'key': key}
+            log(forestID, f"Exported the trajectories of {trajectory_writer.n_stands} stands to {key}")
+        except Exception as e:
+            log(forestID, f"Could not export the trajectories: {e}")
+
+    uncertainty = None
+    if ensemble_samples:
+        log(forestID, f"Running {ensemble_samples} samples of every stand for the uncertainty bands")
+        progress('uncertainty', samples=ensemble_samples)
+        uncertainty = growth_model.columns_to_records(ensemble.ensemble_bands(all_stands, ensemble_samples, yield_requirement, forestID=forestID))
+
+    log(forestID, "Data update completed.")
+    body = {'message': 'Data update completed', 'stands_updated': stands_updated}
+    if maturity_sweep is not None:
+        body['maturity_sweep'] = maturity_sweep
+    if best_thinning is not None:
+        body['thinning'] = best_thinning
+    if uncertainty is not None:
+        body['uncertainty'] = uncertainty
+    if trajectories is not None:
+        body['trajectories'] = trajectories
+    response = {
+        'statusCode': 200,
+        'body': json.dumps(body)
+    }
+    return add_cors_headers(response)
 
-    # Convert DataFrame to a dictionary or JSON serializable format
-    result = df_bestander.to_dict(orient='records')
+# A yield requirement from the request as a float. Yield requirements are yearly growth rates, so anything that is not a number
+# between 0 and 1 raises ValueError
+def parse_yield_requirement(value):
+    try:
+        requirement = float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"Yield requirements must be numbers, got {value!r}")
+    if not 0 < requirement < 1:
+        raise ValueError(f"Yield requirements must be between 0 and 1, got {value!r}")
+    return requirement
 
-    # Get existing records from Airtable
-    log(forestID, f"Fetching existing records from Airtable for Table name: {TABLE_NAME}")
-    existing_records = get_existing_records(AIRTABLE_API_URL)
-    log(forestID, f"Fetched {len(existing_records)} existing records from Airtable.")
+# The yield requirements without repeats, in the order they are given. Requirements with the same maturity columns
+# (see growth_model.maturity_column) count as repeats
+def unique_yield_requirements(yield_requirements):
+    unique = {}
+    for requirement in yield_requirements:
+        unique.setdefault(growth_model.maturity_column('years_to_maturity', requirement), requirement)
+    return list(unique.values())
 
-    # Prepare batches of records to be sent
+# The records to write to Airtable: updates for the stands that are in existing_records and creates for the others.
+# With existing_fields (the fields Airtable has for each bestand_id) updates only hold the fields whose value changes at the precision of the field
+# (precisions, see field_precisions), and stands where nothing changes are left out
+def records_to_write(forestID, result, existing_records, existing_fields=None, precisions=None):
     records_to_update = []
     records_to_create = []
     unique_updates = {}
@@ -76,115 +298,185 @@ def model(event):
 
     # Ensure unique updates only
     records_to_update = list(unique_updates.values())
+    if existing_fields is not None:
+        records_to_update = []
+        for bestand_id, update in unique_updates.items():
+            fields = changed_fields(update['fields'], existing_fields.get(bestand_id, {}), precisions)
+            if fields:
+                records_to_update.append({'id': update['id'], 'fields': fields})
+        log(forestID, f"{len(unique_updates) - len(records_to_update)} of {len(unique_updates)} records are unchanged and not sent.")
+    return records_to_update, records_to_create
 
-    batch_size = 10
-    log(forestID, f"Updating records in batches...")
-    for i in range(0, len(records_to_update), batch_size):
-        batch = records_to_update[i:i + batch_size]
-        airtableResponse = batch_update_airtable_records(batch, AIRTABLE_API_URL)
-        if airtableResponse.status_code in [200, 201]:
-            updated_ids = [record['fields']['bestand_id'] for record in batch]
-            log(forestID, f"Updated batch of {len(batch)} records: {updated_ids}")
-        else:
-            log(forestID, f"Failed batch update")
-            response = {
-                'statusCode': airtableResponse.status_code,
-                'body': json.dumps({'error': 'Failed to update records to Airtable', 'details': airtableResponse.json()})
-            }
-            return add_cors_headers(response)
-
-    log(forestID, f"Creating records in batches...")
-    for i in range(0, len(records_to_create), batch_size):
-        batch = records_to_create[i:i + batch_size]
-        airtableResponse = batch_create_airtable_records(batch, AIRTABLE_API_URL)
-        if airtableResponse.status_code in [200, 201]:
-            created_ids = [record['fields']['bestand_id'] for record in batch]
-            log(forestID, f"Created batch of {len(batch)} records: {created_ids}")
-        else:
-            log(forestID, f"Failed batch create")
-            response = {
-                'statusCode': airtableResponse.status_code,
-                'body': json.dumps({'error': 'Failed to create records to Airtable', 'details': airtableResponse.json()})
-            }
-            return add_cors_headers(response)
+# Logs a batch written by the airtable_io.PipelinedWriter. bestand_ids maps the record ids of the updated stands to their bestand_id
+def log_written_batch(forestID, method, batch, response, bestand_ids):
+    if not response.ok:
+        return
+    if method == 'PATCH':
+        log(forestID, f"Updated batch of {len(batch)} records: {[bestand_ids[record['id']] for record in batch]}")
+    else:
+        log(forestID, f"Created batch of {len(batch)} records: {[record['fields']['bestand_id'] for record in batch]}")
 
-    log(forestID, "Data update completed.")
+# The response to give when the airtable_io.PipelinedWriter failed, failure being its (method, batch, response or exception)
+def failed_write_response(forestID, failure):
+    method, batch, airtableResponse = failure
+    action = 'update' if method == 'PATCH' else 'create'
+    log(forestID, f"Failed batch {action}")
+    if isinstance(airtableResponse, Exception):
+        statusCode, details = 502, str(airtableResponse)
+    else:
+        statusCode, details = airtableResponse.status_code, airtableResponse.json()
     response = {
-        'statusCode': 200,
-        'body': json.dumps({'message': 'Data update completed'})
+        'statusCode': statusCode,
+        'body': json.dumps({'error': f'Failed to {action} records to Airtable', 'details': details})
     }
     return add_cors_headers(response)
 
-def fetch_airtable_data(airtableURL):
-    headers = {
-        'Authorization': f'Bearer {AIRTABLE_PERSONAL_ACCESS_TOKEN}',
-    }
-    params = {
-        'pageSize': 100
-    }
+# The precision of every field of the table that has one (number, currency, percent...), from its schema
+def field_precisions(table):
+    return {field['name']: field['options']['precision'] for field in table['fields'] if 'precision' in (field.get('options') or {})}
+
+# The fields of record whose value differs from the one in existing (the fields Airtable has for the stand).
+# Numbers are compared rounded to the precision of their field, as that is what Airtable keeps. Airtable leaves empty fields out,
+# so a missing field counts as None, and None and '' count as the same
+def changed_fields(record, existing, precisions):
+    changed = {}
+    for name, value in record.items():
+        old = existing.get(name)
+        if value in (None, '') and old in (None, ''):
+            continue
+        precision = precisions.get(name)
+        if precision is not None and isinstance(value, (int, float)) and isinstance(old, (int, float)):
+            if round(value, precision) == round(old, precision):
+                continue
+        elif value == old:
+            continue
+        changed[name] = value
+    return changed
+
+# The schema of the table (its id and fields) from the Airtable metadata API, or None if the table isn't in it or the schema can't be read
+# (e.g. if the token doesn't have the schema.bases:read scope)
+def fetch_table_schema(forestID, table_name):
+    try:
+        table = next((table for table in airtable.tables() if table['name'] == table_name), None)
+    except requests.RequestException as e:
+        log(forestID, f"Could not read the schema of {table_name}: {e}")
+        return None
+    if table is None:
+        log(forestID, f"Table {table_name} not found in the base schema")
+    return table
+
+# Makes sure the table (its schema from fetch_table_schema) has the FINGERPRINT_FIELD, creating it through the Airtable metadata API if it is missing.
+# Returns False if the field isn't there and can't be created (e.g. if the token can't change the schema)
+def ensure_fingerprint_field(forestID, table):
+    if table is None:
+        return False
+    if any(field['name'] == FINGERPRINT_FIELD for field in table['fields']):
+        return True
+    log(forestID, f"Creating the {FINGERPRINT_FIELD} field in {table['name']}")
+    try:
+        table['fields'].append(airtable.create_field(table['id'], {'name': FINGERPRINT_FIELD, 'type': 'singleLineText'}))
+        return True
+    except requests.RequestException as e:
+        log(forestID, f"Could not create the {FINGERPRINT_FIELD} field: {e}")
+        return False
+
+# The stands whose input fingerprint differs from the one stored with their results, or that were computed with another yield requirement
+def stands_to_recompute(airtable_columns, fingerprints, yield_requirement):
+    stored_fingerprints = airtable_columns[FINGERPRINT_FIELD]
+    stored_yield_requirement = growth_model.numbers(airtable_columns['yield_requirement'])
+    # yield_requirement is stored with 3 decimals in Airtable
+    with np.errstate(invalid='ignore'):
+        same_yield_requirement = np.abs(stored_yield_requirement - yield_requirement) < 0.0005
+    return (stored_fingerprints != fingerprints) | ~same_yield_requirement
+
+# Pages through the table once and returns the fields of every record, and the record id of every bestand_id.
+# Only the given fields are fetched (with Airtable's fields[] projection), so the pages don't carry the results of earlier runs
+def fetch_airtable_records(table_name, field_names):
     all_records = []
-    while True:
-        response = requests.get(airtableURL, headers=headers, params=params)
-        response.raise_for_status()
-        data = response.json()
-        records = data['records']
-        all_records.extend(record['fields'] for record in records)
-        if 'offset' in data:
-            params['offset'] = data['offset']
-        else:
-            break
-    return all_records
+    existing_records = {}
+    for record in airtable.list_records(table_name, field_names):
+        fields = record.get('fields', {})
+        all_records.append(fields)
+        bestand_id = fields.get('bestand_id')
+        if bestand_id:
+            existing_records[bestand_id] = record['id']
+    return all_records, existing_records
 
-def get_existing_records(airtableURL):
-    headers = {
-        'Authorization': f'Bearer {AIRTABLE_PERSONAL_ACCESS_TOKEN}',
-    }
-    params = {
-        'pageSize': 100
+# Queues the request as a job and returns its id, with 202 Accepted
+def submit_job(forestID, data):
+    if not MODEL_JOB_QUEUE_URL:
+        response = {
+            'statusCode': 501,
+            'body': json.dumps({'error': 'Jobs are not enabled, MODEL_JOB_QUEUE_URL is not set'})
+        }
+        return add_cors_headers(response)
+    body = {key: value for key, value in data.items() if key != 'async'}
+    job_id = model_jobs.submit(MODEL_JOB_QUEUE_URL, MODEL_JOB_BUCKET, body, forestID)
+    log(forestID, f"Queued model job {job_id}")
+    response = {
+        'statusCode': 202,
+        'body': json.dumps({'job_id': job_id, 'status': f'/model/jobs/{job_id}'})
     }
-    records = {}
-    while True:
-        response = requests.get(airtableURL, headers=headers, params=params)
-        response.raise_for_status()
-        data = response.json()
-        for record in data['records']:
-            fields = record.get('fields', {})
-            bestand_id = fields.get('bestand_id')
-            if bestand_id:
-                records[bestand_id] = record['id']
-        if 'offset' in data:
-            params['offset'] = data['offset']
-        else:
-            break
-    return records
+    return add_cors_headers(response)
 
-def batch_update_airtable_records(records, airtableURL):
-    headers = {
-        'Authorization': f'Bearer {AIRTABLE_PERSONAL_ACCESS_TOKEN}',
-        'Content-Type': 'application/json'
+# GET /model/jobs/{job_id}: the status of a job
+def job_status(event):
+    job_id = (event.get('pathParameters') or {}).get('job_id')
+    status = model_jobs.read_status(MODEL_JOB_BUCKET, job_id)
+    if status is None:
+        response = {
+            'statusCode': 404,
+            'body': json.dumps({'error': 'Job not found'})
+        }
+        return add_cors_headers(response)
+    response = {
+        'statusCode': 200,
+        'body': json.dumps(status)
     }
-    data = {'records': records}
-    response = requests.patch(airtableURL, json=data, headers=headers)
-    return response
+    return add_cors_headers(response)
 
-def batch_create_airtable_records(records, airtableURL):
-    headers = {
-        'Authorization': f'Bearer {AIRTABLE_PERSONAL_ACCESS_TOKEN}',
-        'Content-Type': 'application/json'
-    }
-    data = {'records': records}
-    response = requests.post(airtableURL, json=data, headers=headers)
-    return response
+# Runs the jobs in the messages from the model job queue. A job that fails is marked as failed rather than raised,
+# so the message is not delivered again. A job that runs out of time is stopped and marked as failed as well (see MODEL_JOB_STOP_MILLIS).
+# A message that is delivered again means the run before it never got that far, e.g. the lambda was stopped, so that job is marked
+# as failed instead of being run again. Messages that can't even be marked as failed go to the dead-letter queue (see template.yml)
+def run_jobs(event, context=None):
+    remaining_millis = context.get_remaining_time_in_millis if context is not None else None
+    for record in event['Records']:
+        message = json.loads(record['body'])
+        job_id, body = message['job_id'], message['body']
+        forestID = body.get('forestID')
+        status = model_jobs.JobStatus(MODEL_JOB_BUCKET, job_id, forestID, message.get('submitted_at'), remaining_millis=remaining_millis, stop_millis=MODEL_JOB_STOP_MILLIS)
+        receive_count = int(record.get('attributes', {}).get('ApproximateReceiveCount', 1))
+        if receive_count > 1:
+            log(forestID, f"Model job {job_id} was received {receive_count} times, the run before this one did not finish")
+            status.fail('The job did not finish, the model lambda was stopped before it was done')
+            continue
+        log(forestID, f"Running model job {job_id}")
+        try:
+            status.progress('start')
+            response = model({'body': json.dumps(body)}, progress=status.progress)
+        except Exception as e:
+            log(forestID, f"Model job {job_id} failed: {e}")
+            status.fail(str(e))
+            continue
+        if response['statusCode'] == 200:
+            status.succeed(response['body'])
+        else:
+            status.fail(json.loads(response['body']), response['statusCode'])
+        log(forestID, f"Model job {job_id} finished with status {response['statusCode']}")
 
 def add_cors_headers(response):
     response['headers'] = {
         'Access-Control-Allow-Origin': '*',
-        'Access-Control-Allow-Methods': 'OPTIONS,POST',
+        'Access-Control-Allow-Methods': 'OPTIONS,POST,GET',
         'Access-Control-Allow-Headers': 'Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token'
     }
     return response
 
 def lambda_handler(event, context):
+    # Messages from the model job queue
+    if 'Records' in event:
+        return run_jobs(event, context)
     if event['httpMethod'] == 'OPTIONS':
         response = {
             'statusCode': 200,
@@ -193,6 +485,8 @@ def lambda_handler(event, context):
         return add_cors_headers(response)
     elif event['httpMethod'] == 'POST':
         return model(event)
+    elif event['httpMethod'] == 'GET':
+        return job_status(event)
     else:
         response = {
             'statusCode': 405,
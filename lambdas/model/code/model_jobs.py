@@ -0,0 +1,98 @@
+import json
+import time
+import uuid
+
+# Model runs as jobs, for forests too large to run within the 29 seconds API Gateway waits for a response.
+# POST /model with "async": true puts the request on the model job queue and returns a job id straight away. The model lambda
+# then runs the job from the queue, and keeps the status of the job as JSON in the outputs bucket as it goes. GET /model/jobs/{job_id}
+# returns the status: the state (queued, running, succeeded or failed), the stage the model is at and how far it has come,
+# and once the job has succeeded, where the response body of the model is stored
+# boto3 is only imported when it is used, like in trajectory_export
+
+# Where the status and result of a job go in the outputs bucket
+MODEL_JOB_PREFIX = 'SkogAppModelJobs/'
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+
+def new_job_id():
+    return uuid.uuid4().hex
+
+# Job ids are uuid4 hex strings, anything else can't be a job (and can't reach other keys in the bucket)
+def valid_job_id(job_id):
+    return isinstance(job_id, str) and len(job_id) == 32 and all(c in '0123456789abcdef' for c in job_id)
+
+def status_key(job_id):
+    return f"{MODEL_JOB_PREFIX}{job_id}/status.json"
+
+def result_key(job_id):
+    return f"{MODEL_JOB_PREFIX}{job_id}/result.json"
+
+def _s3_client(client):
+    if client is None:
+        import boto3
+        client = boto3.client('s3')
+    return client
+
+# Raised from JobStatus.progress when the lambda is about to time out, to stop the model while there is time to mark the job as failed
+class JobTimeout(Exception):
+    pass
+
+# The status of one job, written to status_key every time it changes.
+# remaining_millis, if given, is called for the time left before the lambda times out (context.get_remaining_time_in_millis),
+# and progress raises JobTimeout once that is less than stop_millis
+class JobStatus:
+    def __init__(self, bucket, job_id, forestID=None, submitted_at=None, client=None, remaining_millis=None, stop_millis=0):
+        self.bucket = bucket
+        self.client = _s3_client(client)
+        self.remaining_millis = remaining_millis
+        self.stop_millis = stop_millis
+        submitted_at = time.time() if submitted_at is None else submitted_at
+        self.status = {'job_id': job_id, 'forestID': forestID, 'state': QUEUED, 'stage': None, 'submitted_at': submitted_at, 'updated_at': None}
+
+    # Sets the given status fields and writes the status
+    def update(self, **fields):
+        self.status.update(fields)
+        self.status['updated_at'] = time.time()
+        self.client.put_object(
+            Bucket=self.bucket, Key=status_key(self.status['job_id']), Body=json.dumps(self.status).encode(), ContentType='application/json',
+        )
+
+    # Records the stage the model is at, e.g. progress('model', stands_done=5000, stands=20000). Used as the progress callback of the model
+    def progress(self, stage, **details):
+        if self.remaining_millis is not None and self.remaining_millis() < self.stop_millis:
+            raise JobTimeout(f"The job was stopped at the {stage} stage, as it would not have finished before the lambda timeout")
+        self.update(state=RUNNING, stage=stage, progress=details)
+
+    # Stores the response body of the model and marks the job as succeeded
+    def succeed(self, body):
+        key = result_key(self.status['job_id'])
+        self.client.put_object(Bucket=self.bucket, Key=key, Body=body.encode(), ContentType='application/json')
+        self.update(state=SUCCEEDED, stage=None, progress=None, result={'bucket': self.bucket, 'key': key})
+
+    def fail(self, error, statusCode=500):
+        self.update(state=FAILED, error=error, statusCode=statusCode)
+
+# Writes the status of a new job and puts the job on the queue as {'job_id', 'submitted_at', 'body'}. Returns the job id
+def submit(queue_url, bucket, body, forestID=None, sqs_client=None, s3_client=None):
+    if sqs_client is None:
+        import boto3
+        sqs_client = boto3.client('sqs')
+    job_id = new_job_id()
+    status = JobStatus(bucket, job_id, forestID, client=s3_client)
+    status.update()
+    sqs_client.send_message(QueueUrl=queue_url, MessageBody=json.dumps({'job_id': job_id, 'submitted_at': status.status['submitted_at'], 'body': body}))
+    return job_id
+
+# The status of a job, or None if there is no job with that id
+def read_status(bucket, job_id, client=None):
+    if not valid_job_id(job_id):
+        return None
+    client = _s3_client(client)
+    try:
+        response = client.get_object(Bucket=bucket, Key=status_key(job_id))
+    except client.exceptions.NoSuchKey:
+        return None
+    return json.loads(response['Body'].read())
@@ -0,0 +1,100 @@
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+import growth_engine
+
+#Runs growth_engine.simulate_stands in a pool of processes, for bulk reruns of many forests on a machine with several cores.
+#The stands are sorted by species and cut into index ranges of one species each, and every range is simulated by a worker process.
+#The inputs and results are kept in shared memory, so only the names of the blocks and the ranges are sent to the workers.
+#AWS Lambda has no /dev/shm, so this is not used by the model lambda
+
+#The numeric SIMULATION_COLUMNS, in the order of the columns of the shared input matrix
+NUMERIC_COLUMNS = tuple(name for name in growth_engine.SIMULATION_COLUMNS if name != 'treslag')
+
+#Ranges smaller than this cost more to send to a worker than they take to simulate
+MIN_PARTITION_SIZE = 2000
+
+#The species codes of the sorted stands
+SPECIES = ('Gran', 'Furu')
+
+#A float matrix in a new shared memory block
+def _shared_array(shape):
+    block = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * 8, 1))
+    return block, np.ndarray(shape, dtype=float, buffer=block.buf)
+
+#Simulates the stands start to stop of the shared inputs, which all are of species, and writes their maturity results to the shared outputs
+def _simulate_range(inputs_name, outputs_name, n_stands, species, start, stop, yield_requirements, horizon, direct_gran):
+    inputs_block = shared_memory.SharedMemory(name=inputs_name)
+    outputs_block = shared_memory.SharedMemory(name=outputs_name)
+    try:
+        inputs = np.ndarray((n_stands, len(NUMERIC_COLUMNS)), dtype=float, buffer=inputs_block.buf)
+        outputs = np.ndarray((2, n_stands, len(yield_requirements)), dtype=float, buffer=outputs_block.buf)
+        columns = {name: inputs[start:stop, i] for i, name in enumerate(NUMERIC_COLUMNS)}
+        columns['treslag'] = np.full(stop - start, species)
+        maturity = growth_engine.simulate_stands(columns, yield_requirements, horizon=horizon, direct_gran=direct_gran)
+        outputs[0, start:stop] = maturity['years_to_maturity']
+        outputs[1, start:stop] = maturity['volume_per_hectare_at_maturity']
+        #The arrays have to go before the blocks can be closed
+        del inputs, outputs, columns
+    finally:
+        inputs_block.close()
+        outputs_block.close()
+
+#The index ranges of the sorted stands, each of them of one species. counts is the number of stands of each species
+def partition_ranges(counts, processes, partition_size=None):
+    if partition_size is None:
+        #A few ranges per process, so a process that gets slow stands doesn't hold up the others
+        partition_size = max(MIN_PARTITION_SIZE, math.ceil(sum(counts) / (processes * 4)))
+    ranges = []
+    start = 0
+    for species, count in zip(SPECIES, counts):
+        for range_start in range(start, start + count, partition_size):
+            ranges.append((species, range_start, min(range_start + partition_size, start + count)))
+        start += count
+    return ranges
+
+#Same as growth_engine.simulate_stands, with the stands simulated by processes worker processes (all cores by default).
+#Every stand is simulated on its own, so the results are the same as simulating all stands in one process.
+#partition_size is the largest number of stands a worker simulates at a time
+def simulate_stands(columns, yield_requirement=0.03, horizon=growth_engine.HORIZON, direct_gran=False, processes=None, partition_size=None):
+    if processes is None:
+        processes = os.cpu_count() or 1
+    yield_requirements = np.atleast_1d(np.asarray(yield_requirement, dtype=float))
+    treslag = np.asarray(columns['treslag'])
+    n_stands = len(treslag)
+    years_to_maturity = np.full((n_stands, len(yield_requirements)), np.nan)
+    volume_per_hectare_at_maturity = np.full((n_stands, len(yield_requirements)), np.nan)
+
+    #The gran stands followed by the furu stands, each in the order they are in columns
+    species_idx = [np.flatnonzero(treslag == species) for species in SPECIES]
+    order = np.concatenate(species_idx)
+    if len(order) > 0:
+        inputs_block, inputs = _shared_array((len(order), len(NUMERIC_COLUMNS)))
+        outputs_block, outputs = _shared_array((2, len(order), len(yield_requirements)))
+        try:
+            for i, name in enumerate(NUMERIC_COLUMNS):
+                inputs[:, i] = np.asarray(columns[name], dtype=float)[order]
+            outputs[:] = np.nan
+            ranges = partition_ranges([len(idx) for idx in species_idx], processes, partition_size)
+            with ProcessPoolExecutor(max_workers=min(processes, len(ranges))) as pool:
+                futures = [
+                    pool.submit(_simulate_range, inputs_block.name, outputs_block.name, len(order), species, start, stop, yield_requirements, horizon, direct_gran)
+                    for species, start, stop in ranges
+                ]
+                for future in futures:
+                    future.result()
+            #Back in the order of the stands in columns
+            years_to_maturity[order] = outputs[0]
+            volume_per_hectare_at_maturity[order] = outputs[1]
+        finally:
+            del inputs, outputs
+            for block in (inputs_block, outputs_block):
+                block.close()
+                block.unlink()
+
+    if np.ndim(yield_requirement) == 0:
+        years_to_maturity = years_to_maturity[:, 0]
+        volume_per_hectare_at_maturity = volume_per_hectare_at_maturity[:, 0]
+    return {'years_to_maturity': years_to_maturity, 'volume_per_hectare_at_maturity': volume_per_hectare_at_maturity}
@@ -0,0 +1,167 @@
+import numpy as np
+import growth_engine
+
+#Thinning scenarios for the stands. A scenario is one thinning (tynning) of a share of the base area, some years from now.
+#The growth functions take the base area before (GF) and after (GE) the thinning, the dominant height (HOT) and age (AT) at the thinning,
+#so they can follow a stand through one thinning. All scenarios of all stands are advanced together, one year at a time, on
+#scenarios x stands arrays, and the best scenario of each stand is picked by the present value of what is harvested
+
+#A scenario is (years from now, share of the base area removed). Scenario 0 is always no thinning
+NO_THINNING = (0, 0.0)
+
+#Every combination of the thinning years and shares, after the no thinning scenario
+def thinning_schedules(years=(5, 10, 15, 20, 25, 30), shares=(0.2, 0.3, 0.4)):
+    return [NO_THINNING] + [(year, share) for year in years for share in shares]
+
+DEFAULT_SCENARIOS = thinning_schedules()
+
+#The stands are evaluated this many at a time. Every scenario keeps about 15 arrays of one value per stand
+CHUNK_SIZE = 10000
+
+#Advances the stands of one species from year - 1 to year, for all scenarios at once. The thinning parameters and the state
+#(N_per_hectare, G) are scenarios x stands, heights don't depend on the thinning and are one value per stand
+def _advance(species, state, alder, Ht40, H1, H2, year):
+    A1 = alder + year - 1
+    A2 = alder + year
+    N1 = state['N_per_hectare']
+    G1 = state['G']
+    GE, GF = state['GE'], state['GF']
+    if species == 'Gran':
+        N2 = growth_engine.gran_N2_per_hectare_array(N1, A1, A2, Ht40, GE, GF)
+        G2 = growth_engine.gran_basearea_growth_array(G1, N1, N2, H1, H2, state['HOT'], GE, GF)
+        V2 = growth_engine.gran_volume_array(G2, H2, A2)
+    else:
+        N2 = growth_engine.furu_N2_per_hectare_array(N1, A1, A2, Ht40, GE, GF)
+        G2 = growth_engine.furu_basearea_growth_array(G1, A1, A2, H1, H2, N1, N2, GE, GF, state['AT'])
+        V2 = growth_engine.furu_volume_array(G2, H2, A2, GE, GF, state['AT'])
+    return N2, G2, V2
+
+#Thins the scenarios in thinned this year: the share of the base area and trees is taken out, and the thinning parameters are set
+#for the years after. Returns the volume per hectare left standing
+def _thin(species, state, thinned, share, H2, A2, N2, G2, V2):
+    GE = G2 * (1 - share)
+    state['GF'] = np.where(thinned, G2, state['GF'])
+    state['GE'] = np.where(thinned, GE, state['GE'])
+    state['HOT'] = np.where(thinned, H2, state['HOT'])
+    state['AT'] = np.where(thinned, A2, state['AT'])
+    if species == 'Gran':
+        V_after = growth_engine.gran_volume_array(GE, H2, A2)
+    else:
+        V_after = growth_engine.furu_volume_array(GE, H2, A2, state['GE'], state['GF'], state['AT'])
+    state['removed'] = np.where(thinned, V2 - V_after, state['removed'])
+    return np.where(thinned, N2 * (1 - share), N2), np.where(thinned, GE, G2), np.where(thinned, V_after, V2)
+
+#Simulates every scenario for the stands of one species (columns already selected to them). Returns years_to_maturity,
+#volume_per_hectare_at_maturity and thinned_volume_per_hectare, each scenarios x stands
+def _simulate_species(species, columns, active, scenario_years, scenario_shares, yield_requirement, horizon):
+    n_scenarios, n_stands = len(scenario_years), len(columns['alder'])
+    alder = np.asarray(columns['alder'], dtype=float)
+    Ht40 = np.asarray(columns['Ht40'], dtype=float)
+    #The same skip rules as growth_engine.simulate_stands
+    height = np.where(active['height'], np.asarray(columns['height'], dtype=float), np.nan)
+    start_volume = np.where(active['volume'], np.asarray(columns['volume_per_hectare'], dtype=float), np.nan)
+    grid = (n_scenarios, n_stands)
+    state = {
+        'N_per_hectare': np.broadcast_to(np.where(active['density'], np.asarray(columns['N_per_hectare'], dtype=float), np.nan), grid),
+        'G': np.broadcast_to(np.where(active['volume'], np.asarray(columns['G2'], dtype=float), np.nan), grid),
+        #GE = GF is no thinning, the thinning terms then drop out of all the formulas
+        'GE': np.ones(grid),
+        'GF': np.ones(grid),
+        'HOT': np.zeros(grid),
+        'AT': np.ones(grid),
+        'removed': np.zeros(grid),
+    }
+    #The volume left standing after any thinning that year, which the growth rate of the next year is measured from
+    base_volume = np.broadcast_to(start_volume, grid)
+    previous_base_volume = np.full(grid, np.nan)
+    years_to_maturity = np.full(grid, np.nan)
+    volume_at_maturity = np.full(grid, np.nan)
+    #Stands without a volume are never checked for maturity
+    matured = np.broadcast_to(~active['volume'], grid).copy()
+    share = scenario_shares[:, None]
+
+    for year in range(1, horizon + 1):
+        H2 = growth_engine.func_gran_H02_array(height, alder + year - 1, alder + year) if species == 'Gran' else growth_engine.func_furu_H02_array(height, alder + year - 1, alder + year)
+        N2, G2, V2 = _advance(species, state, alder, Ht40, height, H2, year)
+        #The growth rate of the year is measured from what was left standing after last year's thinning
+        with np.errstate(all='ignore'):
+            growth_rate = (V2 - base_volume) / base_volume
+        thinned = (scenario_years[:, None] == year) & ~matured
+        if thinned.any():
+            N2, G2, V2 = _thin(species, state, thinned, share, H2, alder + year, N2, G2, V2)
+        #Like simulate_stands, maturity is checked from year 2, and a stand that matures this year matured two years back
+        if year >= 2:
+            matures = ~matured & (growth_rate < yield_requirement)
+            years_to_maturity[matures] = year - 2
+            volume_at_maturity[matures] = previous_base_volume[matures]
+            matured |= matures
+        height = H2
+        state['N_per_hectare'], state['G'] = N2, G2
+        previous_base_volume, base_volume = base_volume, V2
+        if matured.all():
+            break
+
+    #Stands that never fall below the yield requirement get 0 years to maturity, i.e. their current volume
+    never = ~matured
+    years_to_maturity[never] = 0
+    volume_at_maturity[never] = np.broadcast_to(start_volume, grid)[never]
+    #A thinning only counts if it comes before the stand is harvested at maturity, see best_thinning
+    thinned_volume = np.where((scenario_years[:, None] > 0) & (scenario_years[:, None] <= years_to_maturity), state['removed'], 0.0)
+    return years_to_maturity, volume_at_maturity, thinned_volume
+
+#Evaluates every thinning scenario for the stands and picks the best one for each stand.
+#columns holds the growth_engine.SIMULATION_COLUMNS, scenarios a list of (years from now, share of the base area removed) as from
+#thinning_schedules, with NO_THINNING first. Maturity follows the same rule as growth_engine.simulate_stands, with the growth rate
+#measured from the volume left after a thinning. A scenario is scored by the present value at the yield requirement of the volume
+#thinned out and the volume harvested at maturity, per hectare. A scenario whose thinning comes after the stand has matured is not possible
+#and is not picked, so stands that are better off without thinning get scenario 0.
+#Returns, per stand, the index of the best scenario, its thinning year and share, years_to_maturity, volume_per_hectare_at_maturity,
+#thinned_volume_per_hectare and present_value_per_hectare, and present_values (stands x scenarios, np.nan for scenarios that aren't possible).
+#Stands that are not Gran or Furu, or have no volume growth, get np.nan
+def best_thinning(columns, yield_requirement=0.03, scenarios=DEFAULT_SCENARIOS, horizon=growth_engine.HORIZON, chunk_size=CHUNK_SIZE):
+    scenario_years = np.array([year for year, share in scenarios], dtype=float)
+    scenario_shares = np.array([share for year, share in scenarios], dtype=float)
+    treslag = np.asarray(columns['treslag'])
+    n_stands, n_scenarios = len(treslag), len(scenarios)
+    results = {name: np.full((n_scenarios, n_stands), np.nan) for name in ('years_to_maturity', 'volume_per_hectare_at_maturity', 'thinned_volume_per_hectare')}
+    active = {
+        'height': ~np.isnan(np.asarray(columns['yearly_height_growth'], dtype=float)),
+        'density': ~np.isnan(np.asarray(columns['delta_N_per_hectare'], dtype=float)),
+        'volume': ~np.isnan(np.asarray(columns['volume_growth_next_year'], dtype=float)),
+    }
+
+    for species in ('Gran', 'Furu'):
+        species_idx = np.flatnonzero((treslag == species) & active['volume'])
+        for start in range(0, len(species_idx), chunk_size):
+            idx = species_idx[start:start + chunk_size]
+            chunk = {name: np.asarray(columns[name])[idx] for name in growth_engine.SIMULATION_COLUMNS}
+            chunk_active = {name: mask[idx] for name, mask in active.items()}
+            chunk_results = _simulate_species(species, chunk, chunk_active, scenario_years, scenario_shares, yield_requirement, horizon)
+            for name, values in zip(results, chunk_results):
+                results[name][:, idx] = values
+
+    discount = 1 + yield_requirement
+    possible = (scenario_years[:, None] == 0) | (scenario_years[:, None] <= results['years_to_maturity'])
+    present_values = np.where(
+        possible,
+        results['thinned_volume_per_hectare'] * discount ** -scenario_years[:, None] + results['volume_per_hectare_at_maturity'] * discount ** -results['years_to_maturity'],
+        np.nan,
+        )
+    evaluated = ~np.isnan(present_values[0])
+    #np.nan never wins, and scenario 0 is always possible
+    best = np.where(evaluated, np.argmax(np.where(np.isnan(present_values), -np.inf, present_values), axis=0), 0)
+    stand = np.arange(n_stands)
+
+    def pick(values):
+        return np.where(evaluated, values[best, stand], np.nan)
+
+    return {
+        'scenario': np.where(evaluated, best, -1),
+        'thinning_year': pick(np.broadcast_to(scenario_years[:, None], present_values.shape)),
+        'thinning_share': pick(np.broadcast_to(scenario_shares[:, None], present_values.shape)),
+        'years_to_maturity': pick(results['years_to_maturity']),
+        'volume_per_hectare_at_maturity': pick(results['volume_per_hectare_at_maturity']),
+        'thinned_volume_per_hectare': pick(results['thinned_volume_per_hectare']),
+        'present_value_per_hectare': pick(present_values),
+        'present_values': present_values.T,
+    }
@@ -0,0 +1,223 @@
+import io
+import os
+from collections import OrderedDict
+import numpy as np
+import growth_engine
+
+#Stands are looked up in the cache by their starting state, quantized to these numbers of decimals.
+#SR16 gives heights in dm, densities in trees per hectare and base areas in m2/ha, so stands from the same SR16 cell
+#(and the many stands that share rounded SR16 values across forests) get the same key.
+#volume_per_hectare is part of the key because it falls back on srvolmb when the volume formula can't be used
+KEY_DECIMALS = {
+    'alder': 1,
+    'Ht40': 2,
+    'height': 2,
+    'N_per_hectare': 1,
+    'G1': 3,
+    'volume_per_hectare': 2,
+}
+
+#The columns TrajectoryCache.simulate_stands needs, the SIMULATION_COLUMNS of growth_engine and the starting base area G1
+CACHE_COLUMNS = growth_engine.SIMULATION_COLUMNS + ('G1',)
+
+#The default number of entries kept in memory, one per stand and yield requirement. An entry takes about 300 bytes
+MAX_ENTRIES = 100000
+
+#The quantized state of each stand as rows of a float matrix, with the horizon and direct_gran added as the last two columns
+def _stand_states(columns, idx, horizon, direct_gran):
+    states = np.empty((len(idx), len(KEY_DECIMALS) + 2))
+    for i, (name, decimals) in enumerate(KEY_DECIMALS.items()):
+        #Adding 0.0 turns -0.0 into 0.0, so both give the same key
+        states[:, i] = np.round(np.asarray(columns[name], dtype=float)[idx], decimals) + 0.0
+    states[:, -2] = horizon
+    states[:, -1] = direct_gran
+    #Any np.nan gets the same bytes
+    states[np.isnan(states)] = np.nan
+    return states
+
+#The number of floats in the key of a cache entry: whether the stand is Gran, its state and the yield requirement
+KEY_COLUMNS = 1 + len(KEY_DECIMALS) + 2 + 1
+
+#The rows of a float matrix as bytes objects, to compare rows with np.unique or to use them as keys
+def _row_bytes(rows):
+    rows = np.ascontiguousarray(rows)
+    return rows.view(np.dtype((np.void, rows.dtype.itemsize * rows.shape[1]))).ravel()
+
+#Keeps the maturity results of stands (years_to_maturity and the volume per hectare at maturity) for each yield requirement they were
+#simulated for, keyed on their quantized starting state, so a stand that has been simulated before (in this forest or another one)
+#doesn't have to be simulated again. The least recently used entries are dropped once there are more than max_entries.
+#store is an optional persistent tier (DiskTrajectoryStore or S3TrajectoryStore) that the cache is read from on first use and
+#written back to by save(). What is stored there is tied to growth_engine.MODEL_VERSION, so changed coefficients don't give old results
+class TrajectoryCache:
+    def __init__(self, max_entries=MAX_ENTRIES, store=None, version=growth_engine.MODEL_VERSION):
+        self.max_entries = max_entries
+        self.store = store
+        self.version = version
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.loaded = store is None
+        self.changed = False
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        maturity = self.entries.get(key)
+        if maturity is not None:
+            self.entries.move_to_end(key)
+        return maturity
+
+    #Adds the (key, maturity) pairs as the most recently used entries
+    def put_all(self, items):
+        for key, maturity in items:
+            self.entries[key] = maturity
+            self.entries.move_to_end(key)
+        self.changed = True
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    #Reads the persistent tier into memory, once
+    def load(self):
+        if self.loaded:
+            return
+        self.loaded = True
+        stored = self.store.load(self.version)
+        if stored is None:
+            return
+        keys, maturity = stored
+        self.entries.update(zip(_row_bytes(keys).tolist(), maturity.tolist()))
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    #Writes the entries in memory to the persistent tier, if anything was added since it was read
+    def save(self):
+        if self.store is None or not self.changed:
+            return
+        keys = np.frombuffer(b''.join(self.entries), dtype=float).reshape(len(self.entries), KEY_COLUMNS)
+        maturity = np.array(list(self.entries.values()), dtype=float).reshape(len(self.entries), 2)
+        self.store.save(self.version, (keys, maturity))
+        self.changed = False
+
+    #Same as growth_engine.simulate_stands, but the maturity results are taken from the cache where they can be, and only the stands
+    #that are not in it for every yield requirement are simulated (once for every distinct state, and lazily, see growth_engine.simulate_stands).
+    #columns also needs G1, see CACHE_COLUMNS.
+    #Stands whose state only differs below KEY_DECIMALS share their results, so these can differ slightly from simulating them one by one
+    def simulate_stands(self, columns, yield_requirement=0.03, horizon=growth_engine.HORIZON, direct_gran=False):
+        self.load()
+        yield_requirements = np.atleast_1d(np.asarray(yield_requirement, dtype=float))
+        treslag = np.asarray(columns['treslag'])
+        n_stands = len(treslag)
+        years_to_maturity = np.full((n_stands, len(yield_requirements)), np.nan)
+        volume_per_hectare_at_maturity = np.full((n_stands, len(yield_requirements)), np.nan)
+
+        #Stands without a volume growth are never checked for maturity, so they don't need to be simulated
+        volume_active = ~np.isnan(np.asarray(columns['volume_growth_next_year'], dtype=float))
+        idx = np.flatnonzero(volume_active & ((treslag == 'Gran') | (treslag == 'Furu')))
+        states = _stand_states(columns, idx, horizon, direct_gran)
+        #Stands with the same species and state are looked up (and simulated) once
+        is_gran = (treslag[idx] == 'Gran')[:, None].astype(float)
+        rows = np.hstack([is_gran, states])
+        _, first, inverse = np.unique(_row_bytes(rows), return_index=True, return_inverse=True)
+        inverse = inverse.ravel()
+        #One key for every distinct state and yield requirement: the species, the state and the requirement
+        n_unique, n_requirements = len(first), len(yield_requirements)
+        keys = _row_bytes(np.hstack([np.repeat(rows[first], n_requirements, axis=0), np.tile(yield_requirements, n_unique)[:, None]])).tolist()
+        stored = [self.get(key) for key in keys]
+        found = np.array([maturity is not None for maturity in stored], dtype=bool).reshape(n_unique, n_requirements)
+        unique_maturity = np.array([(np.nan, np.nan) if maturity is None else maturity for maturity in stored]).reshape(n_unique, n_requirements, 2)
+        #A state is simulated again if any of the yield requirements is not in the cache
+        missing = np.flatnonzero(~found.all(axis=1))
+        missing_stands = np.isin(inverse, missing)
+        self.misses += int(missing_stands.sum())
+        self.hits += len(idx) - int(missing_stands.sum())
+
+        if len(missing):
+            simulated = idx[first[missing]]
+            maturity = growth_engine.simulate_stands(
+                {name: np.asarray(columns[name])[simulated] for name in growth_engine.SIMULATION_COLUMNS},
+                yield_requirements,
+                horizon=horizon,
+                direct_gran=direct_gran,
+                )
+            unique_maturity[missing, :, 0] = maturity['years_to_maturity']
+            unique_maturity[missing, :, 1] = maturity['volume_per_hectare_at_maturity']
+            missing_keys = (keys[position * n_requirements + i] for position in missing.tolist() for i in range(n_requirements))
+            self.put_all(zip(missing_keys, unique_maturity[missing].reshape(-1, 2).tolist()))
+
+        years_to_maturity[idx] = unique_maturity[inverse, :, 0]
+        volume_per_hectare_at_maturity[idx] = unique_maturity[inverse, :, 1]
+
+        if np.ndim(yield_requirement) == 0:
+            years_to_maturity = years_to_maturity[:, 0]
+            volume_per_hectare_at_maturity = volume_per_hectare_at_maturity[:, 0]
+        return {'years_to_maturity': years_to_maturity, 'volume_per_hectare_at_maturity': volume_per_hectare_at_maturity}
+
+
+#The stored cache is one .npz per model version, with the key (see KEY_COLUMNS) and the maturity results of every entry.
+#STORE_FORMAT is part of the file name and bumped when what is stored changes, so files in an older format are not read
+STORE_FORMAT = 2
+
+def _file_name(version):
+    return f'trajectory_cache_v{version}_f{STORE_FORMAT}.npz'
+
+def _to_npz(entries):
+    keys, maturity = entries
+    buffer = io.BytesIO()
+    np.savez(buffer, keys=keys, maturity=maturity)
+    return buffer.getvalue()
+
+def _from_npz(data):
+    with np.load(io.BytesIO(data)) as arrays:
+        return arrays['keys'], arrays['maturity']
+
+#Persistent tier in a local directory, e.g. for local runs of the model
+class DiskTrajectoryStore:
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, version):
+        return os.path.join(self.directory, _file_name(version))
+
+    def load(self, version):
+        if not os.path.exists(self.path(version)):
+            return None
+        with open(self.path(version), 'rb') as file:
+            return _from_npz(file.read())
+
+    def save(self, version, entries):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.path(version), 'wb') as file:
+            file.write(_to_npz(entries))
+
+#Persistent tier in S3, shared by all containers of the model lambda. boto3 is only imported when it is used
+class S3TrajectoryStore:
+    def __init__(self, bucket, prefix='SkogAppModelTrajectoryCache/', client=None):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.client = client
+
+    def key(self, version):
+        return f'{self.prefix}{_file_name(version)}'
+
+    def _client(self):
+        if self.client is None:
+            import boto3
+            self.client = boto3.client('s3')
+        return self.client
+
+    def load(self, version):
+        client = self._client()
+        try:
+            response = client.get_object(Bucket=self.bucket, Key=self.key(version))
+        except client.exceptions.NoSuchKey:
+            return None
+        return _from_npz(response['Body'].read())
+
+    def save(self, version, entries):
+        self._client().put_object(Bucket=self.bucket, Key=self.key(version), Body=_to_npz(entries))
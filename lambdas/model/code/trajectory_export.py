@@ -0,0 +1,104 @@
+import io
+import numpy as np
+import growth_model
+
+#The yearly trajectories of the stands as one columnar file, so they can be charted without running the model again.
+#There is one row per stand and year (bestand_id, year and the quantities below), with the stands in the order they were run.
+#Parquet is written with one row group per chunk of stands run, so a client can read the row groups (or columns) it needs with range reads
+
+#Where the trajectories go in the outputs bucket, one file per forest and yield requirement
+TRAJECTORY_EXPORT_PREFIX = 'SkogAppModelTrajectories/'
+
+#The per hectare quantities from growth_engine.allocate_trajectories we export, followed by volume and carbon_stored for the area of the stand
+EXPORT_QUANTITIES = ('height', 'N_per_hectare', 'G', 'volume_per_hectare', 'growth_rate')
+EXPORT_COLUMNS = ('bestand_id', 'year') + EXPORT_QUANTITIES + ('volume', 'carbon_stored')
+
+FORMATS = {'parquet': '.parquet', 'arrow': '.arrow', 'npz': '.npz'}
+
+#The file name of the trajectories of a forest for one yield requirement, e.g. SkogAppModelTrajectories/f1/trajectories_0.03.parquet
+def export_key(forestID, yield_requirement, extension):
+    return f"{TRAJECTORY_EXPORT_PREFIX}{forestID}/trajectories_{yield_requirement:g}{extension}"
+
+#The rows of the trajectories of the stands as flat columns, stand by stand and year by year. The values are float32, which is
+#plenty for charting and halves the size of the file
+def trajectory_columns(stands, trajectories):
+    n_stands, n_years = trajectories['volume_per_hectare'].shape
+    columns = {
+        'bestand_id': np.repeat(np.asarray(stands['bestand_id']).astype(str), n_years),
+        'year': np.tile(np.arange(n_years, dtype=np.int16), n_stands),
+    }
+    for quantity in EXPORT_QUANTITIES:
+        columns[quantity] = np.ascontiguousarray(trajectories[quantity], dtype=np.float32).ravel()
+    volume = trajectories['volume_per_hectare'] * np.asarray(stands['arealm2'], dtype=float)[:, None] / 10000
+    columns['volume'] = volume.astype(np.float32).ravel()
+    columns['carbon_stored'] = growth_model.wood_to_carbon(volume).astype(np.float32).ravel()
+    return columns
+
+#pyarrow takes a while to import and exporting is opt-in, so like boto3 it is only imported when trajectories are written with it.
+#Returns None without pyarrow, then the trajectories are written as a compressed .npz with the same columns
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        return None
+    return pyarrow
+
+#Collects the trajectories of the chunks of stands growth_model.run is given it for (as trajectory_writer), and writes them to one file in memory.
+#format is 'parquet' or 'arrow' (Arrow IPC), both of which need pyarrow, or 'npz'. Without pyarrow the format falls back to 'npz'
+class TrajectoryWriter:
+    def __init__(self, format='parquet'):
+        self.pyarrow = _pyarrow() if format != 'npz' else None
+        if self.pyarrow is None:
+            format = 'npz'
+        self.format = format
+        self.extension = FORMATS[format]
+        self.buffer = io.BytesIO()
+        self.writer = None
+        self.chunks = []
+        self.n_stands = 0
+
+    def write(self, stands, trajectories):
+        columns = trajectory_columns(stands, trajectories)
+        self.n_stands += len(stands['bestand_id'])
+        if self.format == 'npz':
+            self.chunks.append(columns)
+            return
+        pyarrow = self.pyarrow
+        table = pyarrow.table(columns)
+        if self.writer is None:
+            if self.format == 'parquet':
+                #Byte stream split encoding lets zstd compress the float columns about twice as well
+                self.writer = pyarrow.parquet.ParquetWriter(
+                    self.buffer, table.schema, compression='zstd', use_dictionary=['bestand_id', 'year'],
+                    use_byte_stream_split=list(EXPORT_COLUMNS[2:]),
+                    )
+            else:
+                self.writer = pyarrow.ipc.new_file(self.buffer, table.schema, options=pyarrow.ipc.IpcWriteOptions(compression='zstd'))
+        if self.format == 'parquet':
+            self.writer.write_table(table, row_group_size=len(columns['year']))
+        else:
+            self.writer.write_table(table)
+
+    #The contents of the file, once all chunks are written
+    def getvalue(self):
+        if self.format == 'npz':
+            if self.chunks:
+                np.savez_compressed(self.buffer, **{name: np.concatenate([chunk[name] for chunk in self.chunks]) for name in EXPORT_COLUMNS})
+            else:
+                np.savez_compressed(self.buffer)
+            self.chunks = []
+        elif self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        return self.buffer.getvalue()
+
+#Uploads the trajectories to the bucket under export_key and returns the key. boto3 is only imported when it is used
+def upload(writer, bucket, forestID, yield_requirement, client=None):
+    if client is None:
+        import boto3
+        client = boto3.client('s3')
+    key = export_key(forestID, yield_requirement, writer.extension)
+    client.put_object(Bucket=bucket, Key=key, Body=writer.getvalue())
+    return key
@@ -0,0 +1,292 @@
+import os
+import queue
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import zip_longest
+from urllib.parse import quote
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+# Airtable I/O shared by the lambdas that read and write the forest tables (model, featureInfoToAirtable and SR16IntersectionToAirtable).
+# All requests to a base go through one token bucket, so together they stay under Airtable's limit of 5 requests per second per base,
+# over one pooled session that keeps its connections alive between requests (and between invocations of a warm lambda).
+# Requests that get 429 (too many requests) or a 5xx back are retried with exponential back-off and jitter. Creates are only retried
+# when Airtable can't have written them, see request.
+# Batches of records are sent from a few threads at a time, so the round trips overlap while the token bucket sets the pace.
+# The Dockerfiles copy this file in from the shared build context, see Build-Deploy-Lambdas.md
+
+# The API root can be pointed somewhere else, e.g. at a local stand-in for Airtable
+AIRTABLE_API_ROOT = os.getenv('AIRTABLE_API_ROOT', 'https://api.airtable.com/v0')
+
+# Airtable allows 5 requests per second per base
+REQUESTS_PER_SECOND = float(os.getenv('AIRTABLE_REQUESTS_PER_SECOND', 5))
+
+# The most batches in flight at a time
+MAX_CONCURRENCY = int(os.getenv('AIRTABLE_MAX_CONCURRENCY', 4))
+
+# The most batches a PipelinedWriter holds before write waits for the writers to catch up
+MAX_QUEUED_BATCHES = 200
+
+# Airtable takes at most 10 records per create, update or upsert request, and returns at most 100 per page
+MAX_RECORDS_PER_REQUEST = 10
+PAGE_SIZE = 100
+
+# A request is retried this many times, waiting about RETRY_BASE_SECONDS, then twice that and so on, up to RETRY_MAX_SECONDS.
+# Airtable asks for 30 seconds of quiet after a 429, which the waits add up to
+MAX_RETRIES = 6
+RETRY_BASE_SECONDS = 1.0
+RETRY_MAX_SECONDS = 30.0
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+# Retrying a GET or PATCH (updates by id and upserts) writes nothing twice. A POST (a create) that got a 5xx or lost its connection
+# may have been written all the same, and retrying it would create the records again, so it is only retried on a 429, which Airtable
+# turns down before doing anything, and when the connection couldn't be made at all
+IDEMPOTENT_METHODS = ('GET', 'PATCH')
+UNWRITTEN_STATUS_CODES = (429,)
+
+# Lets requests through at rate per second, with at most capacity of them at once after a quiet spell.
+# A capacity of 1 spaces the requests evenly, so no one second window ever sees more than rate of them
+class TokenBucket:
+    def __init__(self, rate=REQUESTS_PER_SECOND, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Waits until a token is free and takes it
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+# One token bucket per base, shared by every client of the base in the process
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def base_limiter(base_id):
+    with _limiters_lock:
+        if base_id not in _limiters:
+            _limiters[base_id] = TokenBucket()
+        return _limiters[base_id]
+
+# A requests.Session with a connection pool large enough for max_concurrency requests at a time
+def pooled_session(max_concurrency=MAX_CONCURRENCY):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+# How long to wait before retry number attempt (from 0): the Retry-After Airtable gives, if any, and otherwise a random
+# wait up to the exponential back-off ("full jitter"), so clients that got a 429 together don't come back together
+def retry_delay(attempt, response=None):
+    retry_after = response.headers.get('Retry-After') if response is not None else None
+    if retry_after:
+        try:
+            return min(float(retry_after), RETRY_MAX_SECONDS)
+        except ValueError:
+            pass
+    return random.uniform(0, min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** attempt))
+
+# Whether a requests.ConnectionError happened before the request was sent: the connection timed out or was refused
+def never_sent(error):
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+def batches(records, batch_size=MAX_RECORDS_PER_REQUEST):
+    return [records[i:i + batch_size] for i in range(0, len(records), batch_size)]
+
+# A client for one Airtable base. Clients are cheap, but keeping one per lambda container keeps its connections alive
+class AirtableClient:
+    def __init__(self, token, base_id, api_root=AIRTABLE_API_ROOT, session=None, limiter=None, max_concurrency=MAX_CONCURRENCY, log=None):
+        self.token = token
+        self.base_id = base_id
+        self.api_root = api_root.rstrip('/')
+        self.session = session if session is not None else pooled_session(max_concurrency)
+        self.limiter = limiter if limiter is not None else base_limiter(base_id)
+        self.max_concurrency = max_concurrency
+        self.log = log if log is not None else print
+
+    def table_url(self, table_name):
+        return f"{self.api_root}/{self.base_id}/{quote(table_name, safe='')}"
+
+    def meta_url(self):
+        return f"{self.api_root}/meta/bases/{self.base_id}/tables"
+
+    # Sends one request at the pace of the token bucket, retrying on 429, 5xx and connection errors (POSTs only on 429 and
+    # connections that couldn't be made, see IDEMPOTENT_METHODS).
+    # Returns the last response, whatever its status, so the caller decides what a failure means
+    def request(self, method, url, **kwargs):
+        headers = {'Authorization': f'Bearer {self.token}', **kwargs.pop('headers', {})}
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+        retry_status_codes = RETRY_STATUS_CODES if idempotent else UNWRITTEN_STATUS_CODES
+        for attempt in range(MAX_RETRIES + 1):
+            self.limiter.acquire()
+            try:
+                response = self.session.request(method, url, headers=headers, **kwargs)
+            except requests.ConnectionError as e:
+                if attempt == MAX_RETRIES or not (idempotent or never_sent(e)):
+                    raise
+                delay = retry_delay(attempt)
+                self.log(f"Airtable {method} failed ({e}), retrying in {delay:.1f}s")
+            else:
+                if response.status_code not in retry_status_codes or attempt == MAX_RETRIES:
+                    return response
+                delay = retry_delay(attempt, response)
+                self.log(f"Airtable {method} returned {response.status_code}, retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+    # All records of the table as returned by Airtable ({'id': ..., 'fields': {...}}), page by page.
+    # fields limits the fields returned (Airtable's fields[] projection), all of them are returned without it
+    def list_records(self, table_name, fields=None):
+        params = {'pageSize': PAGE_SIZE}
+        if fields is not None:
+            params['fields[]'] = list(fields)
+        records = []
+        while True:
+            response = self.request('GET', self.table_url(table_name), params=params)
+            response.raise_for_status()
+            data = response.json()
+            records.extend(data['records'])
+            if 'offset' in data:
+                params['offset'] = data['offset']
+            else:
+                break
+        return records
+
+    # The tables of the base from the metadata API, with their fields
+    def tables(self):
+        response = self.request('GET', self.meta_url())
+        response.raise_for_status()
+        return response.json()['tables']
+
+    def create_table(self, table_name, fields):
+        response = self.request('POST', self.meta_url(), json={'name': table_name, 'fields': fields})
+        response.raise_for_status()
+        return response.json()
+
+    def create_field(self, table_id, field):
+        response = self.request('POST', f"{self.meta_url()}/{table_id}/fields", json=field)
+        response.raise_for_status()
+        return response.json()
+
+    # Sends the records in batches of MAX_RECORDS_PER_REQUEST, up to max_concurrency batches at a time, each request body being
+    # {'records': batch, **body}. Returns the (batch, response) pairs of the batches sent, in the order of the batches.
+    # Once a batch fails the batches that haven't been sent yet are dropped, the ones already in flight are still written
+    def send_batches(self, method, table_name, records, body=None):
+        url = self.table_url(table_name)
+        failed = threading.Event()
+
+        def send(batch):
+            if failed.is_set():
+                return None
+            response = self.request(method, url, json={'records': batch, **(body or {})})
+            if not response.ok:
+                failed.set()
+            return response
+
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            responses = list(executor.map(send, batches(records)))
+        return [(batch, response) for batch, response in zip(batches(records), responses) if response is not None]
+
+    # records are {'fields': {...}}
+    def create_records(self, table_name, records):
+        return self.send_batches('POST', table_name, records)
+
+    # records are {'id': ..., 'fields': {...}}
+    def update_records(self, table_name, records):
+        return self.send_batches('PATCH', table_name, records)
+
+    # records are {'fields': {...}}, matched to the records of the table on fields_to_merge_on and created if there is no match
+    def upsert_records(self, table_name, records, fields_to_merge_on):
+        return self.send_batches('PATCH', table_name, records, {'performUpsert': {'fieldsToMergeOn': list(fields_to_merge_on)}})
+
+# Writes batches of records to one table from a bounded queue on max_concurrency threads of the client, so the caller can go on
+# (e.g. computing the next records) while the earlier ones are written. Updates and creates share the queue and the token bucket.
+# on_result, if given, is called with (method, batch, response) for every batch sent, from the writer threads.
+# Once a batch fails, failure holds it as (method, batch, response) and the batches still queued are dropped. An exception raised by
+# on_result fails the writer the same way, as (method, batch, exception). Use it as a context manager, or call close,
+# which waits for the queue to be written
+class PipelinedWriter:
+    def __init__(self, client, table_name, on_result=None, max_queued_batches=MAX_QUEUED_BATCHES):
+        self.client = client
+        self.url = client.table_url(table_name)
+        self.on_result = on_result
+        self.queue = queue.Queue(maxsize=max_queued_batches)
+        self.lock = threading.Lock()
+        self.failure = None
+        self.written = 0
+        self.threads = [threading.Thread(target=self._work, daemon=True) for _ in range(client.max_concurrency)]
+        for thread in self.threads:
+            thread.start()
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            method, batch = item
+            if self.failure is not None:
+                continue
+            try:
+                response = self.client.request(method, self.url, json={'records': batch})
+            except Exception as e:
+                # Connection errors are raised once the retries run out, they fail the writer like a failed response
+                with self.lock:
+                    if self.failure is None:
+                        self.failure = (method, batch, e)
+                continue
+            with self.lock:
+                if response.ok:
+                    self.written += len(batch)
+                elif self.failure is None:
+                    self.failure = (method, batch, response)
+            if self.on_result is not None:
+                # The thread has to keep taking batches off the queue, or write and close would wait for it forever
+                try:
+                    self.on_result(method, batch, response)
+                except Exception as e:
+                    with self.lock:
+                        if self.failure is None:
+                            self.failure = (method, batch, e)
+
+    # Queues updates ({'id': ..., 'fields': {...}}) and creates ({'fields': {...}}) in batches, taking turns between the two.
+    # Waits while the queue is full. Nothing more is queued once the writer has failed
+    def write(self, updates=(), creates=()):
+        for update, create in zip_longest(batches(list(updates)), batches(list(creates))):
+            for item in (('PATCH', update), ('POST', create)):
+                if self.failure is not None:
+                    return
+                if item[1] is not None:
+                    self.queue.put(item)
+
+    # Waits for the queued batches to be written and stops the threads
+    def close(self):
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+# Raises requests.HTTPError for the first failed batch of the (batch, response) pairs from AirtableClient.send_batches
+def raise_for_failed_batches(results):
+    for batch, response in results:
+        response.raise_for_status()
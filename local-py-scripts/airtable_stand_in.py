@@ -0,0 +1,390 @@
+import argparse
+import json
+import random
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+# A local stand-in for the part of the Airtable REST API the lambdas use (see lambdas/shared/airtable_io.py), so the Airtable paths of
+# model, featureInfoToAirtable and SR16IntersectionToAirtable can be run, timed and tested for rate limits without the real Airtable:
+#   GET    /v0/{base}/{table}                        list records, pageSize and offset paging and the fields[] projection
+#   POST   /v0/{base}/{table}                        create up to 10 records
+#   PATCH  /v0/{base}/{table}                        update up to 10 records by id, or upsert them with performUpsert
+#   GET    /v0/meta/bases/{base}/tables              the tables with their fields
+#   POST   /v0/meta/bases/{base}/tables              create a table
+#   POST   /v0/meta/bases/{base}/tables/{table}/fields  create a field
+#   GET    /_stats                                   the requests served so far, not part of Airtable
+# Tables are kept in memory, any base id and any token will do. Like Airtable it rounds numbers to the precision of their field,
+# drops fields set to null or '' and turns down writes to fields the table doesn't have.
+# Run it from this folder and point the lambdas at it with AIRTABLE_API_ROOT:
+#   python airtable_stand_in.py --latency 0.2 --jitter 0.1 --throttle-rate 0.02
+#   AIRTABLE_API_ROOT=http://localhost:8765/v0 python ...
+# load_test_airtable.py runs forest-sized workloads against it
+
+DEFAULT_PORT = 8765
+
+# Airtable takes at most 10 records per create, update or upsert request, returns at most 100 per page
+# and allows 5 requests per second per base
+MAX_RECORDS_PER_REQUEST = 10
+PAGE_SIZE = 100
+REQUESTS_PER_SECOND = 5
+
+def error_body(error_type, message):
+    return {'error': {'type': error_type, 'message': message}}
+
+# Raised by the handlers of the API, sent back as the status code and Airtable error body
+class AirtableError(Exception):
+    def __init__(self, status_code, error_type, message):
+        super().__init__(message)
+        self.status_code = status_code
+        self.body = error_body(error_type, message)
+
+# One table: its fields, and its records in the order they were created
+class Table:
+    def __init__(self, table_id, name):
+        self.id = table_id
+        self.name = name
+        self.fields = []
+        self.records = []
+        self.records_by_id = {}
+        # Records by the values of the fields they are upserted on, one index per set of fields, built on first use
+        self.indexes = {}
+
+    def field(self, name):
+        for field in self.fields:
+            if field['name'] == name:
+                return field
+        return None
+
+    def meta(self):
+        return {'id': self.id, 'name': self.name, 'primaryFieldId': self.fields[0]['id'] if self.fields else None, 'fields': self.fields, 'views': []}
+
+    def index(self, merge_fields):
+        if merge_fields not in self.indexes:
+            self.indexes[merge_fields] = {index_key(record, merge_fields): record for record in self.records}
+        return self.indexes[merge_fields]
+
+def index_key(record, merge_fields):
+    return tuple(json.dumps(record['fields'].get(name), sort_keys=True) for name in merge_fields)
+
+# The tables of every base, and the ids handed out for tables, fields and records
+class Store:
+    def __init__(self):
+        self.bases = {}
+        self.lock = threading.Lock()
+        self.next_id = 0
+
+    def new_id(self, prefix):
+        self.next_id += 1
+        return f"{prefix}{self.next_id:014x}"
+
+    def tables(self, base_id):
+        return self.bases.setdefault(base_id, {})
+
+    # The table with that name or id
+    def table(self, base_id, name_or_id):
+        for table in self.tables(base_id).values():
+            if name_or_id in (table.id, table.name):
+                return table
+        raise AirtableError(404, 'TABLE_NOT_FOUND', f"Could not find table {name_or_id} in base {base_id}")
+
+    def create_table(self, base_id, name, fields):
+        if not name or any(table.name == name for table in self.tables(base_id).values()):
+            raise AirtableError(422, 'DUPLICATE_TABLE_NAME', f"A table named {name!r} already exists")
+        if not fields:
+            raise AirtableError(422, 'INVALID_REQUEST_UNKNOWN', "A table needs at least one field")
+        table = Table(self.new_id('tbl'), name)
+        for field in fields:
+            self.create_field(table, field)
+        self.tables(base_id)[table.id] = table
+        return table
+
+    def create_field(self, table, field):
+        if not field.get('name') or table.field(field['name']) is not None:
+            raise AirtableError(422, 'DUPLICATE_OR_EMPTY_FIELD_NAME', f"The field {field.get('name')!r} is empty or already exists")
+        field = {'id': self.new_id('fld'), **field}
+        table.fields.append(field)
+        return field
+
+    # The fields of a record as Airtable would store them, or AirtableError for fields the table doesn't have
+    def stored_fields(self, table, fields):
+        stored = {}
+        for name, value in fields.items():
+            field = table.field(name)
+            if field is None:
+                raise AirtableError(422, 'UNKNOWN_FIELD_NAME', f"Unknown field name: {name!r}")
+            precision = field.get('options', {}).get('precision') if field.get('type') == 'number' else None
+            if precision is not None and isinstance(value, (int, float)) and not isinstance(value, bool):
+                value = round(value, precision)
+                if precision == 0:
+                    value = int(value)
+            stored[name] = value
+        return stored
+
+    # Sets fields on a record, keeping the upsert indexes up to date
+    def set_fields(self, table, record, fields):
+        for merge_fields, index in table.indexes.items():
+            if index.get(index_key(record, merge_fields)) is record:
+                del index[index_key(record, merge_fields)]
+        for name, value in fields.items():
+            if value is None or value == '':
+                record['fields'].pop(name, None)
+            else:
+                record['fields'][name] = value
+        for merge_fields, index in table.indexes.items():
+            index[index_key(record, merge_fields)] = record
+
+    def create_record(self, table, fields):
+        record = {'id': self.new_id('rec'), 'createdTime': time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime()), 'fields': {}}
+        table.records.append(record)
+        table.records_by_id[record['id']] = record
+        for merge_fields, index in table.indexes.items():
+            index[index_key(record, merge_fields)] = record
+        self.set_fields(table, record, fields)
+        return record
+
+# The settings of the stand-in: latency (seconds, plus or minus jitter) added to every request, the requests per second per base
+# it takes before it answers 429 (0 for no limit), the share of requests answered 429 at random, and the Retry-After sent with a 429
+class Settings:
+    def __init__(self, latency=0.0, jitter=0.0, rate_limit=REQUESTS_PER_SECOND, throttle_rate=0.0, retry_after=None, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+
+class AirtableStandIn(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', DEFAULT_PORT), settings=None):
+        super().__init__(address, Handler)
+        self.settings = settings if settings is not None else Settings()
+        self.store = Store()
+        # The times of the requests of the last second, per base
+        self.windows = {}
+        self.stats_lock = threading.Lock()
+        self.stats = {'requests': {}, 'throttled': 0, 'records_created': 0, 'records_updated': 0, 'records_listed': 0}
+
+    @property
+    def api_root(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v0"
+
+    def count(self, key, n=1):
+        with self.stats_lock:
+            self.stats[key] += n
+
+    def count_request(self, method):
+        with self.stats_lock:
+            self.stats['requests'][method] = self.stats['requests'].get(method, 0) + 1
+
+    # Whether a request to the base is turned down with a 429, at random or because the base has had rate_limit requests in the last second
+    def throttled(self, base_id):
+        settings = self.settings
+        with self.stats_lock:
+            if settings.throttle_rate and settings.random.random() < settings.throttle_rate:
+                return True
+            if not settings.rate_limit:
+                return False
+            now = time.monotonic()
+            window = self.windows.setdefault(base_id, deque())
+            while window and window[0] <= now - 1:
+                window.popleft()
+            if len(window) >= settings.rate_limit:
+                return True
+            window.append(now)
+            return False
+
+    def delay(self):
+        settings = self.settings
+        with self.stats_lock:
+            seconds = settings.latency + settings.random.uniform(-settings.jitter, settings.jitter)
+        if seconds > 0:
+            time.sleep(seconds)
+
+    # Serves in a background thread, for use from a script or test. Call shutdown to stop it
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+class Handler(BaseHTTPRequestHandler):
+    # HTTP/1.1 keeps the connections alive, like Airtable, so the pooled sessions of the lambdas reuse them
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    # body is JSON already encoded as bytes, or anything to encode as JSON
+    def send_json(self, status_code, body, headers=None):
+        data = body if isinstance(body, bytes) else json.dumps(body).encode()
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return {}
+        try:
+            return json.loads(self.rfile.read(length))
+        except ValueError:
+            raise AirtableError(422, 'INVALID_REQUEST_BODY', "Could not parse the request body as JSON")
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_PATCH(self):
+        self.handle_request('PATCH')
+
+    def handle_request(self, method):
+        server = self.server
+        url = urlsplit(self.path)
+        parts = [unquote(part) for part in url.path.strip('/').split('/')]
+        # The body is read before anything is answered, so the connection can be kept alive
+        try:
+            body = self.read_json() if method != 'GET' else {}
+        except AirtableError as e:
+            self.send_json(e.status_code, e.body)
+            return
+        if parts == ['_stats']:
+            with server.stats_lock:
+                stats = json.dumps(server.stats).encode()
+            self.send_json(200, stats)
+            return
+
+        # Requests are counted as they come in, before the latency, so a client can tell when its requests went out
+        server.count_request(method)
+        server.delay()
+        if not self.headers.get('Authorization', '').startswith('Bearer '):
+            self.send_json(401, error_body('AUTHENTICATION_REQUIRED', "Authentication required"))
+            return
+        if len(parts) < 3 or parts[0] != 'v0':
+            self.send_json(404, error_body('NOT_FOUND', f"Could not find {url.path}"))
+            return
+        base_id = parts[3] if parts[1:3] == ['meta', 'bases'] else parts[1]
+        if server.throttled(base_id):
+            server.count('throttled')
+            headers = {'Retry-After': str(server.settings.retry_after)} if server.settings.retry_after is not None else None
+            self.send_json(429, {'errors': [{'error': 'RATE_LIMIT_REACHED', 'message': "Rate limit exceeded. Please try again later"}]}, headers)
+            return
+
+        # The response is encoded while the store is locked, as it holds the records themselves
+        try:
+            with server.store.lock:
+                if parts[1:3] == ['meta', 'bases']:
+                    status_code, response = self.meta(method, base_id, parts[4:], body)
+                else:
+                    status_code, response = self.records(method, base_id, parts[2:], parse_qs(url.query), body)
+                response = json.dumps(response).encode()
+        except AirtableError as e:
+            self.send_json(e.status_code, e.body)
+            return
+        self.send_json(status_code, response)
+
+    def meta(self, method, base_id, parts, body):
+        store = self.server.store
+        if parts == ['tables'] and method == 'GET':
+            return 200, {'tables': [table.meta() for table in store.tables(base_id).values()]}
+        if parts == ['tables'] and method == 'POST':
+            return 200, store.create_table(base_id, body.get('name'), body.get('fields')).meta()
+        if len(parts) == 3 and parts[0] == 'tables' and parts[2] == 'fields' and method == 'POST':
+            return 200, store.create_field(store.table(base_id, parts[1]), body)
+        raise AirtableError(404, 'NOT_FOUND', f"Could not find {method} {self.path}")
+
+    def records(self, method, base_id, parts, query, body):
+        store = self.server.store
+        if len(parts) != 1:
+            raise AirtableError(404, 'NOT_FOUND', f"Could not find {method} {self.path}")
+        table = store.table(base_id, parts[0])
+        if method == 'GET':
+            return 200, self.list_records(table, query)
+
+        records = body.get('records')
+        if not isinstance(records, list) or not records or len(records) > MAX_RECORDS_PER_REQUEST:
+            raise AirtableError(422, 'INVALID_RECORDS', f"Send 1 to {MAX_RECORDS_PER_REQUEST} records per request")
+        # Every record is checked before any of them is written, a request is written whole or not at all
+        fields = [store.stored_fields(table, record.get('fields', {})) for record in records]
+        if method == 'POST':
+            created = [store.create_record(table, record_fields) for record_fields in fields]
+            self.server.count('records_created', len(created))
+            return 200, {'records': created}
+
+        if 'performUpsert' in body:
+            merge_fields = tuple(body['performUpsert'].get('fieldsToMergeOn') or ())
+            if not merge_fields or any(table.field(name) is None for name in merge_fields):
+                raise AirtableError(422, 'INVALID_FIELDS_TO_MERGE_ON', f"Invalid fieldsToMergeOn: {list(merge_fields)}")
+            index = table.index(merge_fields)
+            result = {'records': [], 'createdRecords': [], 'updatedRecords': []}
+            for record_fields in fields:
+                record = index.get(index_key({'fields': record_fields}, merge_fields))
+                if record is None:
+                    record = store.create_record(table, record_fields)
+                    result['createdRecords'].append(record['id'])
+                else:
+                    store.set_fields(table, record, record_fields)
+                    result['updatedRecords'].append(record['id'])
+                result['records'].append(record)
+            self.server.count('records_created', len(result['createdRecords']))
+            self.server.count('records_updated', len(result['updatedRecords']))
+            return 200, result
+
+        for record in records:
+            if record.get('id') not in table.records_by_id:
+                raise AirtableError(404, 'ROW_DOES_NOT_EXIST', f"Record {record.get('id')} does not exist in {table.name}")
+        updated = []
+        for record, record_fields in zip(records, fields):
+            stored = table.records_by_id[record['id']]
+            store.set_fields(table, stored, record_fields)
+            updated.append(stored)
+        self.server.count('records_updated', len(updated))
+        return 200, {'records': updated}
+
+    def list_records(self, table, query):
+        try:
+            page_size = min(int(query.get('pageSize', [PAGE_SIZE])[0]), PAGE_SIZE)
+            start = int(query.get('offset', [0])[0])
+        except ValueError:
+            raise AirtableError(422, 'LIST_RECORDS_ITERATOR_NOT_AVAILABLE', "Invalid pageSize or offset")
+        fields = query.get('fields[]')
+        page = table.records[start:start + page_size]
+        if fields is not None:
+            page = [{**record, 'fields': {name: value for name, value in record['fields'].items() if name in fields}} for record in page]
+        response = {'records': page}
+        if start + page_size < len(table.records):
+            response['offset'] = str(start + page_size)
+        self.server.count('records_listed', len(page))
+        return response
+
+def main():
+    parser = argparse.ArgumentParser(description='A local stand-in for the Airtable REST API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every request')
+    parser.add_argument('--jitter', type=float, default=0.0, help='the latency varies at random by up to this many seconds either way')
+    parser.add_argument('--rate-limit', type=float, default=REQUESTS_PER_SECOND, help='requests per second per base before 429, 0 for no limit')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='share of requests answered 429 at random')
+    parser.add_argument('--retry-after', type=float, default=None, help='Retry-After seconds sent with a 429 (Airtable sends none)')
+    parser.add_argument('--seed', type=int, default=None, help='seed for the latency jitter and the random 429s')
+    args = parser.parse_args()
+
+    settings = Settings(args.latency, args.jitter, args.rate_limit, args.throttle_rate, args.retry_after, args.seed)
+    server = AirtableStandIn((args.host, args.port), settings)
+    print(f"Airtable stand-in at {server.api_root}, set AIRTABLE_API_ROOT to that")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+import argparse
+import contextlib
+import hashlib
+import io
+import os
+import sys
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+import Bio_growth
+import growth_engine
+try:
+    import resource
+except ImportError:
+    #resource is not available on Windows, we then leave out the peak memory
+    resource = None
+
+# Benchmark of Bio_growth on synthetic forests, timing every stage from load_data through calculate_volume_at_maturity.
+# Run it from this folder, next to the Bonitetstabell CSVs, like local_model.py:
+#   python benchmark_Bio_growth.py                      # sizes 10 to 100000, checked against the golden output
+#   python benchmark_Bio_growth.py --sizes 1000 10000   # only some sizes
+#   python benchmark_Bio_growth.py --update-golden      # pin the current results as the golden output
+# The golden output is the result of Bio_growth.main for one fixed synthetic forest. The one next to this script was made with
+# the original pandas Bio_growth, from before the engine was vectorized, so every change is compared on both speed and numeric
+# equality with the model as it was. Only pin a new one for a change that is meant to change the results.
+# The results also depend on the Bonitetstabell CSVs, which are not in the repository, so the golden output holds a hash of the bonitet
+# tables it was made with. With other tables the output is not compared, as it would differ whether or not the model changed.
+# The exit code is 1 if the output differs from the golden output, and 2 if it could not be compared because the bonitet tables differ
+
+SIZES = [10, 100, 1000, 10000, 100000]
+GOLDEN_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_Bio_growth_golden.npz')
+GOLDEN_SIZE = 2000
+GOLDEN_SEED = 0
+# Results may differ in the last few bits between numpy builds, but not more than this
+GOLDEN_RTOL = 1e-9
+# The entry of the golden file holding bonitet_tables_hash of the tables it was made with, which is not a column of the output
+GOLDEN_TABLES_KEY = 'bonitet_tables_sha256'
+
+# The H40 bonitet classes used in the bonitet tables
+BONITETS = [6, 8, 11, 14, 17, 20, 23, 26]
+
+# A synthetic bestandsdata frame, with the columns the model reads from Airtable.
+# The distributions roughly follow what we see in SR16 for forests in Eastern Norway: mostly gran and furu, stands of all ages,
+# heights that follow the age and bonitet of the stand, fewer but thicker trees in older stands, and SR16 values rounded like SR16 rounds them.
+# Some stands have no age or no SR16 values, as they do in the real tables
+def synthetic_bestandsdata(n_stands, seed=0):
+    rng = np.random.default_rng(seed)
+    treslag = rng.choice(['Gran', 'Furu', 'Bjørk / lauv'], n_stands, p=[0.5, 0.35, 0.15])
+    bonitet = rng.choice(BONITETS, n_stands, p=[0.04, 0.1, 0.2, 0.24, 0.2, 0.12, 0.07, 0.03])
+    alder = np.clip(np.round(rng.gamma(2.2, 25, n_stands)), 1, 160)
+    # Height follows a saturating curve towards roughly the bonitet at old ages
+    height = bonitet * 1.3 * (1 - np.exp(-alder / 45)) * rng.lognormal(0, 0.15, n_stands)
+    N_per_hectare = 3000 * np.exp(-alder / 60) * rng.lognormal(0, 0.25, n_stands) + 150
+    G = np.clip(45 * (1 - np.exp(-alder / 40)) * rng.lognormal(0, 0.25, n_stands), 0.5, 70)
+    volume = 0.45 * G * height * rng.lognormal(0, 0.1, n_stands)
+    hogstkl_verdi = np.select([alder < 10, alder < 30, alder < 50, alder < 80], [1, 2, 3, 4], 5)
+
+    df = pd.DataFrame({
+        'bestand_id': [f'bench_{i}' for i in range(n_stands)],
+        'hogstkl_verdi': hogstkl_verdi,
+        'bonitet': bonitet,
+        'treslag': treslag,
+        'arealm2': np.round(rng.lognormal(8.5, 1.0, n_stands)),
+        'alder': alder,
+        # SR16 gives the height in decimeters, the number of trees and the volumes as whole numbers and the base area with one decimal
+        'srhoydeo': np.round(height * 10),
+        'srtrean': np.round(N_per_hectare),
+        'srgrflate': np.round(G, 1),
+        'srvolmb': np.round(volume),
+        'srvolub': np.round(volume * Bio_growth.adjustment_factor_bark),
+    })
+    df.loc[rng.random(n_stands) < 0.03, 'alder'] = np.nan
+    df.loc[rng.random(n_stands) < 0.02, ['srhoydeo', 'srtrean', 'srgrflate', 'srvolmb', 'srvolub']] = np.nan
+    return df
+
+# Runs one stage, returning its result, the wall time in seconds and the peak memory it allocated in MB.
+# The log lines of the model are left out of the output
+def run_stage(function, *args, **kwargs):
+    tracemalloc.start()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = function(*args, **kwargs)
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] / 1e6
+    tracemalloc.stop()
+    return result, seconds, peak
+
+# Times the stages of the model for one forest. The stages after load_data and the current year values are timed twice:
+# as main runs them (simulate_stands) and one by one through the calculate_future_* functions with their 100 year matrices
+def benchmark(df):
+    stages = {}
+    df_bestander, *stages['load_data'] = run_stage(Bio_growth.load_data, df, None)
+    columns = {name: df_bestander[name].to_numpy() for name in growth_engine.CURRENT_YEAR_COLUMNS}
+    _, *stages['current_year_growth'] = run_stage(growth_engine.current_year_growth, columns)
+    df_out, *stages['main'] = run_stage(Bio_growth.main, df)
+
+    simulation_columns = {name: df_out[name].to_numpy() for name in growth_engine.SIMULATION_COLUMNS}
+    _, *stages['simulate_stands'] = run_stage(growth_engine.simulate_stands, simulation_columns)
+
+    df_stands = df_out.copy()
+    gran_filter = df_stands['treslag'] == 'Gran'
+    furu_filter = df_stands['treslag'] == 'Furu'
+    heights, *stages['calculate_future_heights'] = run_stage(Bio_growth.calculate_future_heights, df_stands, gran_filter, furu_filter)
+    densities, *stages['calculate_future_N_per_hectare'] = run_stage(Bio_growth.calculate_future_N_per_hectare, df_stands, heights, gran_filter, furu_filter)
+    base_areas, *stages['calculate_future_base_area'] = run_stage(Bio_growth.calculate_future_base_area, df_stands, heights, densities, gran_filter, furu_filter)
+    volumes, *stages['calculate_future_volume_per_hectare'] = run_stage(Bio_growth.calculate_future_volume_per_hectare, df_stands, heights, base_areas, gran_filter, furu_filter)
+    growth_rates, *stages['calculate_future_growth_rate'] = run_stage(Bio_growth.calculate_future_growth_rate, volumes)
+    _, *stages['calculate_years_to_maturity'] = run_stage(Bio_growth.calculate_years_to_maturity, df_stands, growth_rates)
+    _, *stages['calculate_volume_at_maturity'] = run_stage(Bio_growth.calculate_volume_at_maturity, df_stands, volumes)
+    return df_out, stages
+
+# The numeric and text columns of the model output, as arrays that can be saved with np.savez
+def output_arrays(df_out):
+    return {column: df_out[column].to_numpy(dtype=float if df_out[column].dtype.kind in 'biuf' else str) for column in df_out.columns}
+
+# A hash of the Ht40 values of the bonitet tables the model reads from this folder (see growth_engine.load_bonitet_tables).
+# Only the H40 and Ht40 columns of the CSVs are used, so other changes to them give the same hash
+def bonitet_tables_hash():
+    tables = growth_engine.load_bonitet_tables()
+    digest = hashlib.sha256()
+    for species in sorted(tables):
+        digest.update(species.encode())
+        digest.update(np.ascontiguousarray(tables[species], dtype=float).tobytes())
+    return digest.hexdigest()
+
+def update_golden(path):
+    df_out = run_stage(Bio_growth.main, synthetic_bestandsdata(GOLDEN_SIZE, GOLDEN_SEED))[0]
+    np.savez_compressed(path, **output_arrays(df_out), **{GOLDEN_TABLES_KEY: np.array(bonitet_tables_hash())})
+    print(f"Pinned the output for {GOLDEN_SIZE} stands (seed {GOLDEN_SEED}) in {path}")
+
+# Compares the output of main for the golden forest with the pinned output. Returns True if they match, and None if they can't be
+# compared because the golden output was made with other bonitet tables
+def check_golden(path):
+    with np.load(path) as golden:
+        if GOLDEN_TABLES_KEY in golden.files and str(golden[GOLDEN_TABLES_KEY]) != bonitet_tables_hash():
+            print(f"  The bonitet tables in this folder (sha256 {bonitet_tables_hash()}) are not the ones the golden output was made with")
+            print(f"  (sha256 {golden[GOLDEN_TABLES_KEY]}), so the output can't be compared with it")
+            return None
+    df_out = run_stage(Bio_growth.main, synthetic_bestandsdata(GOLDEN_SIZE, GOLDEN_SEED))[0]
+    current = output_arrays(df_out)
+    matches = True
+    with np.load(path) as golden:
+        for column in golden.files:
+            if column == GOLDEN_TABLES_KEY:
+                continue
+            if column not in current:
+                print(f"  {column}: missing from the output")
+                matches = False
+            elif golden[column].dtype.kind == 'f':
+                close = np.isclose(current[column], golden[column], rtol=GOLDEN_RTOL, atol=0, equal_nan=True)
+                if not close.all():
+                    with np.errstate(all='ignore'):
+                        difference = np.nanmax(np.abs(current[column] - golden[column]) / np.abs(golden[column]))
+                    print(f"  {column}: {np.count_nonzero(~close)} stands differ, largest relative difference {difference:.3g}")
+                    matches = False
+            elif not np.array_equal(current[column], golden[column]):
+                print(f"  {column}: values differ")
+                matches = False
+        for column in current:
+            if column not in golden.files:
+                print(f"  {column}: new column, not in the golden output")
+    return matches
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark Bio_growth on synthetic forests')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help='number of stands in each synthetic forest')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--golden', default=GOLDEN_FILE, help='file with the pinned golden output')
+    parser.add_argument('--update-golden', action='store_true', help='pin the current output as the golden output and exit')
+    args = parser.parse_args()
+
+    if args.update_golden:
+        update_golden(args.golden)
+        return
+
+    # Without the golden output there is nothing to check the results against, which is a failure rather than something to skip
+    if not os.path.exists(args.golden):
+        print(f"No golden output in {args.golden}, it comes with the repository")
+        sys.exit(1)
+    print(f"Checking the output against {args.golden}")
+    golden_matches = check_golden(args.golden)
+    print("Golden output: " + {True: "OK", False: "DIFFERENT", None: "NOT CHECKED, other bonitet tables"}[golden_matches])
+
+    for n_stands in args.sizes:
+        df = synthetic_bestandsdata(n_stands, args.seed)
+        # The first run also pays for imports and caches, so we only report the second
+        benchmark(df)
+        df_out, stages = benchmark(df)
+        print(f"\n{n_stands} stands")
+        print(f"  {'stage':<38}{'seconds':>10}{'stands/s':>12}{'peak MB':>10}")
+        for stage, (seconds, peak) in stages.items():
+            print(f"  {stage:<38}{seconds:>10.4f}{n_stands / seconds:>12.0f}{peak:>10.1f}")
+    # ru_maxrss is in kilobytes on Linux
+    if resource is not None:
+        print(f"\nPeak resident memory of the process: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB")
+    # A failing exit code, so the benchmark can be used to check a change
+    if golden_matches is None:
+        sys.exit(2)
+    if not golden_matches:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
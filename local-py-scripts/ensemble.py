@@ -0,0 +1,64 @@
+import numpy as np
+import growth_model
+
+#Uncertainty bands for the results of the model. The SR16 values a stand starts out from are estimates, so instead of one run
+#we run many samples of every stand with the SR16 values perturbed, and report percentiles of the results over the samples.
+#The samples of all stands are laid out as one larger forest (every stand repeated n_samples times) and run by growth_model.run,
+#so the cost is array work on n_stands x n_samples stands rather than a loop over the samples
+
+#Relative standard error of the SR16 values we perturb. These are rough figures for SR16 at stand level,
+#height is estimated best and the number of trees worst
+SR16_RELATIVE_ERRORS = {
+    'srhoydeo': 0.10,
+    'srtrean': 0.30,
+    'srgrflate': 0.20,
+}
+
+#The results we report bands for
+ENSEMBLE_COLUMNS = ('volume', 'carbon_stored', 'years_to_maturity')
+
+PERCENTILES = (5, 50, 95)
+
+#The largest number of stand samples run at a time. Each of them takes roughly 1 kB while it is run
+CHUNK_SIZE = 200000
+
+#Name of the column holding a percentile of a result, e.g. volume_p95
+def band_column(column, percentile):
+    return f"{column}_p{percentile:g}"
+
+#The columns of stands repeated n_samples times each, with the relative_errors columns multiplied by lognormal noise with mean 1
+def sample_stands(columns, n_samples, relative_errors, rng):
+    samples = {name: np.repeat(np.asarray(values), n_samples) for name, values in columns.items()}
+    for name, relative_error in relative_errors.items():
+        sigma = np.sqrt(np.log(1 + relative_error ** 2))
+        noise = np.exp(rng.standard_normal(len(samples[name])) * sigma - sigma ** 2 / 2)
+        samples[name] = growth_model.numbers(samples[name]) * noise
+    return samples
+
+#Percentile bands of the ENSEMBLE_COLUMNS for the stands in columns (a dict with bestand_id and the INPUT_COLUMNS, like growth_model.run takes).
+#Every stand is run n_samples times with the SR16 values perturbed by relative_errors. Returns bestand_id and a band_column for every
+#result and percentile. Samples where a result is missing are left out of its percentiles, stands without any get np.nan.
+#The stands are run in chunks of at most chunk_size stand samples, to bound the memory. The samples are reproducible for the same seed and chunk_size
+def ensemble_bands(columns, n_samples=100, yield_requirement=0.03, percentiles=PERCENTILES, relative_errors=SR16_RELATIVE_ERRORS, seed=0, chunk_size=CHUNK_SIZE, forestID=None, **kwargs):
+    rng = np.random.default_rng(seed)
+    n_stands = len(columns['bestand_id'])
+    bands = {'bestand_id': np.asarray(columns['bestand_id'])}
+    for column in ENSEMBLE_COLUMNS:
+        for percentile in percentiles:
+            bands[band_column(column, percentile)] = np.full(n_stands, np.nan)
+
+    stands_per_chunk = max(1, chunk_size // n_samples)
+    for start in range(0, n_stands, stands_per_chunk):
+        stop = min(start + stands_per_chunk, n_stands)
+        growth_model.log(forestID, f"Bio_growth: Running {n_samples} samples of stands {start} to {stop} of {n_stands}")
+        chunk = {name: np.asarray(values)[start:stop] for name, values in columns.items()}
+        samples = growth_model.run(sample_stands(chunk, n_samples, relative_errors, rng), yield_requirement, forestID=forestID, **kwargs)
+        for column in ENSEMBLE_COLUMNS:
+            values = samples[column].reshape(stop - start, n_samples)
+            #Stands where every sample is np.nan keep np.nan
+            with_values = ~np.isnan(values).all(axis=1)
+            if with_values.any():
+                chunk_bands = np.nanpercentile(values[with_values], percentiles, axis=1)
+                for percentile, band in zip(percentiles, chunk_bands):
+                    bands[band_column(column, percentile)][start:stop][with_values] = band
+    return bands
@@ -0,0 +1,501 @@
+import csv
+import os
+import numpy as np
+
+#Array versions of the growth formulas in Bio_growth.
+#Every argument is either a scalar or an array with one value per stand, so a whole forest
+#can be advanced one year at a time with a handful of numpy calls instead of one Python call per stand and year.
+#The guards of the scalar functions (A1 < 3, G2 < 0, A2 <= 0) are applied as masks and give np.nan, exactly like the scalar versions.
+
+#The default projection horizon in years
+HORIZON = 100
+
+#Version of the model coefficients and formulas. Results stored outside the process (see trajectory_cache) are tied to it,
+#so bump it whenever a coefficient or formula that changes the trajectories is changed
+MODEL_VERSION = 1
+
+#The H40 bonitet tables with the Ht40 for each bonitet, per species. Like the rest of the model they are read from the working directory
+BONITET_TABLE_FILES = {
+    'Gran': 'Bonitetstabell_calculations-Gran_H40.csv',
+    'Furu': 'Bonitetstabell_calculations-Furu_H40.csv',
+}
+#The same tables compiled into dense arrays by build_bonitet_tables.py, used instead of the CSVs when it is there
+BONITET_TABLES_FILE = 'bonitet_tables.npz'
+
+#Reads a bonitet table CSV into a dense array indexed by bonitet, holding the Ht40 of that bonitet and np.nan for bonitets not in the table
+def _read_bonitet_csv(path):
+    with open(path, newline='') as file:
+        rows = [(row['H40'], row['Ht40']) for row in csv.DictReader(file)]
+    H40 = np.array([float(h40) for h40, Ht40 in rows])
+    if np.any(H40 != np.floor(H40)) or np.any(H40 < 0):
+        raise ValueError(f"{path}: H40 must be whole non-negative bonitets to be used as an index")
+    table = np.full(int(H40.max()) + 1, np.nan)
+    for h40, Ht40 in zip(H40.astype(int), (row[1] for row in rows)):
+        try:
+            table[h40] = float(Ht40)
+        except ValueError:
+            table[h40] = np.nan
+    return table
+
+#Loads the bonitet tables, from the prebuilt BONITET_TABLES_FILE if there is one and otherwise from the CSVs
+def load_bonitet_tables(directory=''):
+    prebuilt = os.path.join(directory, BONITET_TABLES_FILE)
+    if os.path.exists(prebuilt):
+        with np.load(prebuilt) as tables:
+            return {species: tables[species] for species in BONITET_TABLE_FILES}
+    return {species: _read_bonitet_csv(os.path.join(directory, file_name)) for species, file_name in BONITET_TABLE_FILES.items()}
+
+#The tables are loaded once per container, at import if the files are there and otherwise on first use
+try:
+    _bonitet_tables = load_bonitet_tables()
+except FileNotFoundError:
+    _bonitet_tables = None
+
+def get_bonitet_tables():
+    global _bonitet_tables
+    if _bonitet_tables is None:
+        _bonitet_tables = load_bonitet_tables()
+    return _bonitet_tables
+
+#Ht40 of each stand, looked up in the bonitet table of its species. Other species and bonitets not in the table get np.nan
+def lookup_Ht40(treslag, bonitet, tables=None):
+    if tables is None:
+        tables = get_bonitet_tables()
+    treslag = np.asarray(treslag)
+    bonitet = np.asarray(bonitet, dtype=float)
+    Ht40 = np.full(len(bonitet), np.nan)
+    with np.errstate(invalid='ignore'):
+        whole_bonitet = (bonitet == np.floor(bonitet)) & (bonitet >= 0)
+    for species, table in tables.items():
+        rows = (treslag == species) & whole_bonitet & (bonitet < len(table))
+        Ht40[rows] = table[bonitet[rows].astype(int)]
+    return Ht40
+
+#Height of a stand of Furu at time A2, starting out at height H01 at time A1
+def func_furu_H02_array(H01, A1, A2):
+    with np.errstate(all='ignore'):
+        X0_numerator = H01 - 68.418
+        X0_denominator = 1 + (24.041 * H01 * (A1 ** -1.470))
+        X0 = X0_numerator / X0_denominator
+        H02 = (68.418 + X0) / (1 - 24.041 * X0 * A2 ** - 1.470)
+    #If the starting age is <3 then we return np.nan
+    return np.where(A1 < 3, np.nan, H02)
+
+#Height of a stand of Gran at time A2, starting out at height H01 at time A1
+def func_gran_H02_array(H01, A1, A2):
+    with np.errstate(all='ignore'):
+        L = np.log(1 - np.exp(-0.016 * A1))
+        X0 = 0.5 * (np.log(H01) + 0.612 * L + np.sqrt(np.log(H01) + 0.612 * L) ** 2 - 4 * 4.437 * L)
+        H02 = H01 * ((1 - np.exp(-0.016 * A2)) / (1 - np.exp(-0.016 * A1))) ** (0.612 + 4.437 / X0)
+    #The formula for gran only works for stands that are over 7m, shorter stands use the furu formula (see func_gran_H02)
+    H02 = np.where(H01 < 7, func_furu_H02_array(H01, A1, A2), H02)
+    return np.where(A1 < 3, np.nan, H02)
+
+#Change in the number of trees per hectare, see gran_N2_per_hectare
+def gran_N2_per_hectare_array(N1_per_hectare, A1, A2, Ht40, GE=1, GF=1):
+    with np.errstate(all='ignore'):
+        numerator = N1_per_hectare ** -1.009 + (0.037 * (GE / GF) * ((Ht40 / 1000) ** 3.762) * (A2 ** 2.554 - A1 ** 2.544))
+        N2_per_hectare = numerator ** (1 / -1.010)
+    return np.where(A1 < 3, np.nan, N2_per_hectare)
+
+#Change in the number of trees per hectare, see furu_N2_per_hectare
+def furu_N2_per_hectare_array(N1_per_hectare, A1, A2, Ht40, GE=1, GF=1):
+    with np.errstate(all='ignore'):
+        numerator = N1_per_hectare ** -1.569 + (0.003 * (GE / GF) * ((Ht40 / 10000) ** 4.148) * (A2 ** 4.877 - A1 ** 4.877))
+        N2_per_hectare = numerator ** (1 / -1.569)
+    return np.where(A1 < 3, np.nan, N2_per_hectare)
+
+#Base area growth, see gran_basearea_growth
+def gran_basearea_growth_array(G1, N_per_hectare, N2_per_hectare, HO1, HO2, HOT=0, GE=1, GF=1):
+    with np.errstate(all='ignore'):
+        growth_factor = 4.777 * (N2_per_hectare / N_per_hectare)**0.310 * (1 - HO1 / HO2) * (GE / GF)**(-0.148 * HOT / HO2)
+        G2 = G1**(HO1 / HO2) * np.exp(growth_factor)
+    return G2
+
+#Base area growth, see furu_basearea_growth
+def furu_basearea_growth_array(G1, A1, A2, HO1, HO2, N_per_hectare, N2_per_hectare, GE=1, GF=1, AT=1):
+    with np.errstate(all='ignore'):
+        term1 = (A1 / A2) * np.log(G1)
+        term2 = 1.466 * (1 - (A1 / A2))
+        term3 = 0.525 * (np.log(HO2) - (A1 / A2) * np.log(HO1))
+        term4 = 0.177 * (np.log(N2_per_hectare) - (A1 / A2) * np.log(N_per_hectare))
+        term5 = 16.538 * ((np.log(N2_per_hectare) - np.log(N_per_hectare)) / A2)
+        term6 = -386.717 * (((GF - GE) / GF) / AT * (1 / A2 - 1 / A1))
+        G2 = np.exp(term1 + term2 + term3 + term4 + term5 + term6)
+    return G2
+
+#Volume per hectare, see gran_volume
+def gran_volume_array(G2, HO2, A2):
+    with np.errstate(all='ignore'):
+        V_per_hectare = 0.250 * (G2**1.150) * (HO2**1.012) * np.exp(2.320 / A2)
+    return np.where((A2 <= 0) | (G2 < 0), np.nan, V_per_hectare)
+
+#Volume per hectare, see furu_volume
+def furu_volume_array(G2, HO2, A2, GE=1, GF=1, AT=0):
+    with np.errstate(all='ignore'):
+        V_per_hectare = 0.654 * (G2**0.969) * (HO2**0.915) * np.exp(-2.053 / A2) * ((GE / GF)**(-0.069 * (AT / A2)))
+    return np.where((A2 <= 0) | (G2 < 0), np.nan, V_per_hectare)
+
+#Saw wood portion of the stands, see saw_wood_portion in Bio_growth
+def saw_wood_portion_array(treslag, bonitet):
+    bonitet = np.asarray(bonitet, dtype=float)
+    with np.errstate(invalid='ignore'):
+        portion = np.where(bonitet >= 20, 0.7, 0.5 + (0.2/12) * bonitet)
+    #We only have saw wood prices for Gran and Furu, for bjørk the saw wood portion is 0
+    return np.where(np.asarray(treslag) == 'Bjørk / lauv', 0.0, portion)
+
+#The columns current_year_growth needs
+CURRENT_YEAR_COLUMNS = ('treslag', 'alder', 'Ht40', 'height', 'N_per_hectare', 'G1')
+
+#The growth over the coming year for each stand, computed for all stands at once from a dict of CURRENT_YEAR_COLUMNS arrays.
+#Returns the arrays for yearly_height_growth, delta_N_per_hectare, G2, volume_per_hectare (np.nan where the formulas don't apply,
+#before falling back on SR16) and volume_per_hectare_next_year. Only Gran and Furu get values, and density, base area and
+#current volume are skipped for stands under 5 years, like the row by row functions in Bio_growth
+def current_year_growth(columns):
+    treslag = np.asarray(columns['treslag'])
+    alder = np.asarray(columns['alder'], dtype=float)
+    Ht40 = np.asarray(columns['Ht40'], dtype=float)
+    height = np.asarray(columns['height'], dtype=float)
+    N_per_hectare = np.asarray(columns['N_per_hectare'], dtype=float)
+    G1 = np.asarray(columns['G1'], dtype=float)
+
+    gran = treslag == 'Gran'
+    furu = treslag == 'Furu'
+    with np.errstate(invalid='ignore'):
+        young = alder < 5
+    gran_grown = gran & ~young
+    furu_grown = furu & ~young
+    next_age = alder + 1
+
+    yearly_height_growth = np.select([gran, furu], [func_gran_H02_array(height, alder, next_age), func_furu_H02_array(height, alder, next_age)], np.nan) - height
+    next_height = height + yearly_height_growth
+    delta_N_per_hectare = np.select([gran_grown, furu_grown], [
+        gran_N2_per_hectare_array(N_per_hectare, alder, next_age, Ht40),
+        furu_N2_per_hectare_array(N_per_hectare, alder, next_age, Ht40),
+        ], np.nan) - N_per_hectare
+    next_N_per_hectare = N_per_hectare + delta_N_per_hectare
+    G2 = np.select([gran_grown, furu_grown], [
+        gran_basearea_growth_array(G1, N_per_hectare, next_N_per_hectare, height, next_height),
+        furu_basearea_growth_array(G1, alder, next_age, height, next_height, N_per_hectare, next_N_per_hectare),
+        ], np.nan)
+    volume_per_hectare = np.select([gran_grown, furu_grown], [gran_volume_array(G1, height, alder), furu_volume_array(G1, height, alder)], np.nan)
+    volume_per_hectare_next_year = np.select([gran, furu], [gran_volume_array(G2, next_height, next_age), furu_volume_array(G2, next_height, next_age)], np.nan)
+
+    return {
+        'yearly_height_growth': yearly_height_growth,
+        'delta_N_per_hectare': delta_N_per_hectare,
+        'G2': G2,
+        'volume_per_hectare': volume_per_hectare,
+        'volume_per_hectare_next_year': volume_per_hectare_next_year,
+    }
+
+
+#The quantities we keep a stands x years trajectory for
+TRAJECTORY_QUANTITIES = ('height', 'N_per_hectare', 'G', 'volume_per_hectare', 'growth_rate')
+
+#Preallocates one stands x (horizon+1) matrix per quantity, column 0 being the starting year.
+#The matrices are stored column by column (Fortran order) since we fill one year at a time.
+#dtype=np.float32 halves the memory for very large forests, at the cost of some precision in the trajectories
+def allocate_trajectories(n_stands, horizon=HORIZON, dtype=np.float64, quantities=TRAJECTORY_QUANTITIES):
+    return {quantity: np.full((n_stands, horizon + 1), np.nan, dtype=dtype, order='F') for quantity in quantities}
+
+#Sets up a stands x years matrix (a new one, or out from allocate_trajectories) with the starting values in column 0.
+#The other columns stay np.nan for the stands we skip
+def _new_projection(start_values, horizon, out=None):
+    if out is None:
+        out = allocate_trajectories(len(start_values), horizon, quantities=('projection',))['projection']
+    else:
+        out[:, 1:] = np.nan
+    out[:, 0] = start_values
+    return out
+
+#Future heights of the stands. gran_mask and furu_mask select the stands to project, all other stands stay np.nan after year 0
+#When out is given the projection is written into it, otherwise a new matrix is allocated. The same goes for the other project_* functions
+def project_heights(height, alder, gran_mask, furu_mask, horizon=HORIZON, out=None):
+    heights = _new_projection(height, horizon, out)
+    gran_idx = np.flatnonzero(gran_mask)
+    furu_idx = np.flatnonzero(furu_mask)
+    for year in range(1, heights.shape[1]):
+        heights[gran_idx, year] = func_gran_H02_array(heights[gran_idx, year - 1], alder[gran_idx] + year - 1, alder[gran_idx] + year)
+        heights[furu_idx, year] = func_furu_H02_array(heights[furu_idx, year - 1], alder[furu_idx] + year - 1, alder[furu_idx] + year)
+    return heights
+
+#The gran height formula only applies from 7m, shorter gran stands follow the furu curve (see func_gran_H02)
+GRAN_MIN_HEIGHT = 7
+
+#Number of whole years until a stand following the furu curve from (H01, A1) is at least target_height tall.
+#0 for stands that already are, np.inf for stands whose curve never gets there
+def _furu_years_to_height(H01, A1, target_height):
+    with np.errstate(all='ignore'):
+        X0 = (H01 - 68.418) / (1 + (24.041 * H01 * (A1 ** -1.470)))
+        #func_furu_H02 solved for the age at which the height equals target_height
+        age_at_target = ((1 - (68.418 + X0) / target_height) / (24.041 * X0)) ** (1 / -1.470)
+        years = np.maximum(np.ceil(age_at_target - A1), 1)
+    years = np.where(np.isnan(years), np.inf, years)
+    #Correct for rounding right at the boundary, the yearly chaining decides on the heights at whole years
+    finite = np.isfinite(years)
+    step_back = finite & (years > 1) & (func_furu_H02_array(H01, A1, A1 + years - 1) >= target_height)
+    step_forward = finite & (func_furu_H02_array(H01, A1, A1 + years) < target_height)
+    years = years - step_back + step_forward
+    return np.where(H01 >= target_height, 0, years)
+
+#Point from which a gran stand follows the gran curve: stands below 7m follow the furu curve up to the first whole year they reach 7m
+#and the gran curve anchored at that point afterwards, stands of 7m or more follow the gran curve from where they are now
+def _gran_anchor(H01, A1):
+    years_on_furu = _furu_years_to_height(H01, A1, GRAN_MIN_HEIGHT)
+    anchor_age = A1 + np.where(np.isfinite(years_on_furu), years_on_furu, 0)
+    anchor_height = np.where(years_on_furu > 0, func_furu_H02_array(H01, A1, anchor_age), H01)
+    return years_on_furu, anchor_age, anchor_height
+
+#Gran heights evaluated straight from the starting point (and the anchor from _gran_anchor) instead of year by year.
+#The arguments broadcast, so years can be a single year or one row of years for all stands
+def _direct_gran_height(H01, A1, anchor, years):
+    years_on_furu, anchor_age, anchor_height = anchor
+    A2 = A1 + years
+    heights = np.where(years <= years_on_furu, func_furu_H02_array(H01, A1, A2), func_gran_H02_array(anchor_height, anchor_age, A2))
+    #Like the yearly chaining, stands younger than 3 years get no future heights
+    return np.where((A1 < 3) & (years > 0), np.nan, heights)
+
+#Heights of the stands at any set of whole years from now, e.g. np.arange(101), np.arange(301) or [10, 50, 300].
+#The furu curve is anchored: the height at age A2 only depends on (H01, A1, A2), so every target year is evaluated
+#straight from the starting height and age in one broadcast, without chaining year by year.
+#func_gran_H02 as coded is not anchored (one jump does not give the same height as yearly steps), so by default gran stands
+#are still advanced one year at a time up to the last target year. direct_gran=True evaluates them in one broadcast as well,
+#which is faster but does not reproduce the yearly chaining the rest of the model uses.
+#Stands outside gran_mask and furu_mask keep their starting height in year 0 and np.nan otherwise, like project_heights
+def height_trajectory(height, alder, gran_mask, furu_mask, years, direct_gran=False, out=None):
+    years = np.asarray(years, dtype=int)
+    if out is None:
+        out = np.empty((len(height), len(years)), order='F')
+    out[:] = np.nan
+    out[:, years == 0] = height[:, None]
+
+    furu_idx = np.flatnonzero(furu_mask)
+    later = years > 0
+    out[np.ix_(furu_idx, later)] = func_furu_H02_array(height[furu_idx, None], alder[furu_idx, None], alder[furu_idx, None] + years[later])
+
+    gran_idx = np.flatnonzero(gran_mask)
+    if direct_gran:
+        H01 = height[gran_idx, None]
+        A1 = alder[gran_idx, None]
+        anchor = _gran_anchor(H01, A1)
+        out[np.ix_(gran_idx, later)] = _direct_gran_height(H01, A1, anchor, years[later])
+    elif len(gran_idx) > 0 and later.any():
+        gran_heights = project_heights(height[gran_idx], alder[gran_idx], np.ones(len(gran_idx), dtype=bool), np.zeros(len(gran_idx), dtype=bool), horizon=years.max())
+        out[np.ix_(gran_idx, later)] = gran_heights[:, years[later]]
+    return out
+
+#Future N per hectare of the stands
+def project_N_per_hectare(N_per_hectare, alder, Ht40, gran_mask, furu_mask, horizon=HORIZON, out=None):
+    densities = _new_projection(N_per_hectare, horizon, out)
+    gran_idx = np.flatnonzero(gran_mask)
+    furu_idx = np.flatnonzero(furu_mask)
+    for year in range(1, densities.shape[1]):
+        densities[gran_idx, year] = gran_N2_per_hectare_array(densities[gran_idx, year - 1], alder[gran_idx] + year - 1, alder[gran_idx] + year, Ht40[gran_idx])
+        densities[furu_idx, year] = furu_N2_per_hectare_array(densities[furu_idx, year - 1], alder[furu_idx] + year - 1, alder[furu_idx] + year, Ht40[furu_idx])
+    return densities
+
+#Future base area of the stands, based on the projected heights and densities
+def project_base_area(G2, alder, heights, densities, gran_mask, furu_mask, horizon=HORIZON, out=None):
+    base_areas = _new_projection(G2, horizon, out)
+    gran_idx = np.flatnonzero(gran_mask)
+    furu_idx = np.flatnonzero(furu_mask)
+    for year in range(1, base_areas.shape[1]):
+        base_areas[gran_idx, year] = gran_basearea_growth_array(
+            base_areas[gran_idx, year - 1],
+            densities[gran_idx, year - 1],
+            densities[gran_idx, year],
+            heights[gran_idx, year - 1],
+            heights[gran_idx, year],
+            )
+        base_areas[furu_idx, year] = furu_basearea_growth_array(
+            base_areas[furu_idx, year - 1],
+            alder[furu_idx] + year - 1,
+            alder[furu_idx] + year,
+            heights[furu_idx, year - 1],
+            heights[furu_idx, year],
+            densities[furu_idx, year - 1],
+            densities[furu_idx, year],
+            )
+    return base_areas
+
+#Future volume per hectare of the stands, based on the projected heights and base areas
+def project_volume_per_hectare(volume_per_hectare, alder, heights, base_areas, gran_mask, furu_mask, horizon=HORIZON, out=None):
+    volumes = _new_projection(volume_per_hectare, horizon, out)
+    gran_idx = np.flatnonzero(gran_mask)
+    furu_idx = np.flatnonzero(furu_mask)
+    for year in range(1, volumes.shape[1]):
+        volumes[gran_idx, year] = gran_volume_array(base_areas[gran_idx, year], heights[gran_idx, year], alder[gran_idx] + year)
+        volumes[furu_idx, year] = furu_volume_array(base_areas[furu_idx, year], heights[furu_idx, year], alder[furu_idx] + year)
+    return volumes
+
+#Yearly growth rate of the volume per hectare. Column 0 has no previous year and stays np.nan
+def growth_rate_array(volumes, out=None):
+    if out is None:
+        out = np.empty(volumes.shape, dtype=volumes.dtype, order='F')
+    out[:, 0] = np.nan
+    with np.errstate(all='ignore'):
+        np.subtract(volumes[:, 1:], volumes[:, :-1], out=out[:, 1:])
+        np.divide(out[:, 1:], volumes[:, :-1], out=out[:, 1:])
+    return out
+
+#Index of the first year in which the growth rate falls below the yield requirement, 0 if it never does.
+#growth_rates holds the growth rates from the first year we check (see calculate_years_to_maturity), stands that are not active get np.nan.
+#yield_requirement can also be a sequence, all requirements are then searched at once and the result has one column per requirement
+def years_to_maturity_array(growth_rates, active, yield_requirement=0.03):
+    yield_requirements = np.atleast_1d(np.asarray(yield_requirement, dtype=float))
+    below_yield = growth_rates[:, :, None] < yield_requirements
+    years_to_maturity = np.argmax(below_yield, axis=1).astype(float)
+    years_to_maturity[~active] = np.nan
+    return years_to_maturity if np.ndim(yield_requirement) else years_to_maturity[:, 0]
+
+#The volume of each stand in the year it matures, found by indexing the volume trajectories with years_to_maturity.
+#years_to_maturity can have one column per yield requirement, as returned by years_to_maturity_array
+def volume_at_maturity_array(volumes, years_to_maturity, arealm2):
+    volume_at_maturity = np.full(years_to_maturity.shape, np.nan)
+    matured = ~np.isnan(years_to_maturity)
+    stand = np.nonzero(matured)[0]
+    maturity_year = years_to_maturity[matured].astype(int)
+    volume_at_maturity[matured] = volumes[stand, maturity_year] * arealm2[stand] / 10000
+    return volume_at_maturity
+
+#Columns of df_bestander that simulate_stands needs
+SIMULATION_COLUMNS = ('treslag', 'alder', 'Ht40', 'height', 'N_per_hectare', 'G2', 'volume_per_hectare', 'yearly_height_growth', 'delta_N_per_hectare', 'volume_growth_next_year')
+
+#The stands of one species, gathered into contiguous arrays holding their current state.
+#Every array in the partition has one entry per stand, idx being the position of the stand in columns
+def _species_partition(columns, species, height_active, density_active, volume_active, direct_gran, n_requirements):
+    treslag = np.asarray(columns['treslag'])
+    idx = np.flatnonzero((treslag == species) & (height_active | density_active | volume_active))
+    alder = np.asarray(columns['alder'], dtype=float)[idx]
+    #Quantities we skip for a stand start out as np.nan, which carries through all the formulas, so the
+    #stands get the same np.nan trajectories as with the calculate_future_* functions
+    height = np.where(height_active[idx], np.asarray(columns['height'], dtype=float)[idx], np.nan)
+    volume = np.where(volume_active[idx], np.asarray(columns['volume_per_hectare'], dtype=float)[idx], np.nan)
+    partition = {
+        'idx': idx,
+        'alder': alder,
+        'Ht40': np.asarray(columns['Ht40'], dtype=float)[idx],
+        'height': height,
+        'N_per_hectare': np.where(density_active[idx], np.asarray(columns['N_per_hectare'], dtype=float)[idx], np.nan),
+        'G': np.where(volume_active[idx], np.asarray(columns['G2'], dtype=float)[idx], np.nan),
+        'volume_per_hectare': volume,
+        'start_volume_per_hectare': volume,
+        'previous_volume_per_hectare': np.full(len(idx), np.nan),
+        #One column per yield requirement. Stands without a volume are never checked for maturity
+        'matured': np.repeat(~volume_active[idx, None], n_requirements, axis=1),
+    }
+    if species == 'Gran' and direct_gran:
+        partition['start_height'] = height
+        partition['anchor_years_on_furu'], partition['anchor_age'], partition['anchor_height'] = _gran_anchor(height, alder)
+    return species, partition
+
+#Keeps only the stands selected by keep in a species partition
+def _compact_partition(partition, keep):
+    for key in partition:
+        partition[key] = partition[key][keep]
+
+#Advances one species partition from year - 1 to year
+def _advance_partition(species, partition, year):
+    A1 = partition['alder'] + year - 1
+    A2 = partition['alder'] + year
+    H1 = partition['height']
+    N1 = partition['N_per_hectare']
+    G1 = partition['G']
+    if species == 'Gran':
+        if 'anchor_age' in partition:
+            anchor = (partition['anchor_years_on_furu'], partition['anchor_age'], partition['anchor_height'])
+            H2 = _direct_gran_height(partition['start_height'], partition['alder'], anchor, year)
+        else:
+            H2 = func_gran_H02_array(H1, A1, A2)
+        N2 = gran_N2_per_hectare_array(N1, A1, A2, partition['Ht40'])
+        G2 = gran_basearea_growth_array(G1, N1, N2, H1, H2)
+        V2 = gran_volume_array(G2, H2, A2)
+    else:
+        H2 = func_furu_H02_array(H1, A1, A2)
+        N2 = furu_N2_per_hectare_array(N1, A1, A2, partition['Ht40'])
+        G2 = furu_basearea_growth_array(G1, A1, A2, H1, H2, N1, N2)
+        V2 = furu_volume_array(G2, H2, A2)
+    partition['height'] = H2
+    partition['N_per_hectare'] = N2
+    partition['G'] = G2
+    partition['previous_volume_per_hectare'], partition['volume_per_hectare'] = partition['volume_per_hectare'], V2
+
+#Simulates all stands in one pass over the years: height, N per hectare, base area and volume of both species are advanced
+#together, and the growth rate and the year each stand matures are found as we go, so no 100 year matrices are needed.
+#columns holds one array per name in SIMULATION_COLUMNS (e.g. the columns of df_bestander after the current year values are added).
+#The skip rules and the maturity rule are the same as in the calculate_future_* and calculate_years_to_maturity functions of Bio_growth:
+#maturity is the first year, counting from year 2, where the growth rate falls below yield_requirement, 0 if it never does within horizon.
+#Returns years_to_maturity and the volume per hectare in that year. yield_requirement can also be a sequence, the stands are then
+#simulated once and the results have one column per requirement. When trajectories (from allocate_trajectories) is given,
+#the yearly values are written into it as well and horizon follows from its shape.
+#With lazy=True (ignored when trajectories is given) a stand stops being advanced as soon as its maturity year is known for every requirement,
+#or once its base area has become np.nan and it can no longer mature, and the loop ends when no stands are left.
+#Most stands mature well before the horizon, so this removes most of the work without changing the results
+def simulate_stands(columns, yield_requirement=0.03, horizon=HORIZON, trajectories=None, direct_gran=False, lazy=True):
+    yield_requirements = np.atleast_1d(np.asarray(yield_requirement, dtype=float))
+    height_active = ~np.isnan(np.asarray(columns['yearly_height_growth'], dtype=float))
+    density_active = ~np.isnan(np.asarray(columns['delta_N_per_hectare'], dtype=float))
+    volume_active = ~np.isnan(np.asarray(columns['volume_growth_next_year'], dtype=float))
+    partitions = [_species_partition(columns, species, height_active, density_active, volume_active, direct_gran, len(yield_requirements)) for species in ('Gran', 'Furu')]
+
+    n_stands = len(height_active)
+    years_to_maturity = np.full((n_stands, len(yield_requirements)), np.nan)
+    volume_per_hectare_at_maturity = np.full((n_stands, len(yield_requirements)), np.nan)
+
+    if trajectories is not None:
+        lazy = False
+        horizon = trajectories['volume_per_hectare'].shape[1] - 1
+        for quantity, start_column in (('height', 'height'), ('N_per_hectare', 'N_per_hectare'), ('G', 'G2'), ('volume_per_hectare', 'volume_per_hectare')):
+            _new_projection(np.asarray(columns[start_column], dtype=float), horizon, trajectories[quantity])
+        trajectories['growth_rate'][:] = np.nan
+
+    for year in range(1, horizon + 1):
+        for species, partition in partitions:
+            #The volume two years back, which is the volume at maturity if the stand matures this year
+            volume_two_years_back = partition['previous_volume_per_hectare']
+            _advance_partition(species, partition, year)
+            with np.errstate(all='ignore'):
+                growth_rate = (partition['volume_per_hectare'] - partition['previous_volume_per_hectare']) / partition['previous_volume_per_hectare']
+
+            # Year 1 growth rates come out too high, so like calculate_years_to_maturity we start the check at year 2
+            if year >= 2:
+                #All yield requirements are checked at once
+                matures = ~partition['matured'] & (growth_rate[:, None] < yield_requirements)
+                stand, requirement = np.nonzero(matures)
+                years_to_maturity[partition['idx'][stand], requirement] = year - 2
+                volume_per_hectare_at_maturity[partition['idx'][stand], requirement] = volume_two_years_back[stand]
+                partition['matured'] |= matures
+
+            if trajectories is not None:
+                idx = partition['idx']
+                trajectories['height'][idx, year] = partition['height']
+                trajectories['N_per_hectare'][idx, year] = partition['N_per_hectare']
+                trajectories['G'][idx, year] = partition['G']
+                trajectories['volume_per_hectare'][idx, year] = partition['volume_per_hectare']
+                trajectories['growth_rate'][idx, year] = growth_rate
+
+            if lazy:
+                #A stand whose base area is np.nan keeps a np.nan volume and never matures
+                stuck = ~partition['matured'] & np.isnan(partition['G'])[:, None]
+                stand, requirement = np.nonzero(stuck)
+                years_to_maturity[partition['idx'][stand], requirement] = 0
+                volume_per_hectare_at_maturity[partition['idx'][stand], requirement] = partition['start_volume_per_hectare'][stand]
+                partition['matured'] |= stuck
+                finished = partition['matured'].all(axis=1)
+                #Compacting costs a copy of the partition, so we only do it once a good share of the stands are done
+                if finished.sum() * 8 >= len(finished):
+                    _compact_partition(partition, ~finished)
+        if lazy and all(len(partition['idx']) == 0 for species, partition in partitions):
+            break
+
+    for species, partition in partitions:
+        #Stands that never fall below the yield requirement get 0 years to maturity, i.e. their current volume
+        stand, requirement = np.nonzero(~partition['matured'])
+        years_to_maturity[partition['idx'][stand], requirement] = 0
+        volume_per_hectare_at_maturity[partition['idx'][stand], requirement] = partition['start_volume_per_hectare'][stand]
+
+    if np.ndim(yield_requirement) == 0:
+        years_to_maturity = years_to_maturity[:, 0]
+        volume_per_hectare_at_maturity = volume_per_hectare_at_maturity[:, 0]
+    return {'years_to_maturity': years_to_maturity, 'volume_per_hectare_at_maturity': volume_per_hectare_at_maturity}
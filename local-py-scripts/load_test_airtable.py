@@ -0,0 +1,194 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+from urllib.parse import urlsplit
+import numpy as np
+import requests
+import airtable_stand_in
+import benchmark_Bio_growth
+import growth_model
+
+# Load test of the Airtable paths of the lambdas against the Airtable stand-in (airtable_stand_in.py), on synthetic forests of the given sizes.
+# Each forest goes through the Airtable calls of its life in SkogApp, one phase at a time:
+#   featureInfo  creates the table and upserts the stands, like featureInfoToAirtable
+#   SR16         lists the bestand_ids and updates the SR16 values of the stands, like SR16IntersectionToAirtable
+#   model        runs the model lambda, which reads the stands and writes back the results of all of them. This checks that the
+#                first results are written while the rest of the forest is still computed (see lambda_function.MODEL_WRITE_CHUNK_SIZE)
+#   model again  runs the model lambda again, which only writes back what changed: nothing, as nothing changed in between.
+#                The synthetic forests have stands with missing ages and SR16 values, which the model writes back as 0, so this
+#                checks that those stands don't look changed once they are read back (see growth_model.input_fingerprints)
+# featureInfoToAirtable and SR16IntersectionToAirtable need S3, shapefiles and PostGIS, so their Airtable calls are replayed through
+# airtable_io the way they make them. The model lambda itself is run, from lambdas/model/code.
+# Run it from this folder, next to the Bonitetstabell CSVs, like local_model.py:
+#   python load_test_airtable.py                                      # sizes 100 to 10000 against a stand-in with Airtable's rate limit
+#   python load_test_airtable.py --sizes 20000 --latency 0.25 --jitter 0.1 --throttle-rate 0.02
+#   python load_test_airtable.py --api-root http://localhost:8765/v0  # against a stand-in that is already running
+# The client settings come from the environment like in the lambdas, e.g. AIRTABLE_MAX_CONCURRENCY=8 or AIRTABLE_REQUESTS_PER_SECOND=10
+# The exit code is 1 if any of the checks fails, so it can be used to check a change
+
+SIZES = [100, 1000, 10000]
+BASE_ID = 'appLoadTest0000000'
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+LAMBDA_PATHS = [os.path.join(script_dir, '..', 'lambdas', 'shared'), os.path.join(script_dir, '..', 'lambdas', 'model', 'code')]
+
+# The SR16 values of the stands, written by the SR16 phase
+SR16_COLUMNS = ('srhoydeo', 'srtrean', 'srgrflate', 'srvolmb', 'srvolub')
+
+# The fields of the forest tables, as featureInfoToAirtable creates them
+def forest_fields():
+    fields = [{'name': 'bestand_id', 'type': 'singleLineText'}]
+    for name in (*growth_model.INPUT_COLUMNS, *growth_model.RESULT_COLUMNS):
+        if name == 'treslag':
+            choices = [{'name': 'Furu'}, {'name': 'Gran'}, {'name': 'Bjørk / lauv'}]
+            fields.append({'name': name, 'type': 'singleSelect', 'options': {'choices': choices}})
+        else:
+            precision = 0 if name in ('hogstkl_verdi', 'bonitet', 'arealm2', 'alder') else 3 if name == 'yield_requirement' else 8
+            fields.append({'name': name, 'type': 'number', 'options': {'precision': precision}})
+    fields.append({'name': 'model_fingerprint', 'type': 'singleLineText'})
+    return fields
+
+# Whether the model wrote to Airtable before it had computed its last chunk, from the progress_log of model_phase.
+# A forest larger than write_chunk_size computed in one go never overlaps. Otherwise it is None when the model computed too little
+# to tell: the first write waits up to one slot of the rate limit and one round trip, and the model may be done before then
+def writes_overlap_computation(progress_log, write_chunk_size, seconds_to_first_write):
+    chunks = [entry for entry in progress_log if entry[1] > 0]
+    if not chunks:
+        return None
+    if len(chunks) == 1:
+        return False if chunks[0][1] > write_chunk_size else None
+    if chunks[-1][0] - progress_log[0][0] < seconds_to_first_write:
+        return None
+    return chunks[-1][2] > progress_log[0][2]
+
+# The stands of a synthetic forest as the fields of Airtable records, leaving out the missing values
+def forest_records(n_stands, seed=0):
+    df = benchmark_Bio_growth.synthetic_bestandsdata(n_stands, seed)
+    records = []
+    for row in df.to_dict(orient='records'):
+        fields = {}
+        for name, value in row.items():
+            if isinstance(value, (float, np.floating)) and np.isnan(value):
+                continue
+            fields[name] = value.item() if isinstance(value, np.generic) else value
+        records.append(fields)
+    return records
+
+def server_stats(api_root):
+    url = urlsplit(api_root)
+    return requests.get(f"{url.scheme}://{url.netloc}/_stats").json()
+
+# Runs one phase, returning the wall time in seconds and what the stand-in served meanwhile.
+# The log lines of the lambdas are left out of the output
+def run_phase(api_root, function, *args):
+    before = server_stats(api_root)
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        function(*args)
+    seconds = time.perf_counter() - start
+    after = server_stats(api_root)
+    served = {key: after[key] - before[key] for key in after if key != 'requests'}
+    served['requests'] = sum(after['requests'].values()) - sum(before['requests'].values())
+    return seconds, served
+
+def feature_info_phase(airtable, airtable_io, table_name, records):
+    if not any(table['name'] == table_name for table in airtable.tables()):
+        airtable.create_table(table_name, forest_fields())
+    stands = [{'fields': {name: value for name, value in fields.items() if name not in SR16_COLUMNS}} for fields in records]
+    airtable_io.raise_for_failed_batches(airtable.upsert_records(table_name, stands, ['bestand_id']))
+
+def sr16_phase(airtable, airtable_io, table_name, records):
+    record_ids = {record['fields']['bestand_id']: record['id'] for record in airtable.list_records(table_name, ['bestand_id'])}
+    updates = []
+    for fields in records:
+        sr16 = {name: fields[name] for name in SR16_COLUMNS if name in fields}
+        if sr16:
+            updates.append({'id': record_ids[fields['bestand_id']], 'fields': sr16})
+    airtable_io.raise_for_failed_batches(airtable.update_records(table_name, updates))
+
+# The number of writes (creates, updates and upserts) the stand-in has received
+def write_requests(api_root):
+    requests_received = server_stats(api_root)['requests']
+    return requests_received.get('POST', 0) + requests_received.get('PATCH', 0)
+
+# Runs the model lambda. With progress_log, the time, the stands computed and the writes received so far are added to it
+# every time the model has computed a chunk
+def model_phase(lambda_function, forestID, api_root, progress_log=None):
+    def progress(stage, **details):
+        if progress_log is not None and stage == 'model':
+            progress_log.append((time.perf_counter(), details['stands_done'], write_requests(api_root)))
+    response = lambda_function.model({'body': json.dumps({'forestID': forestID})}, progress)
+    if response['statusCode'] != 200:
+        raise RuntimeError(f"The model returned {response['statusCode']}: {response['body']}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the Airtable paths of the lambdas against the Airtable stand-in')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help='number of stands in each synthetic forest')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--api-root', default=None, help='a stand-in that is already running, instead of starting one')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds the stand-in adds to every request')
+    parser.add_argument('--jitter', type=float, default=0.0, help='the latency varies at random by up to this many seconds either way')
+    parser.add_argument('--rate-limit', type=float, default=airtable_stand_in.REQUESTS_PER_SECOND, help='requests per second per base before 429, 0 for no limit')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='share of requests answered 429 at random')
+    args = parser.parse_args()
+
+    server = None
+    api_root = args.api_root
+    if api_root is None:
+        settings = airtable_stand_in.Settings(args.latency, args.jitter, args.rate_limit, args.throttle_rate, seed=args.seed)
+        server = airtable_stand_in.AirtableStandIn(('127.0.0.1', 0), settings).start()
+        api_root = server.api_root
+    print(f"Airtable stand-in at {api_root}")
+
+    # The lambdas read their Airtable settings when they are imported
+    os.environ['AIRTABLE_API_ROOT'] = api_root
+    os.environ.setdefault('AIRTABLE_PERSONAL_ACCESS_TOKEN', 'local')
+    os.environ['AIRTABLE_BASE_ID'] = BASE_ID
+    sys.path.extend(LAMBDA_PATHS)
+    import airtable_io
+    import lambda_function
+    airtable = airtable_io.AirtableClient(os.environ['AIRTABLE_PERSONAL_ACCESS_TOKEN'], BASE_ID, api_root)
+    print(f"Client: {airtable_io.REQUESTS_PER_SECOND} requests per second, {airtable_io.MAX_CONCURRENCY} at a time")
+
+    phases = [
+        ('featureInfo', lambda forestID, table_name, records: feature_info_phase(airtable, airtable_io, table_name, records)),
+        ('SR16', lambda forestID, table_name, records: sr16_phase(airtable, airtable_io, table_name, records)),
+        ('model', lambda forestID, table_name, records: model_phase(lambda_function, forestID, api_root, progress_log)),
+        ('model again', lambda forestID, table_name, records: model_phase(lambda_function, forestID, api_root)),
+    ]
+    seconds_to_first_write = 1 / airtable_io.REQUESTS_PER_SECOND + args.latency + args.jitter + 0.1
+    checks_pass = True
+    try:
+        for n_stands in args.sizes:
+            forestID = f"loadtest{n_stands}x{args.seed}"
+            table_name = f"{forestID}_bestandsdata"
+            records = forest_records(n_stands, args.seed)
+            print(f"\n{n_stands} stands")
+            print(f"  {'phase':<14}{'seconds':>10}{'requests':>10}{'req/s':>8}{'429s':>7}{'created':>9}{'updated':>9}{'listed':>9}{'stands/s':>10}")
+            progress_log = []
+            for name, phase in phases:
+                seconds, served = run_phase(api_root, phase, forestID, table_name, records)
+                print(f"  {name:<14}{seconds:>10.2f}{served['requests']:>10}{served['requests'] / seconds:>8.1f}{served['throttled']:>7}"
+                      f"{served['records_created']:>9}{served['records_updated']:>9}{served['records_listed']:>9}{n_stands / seconds:>10.0f}")
+                if name == 'model':
+                    overlap = writes_overlap_computation(progress_log, lambda_function.MODEL_WRITE_CHUNK_SIZE, seconds_to_first_write)
+                    if overlap is False:
+                        print("  CHECK FAILED: the model wrote nothing to Airtable until it had computed every stand")
+                        checks_pass = False
+                    elif overlap is None:
+                        print("  (the model computed too fast to check that it writes while it computes)")
+                if name == 'model again' and served['records_created'] + served['records_updated']:
+                    print(f"  CHECK FAILED: the model wrote {served['records_created'] + served['records_updated']} stands again though nothing changed")
+                    checks_pass = False
+    finally:
+        if server is not None:
+            server.shutdown()
+    if not checks_pass:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,7 @@ import requests
 import os
 import pandas as pd
 import Bio_growth
+import growth_model
 
 # Airtable configuration
 AIRTABLE_PERSONAL_ACCESS_TOKEN = os.getenv('AIRTABLE_PERSONAL_ACCESS_TOKEN')
@@ -28,7 +29,7 @@ def model(event):
     
     # Fetch data from Airtable
     print("Fetching data from Airtable for Table name: ", TABLE_NAME)
-    airtable_data = fetch_airtable_data(AIRTABLE_API_URL)
+    airtable_data, existing_records = fetch_airtable_records(AIRTABLE_API_URL, ('bestand_id', *growth_model.INPUT_COLUMNS))
     df_airtable = pd.DataFrame(airtable_data)
     print(f"Fetched {len(df_airtable)} records from Airtable.")
 
@@ -43,11 +44,6 @@ def model(event):
     # Convert DataFrame to a dictionary or JSON serializable format
     result = df_bestander.to_dict(orient='records')
 
-    # Get existing records from Airtable
-    print("Fetching existing records from Airtable...")
-    existing_records = get_existing_records(AIRTABLE_API_URL)
-    print(f"Fetched {len(existing_records)} existing records from Airtable.")
-
     # Prepare batches of records to be sent
     records_to_update = []
     records_to_create = []
@@ -100,48 +96,33 @@ def model(event):
     }
     return add_cors_headers(response)
 
-def fetch_airtable_data(airtableURL):
+# Pages through the table once and returns the fields of every record, and the record id of every bestand_id.
+# Only the given fields are fetched (with Airtable's fields[] projection), so the pages don't carry the results of earlier runs
+def fetch_airtable_records(airtableURL, field_names):
     headers = {
         'Authorization': f'Bearer {AIRTABLE_PERSONAL_ACCESS_TOKEN}',
     }
     params = {
-        'pageSize': 100
+        'pageSize': 100,
+        'fields[]': list(field_names),
     }
     all_records = []
-    while True:
-        response = requests.get(airtableURL, headers=headers, params=params)
-        response.raise_for_status()
-        data = response.json()
-        records = data['records']
-        all_records.extend(record['fields'] for record in records)
-        if 'offset' in data:
-            params['offset'] = data['offset']
-        else:
-            break
-    return all_records
-
-def get_existing_records(airtableURL):
-    headers = {
-        'Authorization': f'Bearer {AIRTABLE_PERSONAL_ACCESS_TOKEN}',
-    }
-    params = {
-        'pageSize': 100
-    }
-    records = {}
+    existing_records = {}
     while True:
         response = requests.get(airtableURL, headers=headers, params=params)
         response.raise_for_status()
         data = response.json()
         for record in data['records']:
             fields = record.get('fields', {})
+            all_records.append(fields)
             bestand_id = fields.get('bestand_id')
             if bestand_id:
-                records[bestand_id] = record['id']
+                existing_records[bestand_id] = record['id']
         if 'offset' in data:
             params['offset'] = data['offset']
         else:
             break
-    return records
+    return all_records, existing_records
 
 def batch_update_airtable_records(records, airtableURL):
     headers = {